@@ -0,0 +1,54 @@
+import util
+
+from . import fixtures
+
+
+class Cor:
+    params = (['pearson', 'spearman'], fixtures.n_genes, fixtures.n_cases,
+              fixtures.n_features)
+    param_names = ['method', 'n_genes', 'n_cases', 'n_features']
+    timeout = 600
+
+    # util.cor tests every pair separately
+    max_pairs = 21000
+    max_values = 210000000
+
+    def setup(self, method, n_genes, n_cases, n_features):
+        fixtures.skip_if_larger(n_genes * n_features, self.max_pairs)
+        fixtures.skip_if_larger(n_genes * n_features * n_cases,
+                                self.max_values)
+        self.gexp = fixtures.log2_cpm(n_cases, n_genes)
+        self.mri = fixtures.mri_features(n_cases, n_features,
+                                         nan_fraction=0.05)
+
+    def time_cor(self, method, n_genes, n_cases, n_features):
+        util.cor(self.gexp, self.mri, 'case', method=method)
+
+    def peakmem_cor(self, method, n_genes, n_cases, n_features):
+        util.cor(self.gexp, self.mri, 'case', method=method)
+
+
+class SparseCor:
+    params = (['pearson', 'spearman'], fixtures.n_genes, fixtures.n_cases,
+              fixtures.n_features)
+    param_names = ['method', 'n_genes', 'n_cases', 'n_features']
+    timeout = 600
+
+    # Pairs are tested in blocks, the limit is on the values per block
+    max_values = 2000000000
+
+    def setup(self, method, n_genes, n_cases, n_features):
+        fixtures.skip_if_larger(n_genes * n_features * n_cases,
+                                self.max_values)
+        self.gexp = fixtures.log2_cpm(n_cases, n_genes)
+        self.mri = fixtures.mri_features(n_cases, n_features,
+                                         nan_fraction=0.05)
+
+    def time_cor_fdr(self, method, n_genes, n_cases, n_features):
+        util.cor(self.gexp, self.mri, 'case', method=method, max_fdr=0.05)
+
+    def time_cor_top_k(self, method, n_genes, n_cases, n_features):
+        util.cor(self.gexp, self.mri, 'case', method=method, top_k=100)
+
+    def peakmem_cor_fdr(self, method, n_genes, n_cases, n_features):
+        util.cor(self.gexp, self.mri, 'case', method=method, max_fdr=0.05)
@@ -0,0 +1,19 @@
+import numpy as np
+
+from models import cross_validate
+
+from . import fixtures
+
+
+class CrossValidate:
+    params = ([100, 1000], [10, 100])
+    param_names = ['n_cases', 'n_targets']
+    timeout = 600
+
+    def setup(self, n_cases, n_targets):
+        r = np.random.RandomState(0)
+        self.x = fixtures.mri_features(n_cases, 21).values
+        self.y = self.x @ r.randn(21, n_targets) + r.randn(n_cases, n_targets)
+
+    def time_cross_validate(self, n_cases, n_targets):
+        cross_validate.cross_validate(self.x, self.y, 10, 0, 1)
@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+from features import eigenbreasts
+
+from . import fixtures
+
+
+class EigenbreastPca:
+    params = (fixtures.n_cases, [32, 64], ['randomized', 'incremental'])
+    param_names = ['n_cases', 'size', 'method']
+    timeout = 300
+
+    def setup(self, n_cases, size, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.stack = os.path.join(self.tmp_dir.name, 'stack.npy')
+        fixtures.write_image_stack(self.stack, n_cases, size)
+
+    def teardown(self, n_cases, size, method):
+        self.tmp_dir.cleanup()
+
+    def time_pca(self, n_cases, size, method):
+        eigenbreasts.methods[method](self.stack, 50)
+
+    def peakmem_pca(self, n_cases, size, method):
+        eigenbreasts.methods[method](self.stack, 50)
@@ -0,0 +1,28 @@
+from features import fa_mri_features
+
+from . import fixtures
+
+
+class AdjustScale:
+    params = (fixtures.n_cases, fixtures.n_features)
+    param_names = ['n_cases', 'n_features']
+
+    def setup(self, n_cases, n_features):
+        self.mri = fixtures.mri_features(n_cases, n_features)
+
+    def time_adjust_scale(self, n_cases, n_features):
+        fa_mri_features.adjust_scale(self.mri)
+
+
+class ComputeFactors:
+    params = (fixtures.n_cases, fixtures.n_features, [5])
+    param_names = ['n_cases', 'n_features', 'n_components']
+    timeout = 300
+
+    def setup(self, n_cases, n_features, n_components):
+        self.mri = fa_mri_features.adjust_scale(
+            fixtures.mri_features(n_cases, n_features,
+                                  n_latent=n_components))
+
+    def time_compute_factors(self, n_cases, n_features, n_components):
+        fa_mri_features.compute_factors(self.mri, n_components)
@@ -0,0 +1,63 @@
+import matplotlib
+import numpy as np
+matplotlib.use('Agg')
+
+import matplotlib.pyplot  # noqa: E402
+
+from lib.sketch import QuantileSketch  # noqa: E402
+import plot  # noqa: E402
+
+from . import fixtures  # noqa: E402
+
+
+class Heatmap:
+    params = (fixtures.n_cases, fixtures.n_features)
+    param_names = ['n_cases', 'n_features']
+    timeout = 300
+
+    def setup(self, n_cases, n_features):
+        mri = fixtures.mri_features(n_cases, n_features)
+        self.z = (mri - mri.mean('case')) / mri.std('case')
+        self.fig, self.ax = matplotlib.pyplot.subplots()
+
+    def teardown(self, n_cases, n_features):
+        matplotlib.pyplot.close(self.fig)
+
+    def time_heatmap_dendrograms(self, n_cases, n_features):
+        plot.heatmap(self.z, row_dendrogram=True, col_dendrogram=True,
+                     ax=self.ax)
+
+
+class QQPlot:
+    params = ([100000, 1000000, 10000000], ['array', 'sketch'])
+    param_names = ['n_values', 'input']
+    timeout = 300
+
+    def setup(self, n_values, input):
+        rng = fixtures.rng(n_values)
+        self.p = rng.uniform(size=n_values)
+        self.expected = rng.uniform(size=n_values)
+        if input == 'sketch':
+            self.p = QuantileSketch().update(self.p)
+            self.expected = QuantileSketch().update(self.expected)
+        self.fig, self.ax = matplotlib.pyplot.subplots()
+
+    def teardown(self, n_values, input):
+        matplotlib.pyplot.close(self.fig)
+
+    def time_qqplot(self, n_values, input):
+        plot.qqplot(self.expected, self.p, ax=self.ax)
+
+
+class BuildQuantileSketch:
+    params = [1000000, 10000000]
+    param_names = ['n_values']
+    timeout = 300
+
+    def setup(self, n_values):
+        self.p = fixtures.rng(n_values).uniform(size=n_values)
+
+    def time_update_chunks(self, n_values):
+        sketch = QuantileSketch()
+        for chunk in np.array_split(self.p, 100):
+            sketch.update(chunk)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+import numpy as np
+
+from data import process_gene_expression
+from data import qc_gene_expression
+from lib import sparse_counts
+
+from . import fixtures
+
+
+class CountsToLog2Cpm:
+    params = (fixtures.n_cases, fixtures.n_genes, ['dense', 'csr', 'csc'])
+    param_names = ['n_cases', 'n_genes', 'storage']
+    timeout = 300
+
+    max_values = 100000000
+
+    def setup(self, n_cases, n_genes, storage):
+        fixtures.skip_if_larger(n_cases * n_genes, self.max_values)
+        self.counts = fixtures.read_counts(n_cases, n_genes)['read_count']
+        if storage != 'dense':
+            self.counts = sparse_counts.from_dense(self.counts, storage)
+
+    def time_counts_to_log2_cpm(self, n_cases, n_genes, storage):
+        process_gene_expression.counts_to_log2_cpm(self.counts)
+
+    def peakmem_counts_to_log2_cpm(self, n_cases, n_genes, storage):
+        process_gene_expression.counts_to_log2_cpm(self.counts)
+
+
+class AnnotateGenes:
+    params = (fixtures.n_genes, ['tsv', 'nc'])
+    param_names = ['n_genes', 'reference']
+    timeout = 300
+    # annotate_genes modifies the data set in place
+    number = 1
+
+    def setup(self, n_genes, reference):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.annot_path = os.path.join(self.tmp_dir.name,
+                                       f'ensembl.{reference}')
+        fixtures.write_ensembl_reference(self.annot_path, n_genes)
+        self.data_set = fixtures.read_counts(10, n_genes)
+
+    def teardown(self, n_genes, reference):
+        self.tmp_dir.cleanup()
+
+    def time_annotate_genes(self, n_genes, reference):
+        process_gene_expression.annotate_genes(self.data_set,
+                                               self.annot_path)
+
+
+class QcMetrics:
+    params = (fixtures.n_cases, fixtures.n_genes)
+    param_names = ['n_cases', 'n_genes']
+    timeout = 300
+
+    max_values = 100000000
+
+    def setup(self, n_cases, n_genes):
+        fixtures.skip_if_larger(n_cases * n_genes, self.max_values)
+        self.data_set = fixtures.read_counts(n_cases, n_genes)
+        for counter in qc_gene_expression.star_counters:
+            self.data_set[counter] = ('sample', np.full(n_cases, 100000))
+
+    def time_qc_metrics(self, n_cases, n_genes):
+        qc_gene_expression.qc_metrics(self.data_set, 64, 50, 1024, 0)
+
+    def peakmem_qc_metrics(self, n_cases, n_genes):
+        qc_gene_expression.qc_metrics(self.data_set, 64, 50, 1024, 0)
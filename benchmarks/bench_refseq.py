@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+from data import map_genes_zwart2011
+from data import parse_genbank_flatfile
+
+from . import fixtures
+
+
+class ParseGbff:
+    params = fixtures.n_genes
+    param_names = ['n_loci']
+    timeout = 300
+
+    def setup(self, n_loci):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gbff = os.path.join(self.tmp_dir.name, 'refseq.gbff.gz')
+        self.out = os.path.join(self.tmp_dir.name, 'refseq-hgnc.tsv')
+        fixtures.write_gbff(self.gbff, n_loci)
+
+    def teardown(self, n_loci):
+        self.tmp_dir.cleanup()
+
+    def time_parse_gbff(self, n_loci):
+        parse_genbank_flatfile.parse_gbff.callback(self.gbff, self.out)
+
+
+class MapGenes:
+    params = (fixtures.n_genes, ['tsv', 'nc'])
+    param_names = ['n_genes', 'reference']
+    timeout = 300
+
+    def setup(self, n_genes, reference):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = [os.path.join(self.tmp_dir.name, f) for f in
+                      ['zwart2011.xlsx', 'refseq-hgnc.tsv',
+                       f'ensembl.{reference}', 'out.tsv']]
+        xls, refseq, ensembl, _ = self.paths
+        fixtures.write_zwart2011(xls, n_genes)
+        fixtures.write_refseq_hgnc(refseq, n_genes)
+        fixtures.write_ensembl_reference(ensembl, n_genes)
+
+    def teardown(self, n_genes, reference):
+        self.tmp_dir.cleanup()
+
+    def time_map_genes(self, n_genes, reference):
+        map_genes_zwart2011.map_genes.callback(*self.paths)
@@ -0,0 +1,26 @@
+from models import sfa
+
+from . import fixtures
+
+
+class FitSfa:
+    params = ([100, 1000], [1000, 10000], ['cold', 'warm'])
+    param_names = ['n_cases', 'n_genes', 'start']
+    timeout = 600
+
+    def setup(self, n_cases, n_genes, start):
+        self.data = {
+            'gexp': sfa.standardize(
+                fixtures.log2_cpm(n_cases, n_genes).values),
+            'mri': sfa.standardize(
+                fixtures.mri_features(n_cases, 21).values),
+        }
+        self.init = None
+        if start == 'warm':
+            # The neighbouring point of a parameter sweep
+            z, loadings, _, _, _ = sfa.fit(self.data, 5, 0.1, 0.1, 0.5,
+                                           max_iter=200)
+            self.init = (z, loadings)
+
+    def time_fit(self, n_cases, n_genes, start):
+        sfa.fit(self.data, 5, 0.05, 0.1, 0.5, init=self.init, max_iter=200)
@@ -0,0 +1,34 @@
+import importlib.util
+import os
+
+from . import startup
+
+
+def _src_dir():
+    """Directory of the installed sources, which asv builds per commit."""
+    return os.path.dirname(importlib.util.find_spec('plot').origin)
+
+
+class ImportModule:
+    params = sorted(startup.module_budgets)
+    param_names = ['module']
+
+    def timeraw_import(self, module):
+        return f"import {module}"
+
+
+class ScriptHelp:
+    params = sorted(startup.script_budgets)
+    param_names = ['script']
+
+    def timeraw_help(self, script):
+        path = os.path.join(_src_dir(), script)
+        return f"""
+import runpy
+import sys
+sys.argv = [{path!r}, '--help']
+try:
+    runpy.run_path({path!r}, run_name='__main__')
+except SystemExit:
+    pass
+"""
@@ -0,0 +1,169 @@
+"""Synthetic data at the scale of the production data sets.
+
+Every generator is deterministic given its size arguments, so timings are
+comparable between commits.
+"""
+import gzip
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from lib import ensembl_reference
+
+n_genes = [1000, 10000, 100000]
+n_cases = [100, 1000, 10000]
+n_features = [21, 200]
+
+
+def skip_if_larger(size, limit):
+    """Skip a parameter combination asv cannot run in reasonable time."""
+    if size > limit:
+        raise NotImplementedError(f"{size} exceeds benchmark limit {limit}")
+
+
+def rng(*sizes):
+    return np.random.RandomState(sum(sizes) % 2**32)
+
+
+def ensembl_ids(n):
+    return np.array([f"ENSG{i:011d}" for i in range(n)], dtype=object)
+
+
+def read_counts(n_cases, n_genes):
+    """Raw gene expression data set with dims (sample, gene)."""
+    r = rng(n_cases, n_genes)
+    mean = r.lognormal(3.0, 2.0, size=n_genes)
+    counts = r.poisson(mean, size=(n_cases, n_genes)).astype('int32')
+    return xr.Dataset(
+        {'read_count': (('sample', 'gene'), counts)},
+        coords={
+            'sample': np.array([f"S{i}" for i in range(n_cases)],
+                               dtype=object),
+            'gene': np.array([f"{g}.{i % 9 + 1}" for i, g
+                              in enumerate(ensembl_ids(n_genes))],
+                             dtype=object),
+        },
+    )
+
+
+def log2_cpm(n_cases, n_genes):
+    r = rng(n_cases, n_genes)
+    return xr.DataArray(
+        r.normal(size=(n_cases, n_genes)),
+        dims=('case', 'gene'),
+        coords={'case': np.arange(n_cases), 'gene': ensembl_ids(n_genes)},
+    )
+
+
+def feature_names(n_features):
+    prefixes = ['vol', 'var', 'mean']
+    return np.array([f"{prefixes[i % 3]}_{i}" for i in range(n_features)],
+                    dtype=object)
+
+
+def mri_features(n_cases, n_features, n_latent=5, nan_fraction=0.0):
+    """Positive MRI features driven by a few latent factors."""
+    r = rng(n_cases, n_features, n_latent)
+    latent = r.normal(size=(n_cases, n_latent))
+    loadings = r.normal(size=(n_latent, n_features))
+    values = np.exp(0.5 * (latent @ loadings) / np.sqrt(n_latent) +
+                    0.01 * r.normal(size=(n_cases, n_features)))
+    if nan_fraction > 0:
+        values[r.uniform(size=values.shape) < nan_fraction] = np.nan
+    return xr.DataArray(
+        values,
+        dims=('case', 'cad_feature'),
+        coords={'case': np.arange(n_cases),
+                'cad_feature': feature_names(n_features)},
+    )
+
+
+def write_ensembl_annotation(path, n_genes):
+    """BioMart export with duplicated rows and alternative haplotypes.
+
+    A tenth of the genes has a second row with another EntrezGene ID, a
+    tenth has a copy on an alternative haplotype with the same HGNC ID.
+    """
+    r = rng(n_genes)
+    idx = np.arange(n_genes)
+    dup = idx[r.uniform(size=n_genes) < 0.1]
+    alt = idx[r.uniform(size=n_genes) < 0.1]
+    genes = ensembl_ids(n_genes + len(alt))
+    rows = np.concatenate([idx, dup, idx[alt]])
+    annot = pd.DataFrame({
+        'Ensembl Gene ID': np.concatenate([genes[idx], genes[dup],
+                                           genes[n_genes:]]),
+        'EntrezGene ID': [str(i + 1) if i % 7 else '' for i in rows],
+        'HGNC symbol': [f"GENE{i}" if i % 5 else '' for i in rows],
+        'HGNC ID(s)': [f"HGNC:{i + 1}" if i % 5 else '' for i in rows],
+        'Chromosome Name': ['1'] * (n_genes + len(dup)) +
+                           ['CHR_HSCHR1_1_CTG3'] * len(alt),
+    })
+    annot.loc[n_genes:n_genes + len(dup) - 1, 'EntrezGene ID'] = [
+        str(i + 1 + n_genes) for i in dup]
+    annot.to_csv(path, sep='\t', index=False)
+
+
+def write_ensembl_reference(path, n_genes):
+    """Ensembl annotation as TSV or, for a .nc path, as NetCDF reference."""
+    if not path.endswith('.nc'):
+        write_ensembl_annotation(path, n_genes)
+        return
+    tsv_path = path[:-len('.nc')] + '.tsv'
+    write_ensembl_annotation(tsv_path, n_genes)
+    ensembl_reference.write_reference(
+        ensembl_reference.read_reference(tsv_path), path)
+
+
+def write_gbff(path, n_loci):
+    """Gzipped RefSeq GenBank flat file with one gene feature per locus."""
+    with gzip.open(path, 'wt') as f:
+        for i in range(n_loci):
+            f.write(
+                f"LOCUS       NM_{i:06d}               2000 bp    mRNA    "
+                "linear   PRI 01-JAN-2017\n"
+                "DEFINITION  Homo sapiens synthetic gene, mRNA.\n"
+                f"ACCESSION   NM_{i:06d}\n"
+                "FEATURES             Location/Qualifiers\n"
+                "     source          1..2000\n"
+                "                     /organism=\"Homo sapiens\"\n"
+                "     gene            1..2000\n"
+                f"                     /gene=\"GENE{i}\"\n"
+                f"                     /db_xref=\"GeneID:{i + 1}\"\n"
+                f"                     /db_xref=\"HGNC:HGNC:{i + 1}\"\n"
+                "     CDS             100..1900\n"
+                f"                     /gene=\"GENE{i}\"\n"
+                "ORIGIN      \n"
+                "        1 acgtacgtac gtacgtacgt\n"
+                "//\n"
+            )
+
+
+def write_refseq_hgnc(path, n_loci):
+    pd.DataFrame({
+        'refseq_id': [f"NM_{i:06d}" for i in range(n_loci)],
+        'hgnc_id': [f"HGNC:{i + 1}" for i in range(n_loci)],
+    }).to_csv(path, sep='\t', index=False)
+
+
+def write_zwart2011(path, n_genes):
+    """Gene list in the layout of the Zwart et al. (2011) supplement."""
+    pd.DataFrame({
+        '#name': [f"NM_{i:06d}" for i in range(n_genes)],
+        'name2': [f"GENE{i}" for i in range(n_genes)],
+    }).to_excel(path, index=False)
+
+
+def write_image_stack(path, n_cases, size, n_latent=20):
+    """(case, y, x) stack of float32 images with a few latent components."""
+    r = rng(n_cases, size, n_latent)
+    stack = np.lib.format.open_memmap(path, mode='w+', dtype='float32',
+                                      shape=(n_cases, size, size))
+    basis = r.normal(size=(n_latent, size * size)).astype('float32')
+    for start in range(0, n_cases, 1000):
+        n = min(1000, n_cases - start)
+        images = (r.normal(size=(n, n_latent)).astype('float32') @ basis +
+                  r.normal(size=(n, size * size)).astype('float32'))
+        stack[start:start + n] = images.reshape(n, size, size)
+    stack.flush()
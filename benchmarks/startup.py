@@ -0,0 +1,63 @@
+"""Startup time budgets of the command line entry points.
+
+The workflow starts a new process for every figure, so the time to load a
+script adds up. Run this module as a script to check every entry point
+against its budget, `make check-startup` does so. The budgets include
+the start of the interpreter itself.
+"""
+import os
+import subprocess
+import sys
+import time
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src')
+
+# Seconds for `<script> --help`
+script_budgets = {
+    'visualization/figure-cad-factors-heatmap.py': 0.75,
+    'visualization/figure-fa-variance-explained.py': 0.75,
+    'visualization/figure-gsea-heatmap.py': 0.75,
+    'visualization/figure-mri-clin-boxplots.py': 0.75,
+    'visualization/figure-mri-cad-correlation.py': 0.75,
+    'visualization/figure-mri-factor-clin-boxplot.py': 0.75,
+    'visualization/figure-mri-feature-clin-boxplot.py': 0.75,
+}
+
+# Seconds for `import <module>`
+module_budgets = {
+    'plot': 0.5,
+    'util': 0.5,
+    'visualization.style': 0.5,
+}
+
+
+def startup_time(args, repeat=3):
+    """Fastest of a few runs of python with `args`, in seconds."""
+    env = dict(os.environ, PYTHONPATH=src_dir)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_budgets():
+    """Print the startup time of each entry point, False if over budget."""
+    within = True
+    checks = ([(s, [os.path.join(src_dir, s), '--help'], b)
+               for s, b in script_budgets.items()] +
+              [(m, ['-c', f"import {m}"], b)
+               for m, b in module_budgets.items()])
+    for name, args, budget in checks:
+        seconds = startup_time(args)
+        status = 'ok' if seconds <= budget else 'OVER BUDGET'
+        print(f"{name:<50} {seconds:5.2f}s / {budget:.2f}s {status}")
+        within &= seconds <= budget
+    return within
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_budgets() else 1)
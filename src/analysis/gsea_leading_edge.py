@@ -0,0 +1,125 @@
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+from lib import bitset
+from lib import click_utils
+from lib.gene_sets import load_gene_set_matrix
+
+
+def decode(values):
+    return np.array([v.decode() if isinstance(v, bytes) else str(v)
+                     for v in values], dtype=object)
+
+
+def leading_edge_bits(membership, scores, max_es_at, es_sign, absolute,
+                      n_bits, cols):
+    """Leading edge membership of every gene set as packed bitsets.
+
+    `membership` has the gene sets as rows and the scored genes as
+    columns, `cols` maps the scored genes to bit positions. Genes are
+    ranked by decreasing score, or decreasing absolute score if
+    `absolute`. The leading edge of a set with a positive enrichment are
+    its members ranked at or before `max_es_at`, of a set with a negative
+    enrichment its members ranked at or after it.
+    """
+    if absolute:
+        order = np.argsort(-np.abs(scores), kind='mergesort')
+    else:
+        order = np.argsort(-scores, kind='mergesort')
+    rank = np.empty(len(scores), dtype='int64')
+    rank[order] = np.arange(1, len(scores) + 1)
+
+    set_len = np.diff(membership.indptr)
+    rows = np.repeat(np.arange(membership.shape[0]), set_len)
+    member_rank = rank[membership.indices]
+    threshold = np.repeat(max_es_at, set_len)
+    positive = np.repeat(absolute | (es_sign >= 0), set_len)
+    in_le = np.where(positive, member_rank <= threshold,
+                     member_rank >= threshold)
+
+    return bitset.from_indices(rows[in_le], cols[membership.indices[in_le]],
+                               membership.shape[0], n_bits)
+
+
+@click.command()
+@click.argument('gsea', type=click_utils.in_path)
+@click.argument('de', type=click_utils.in_path)
+@click.argument('gene_sets', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+def gsea_leading_edge(gsea, de, gene_sets, out):
+    """Record leading edge genes of GSEA results as packed bitsets."""
+    gsea_ds = xr.open_dataset(gsea).load()
+    gsea_ds['gene_set'] = decode(gsea_ds['gene_set'].values)
+    gsea_ds['mri_feature'] = decode(gsea_ds['mri_feature'].values)
+    de_ds = xr.open_dataset(de).load()
+    de_ds['gene'] = decode(de_ds['gene'].values)
+    de_ds['mri_feature'] = decode(de_ds['mri_feature'].values)
+    absolute = bool(gsea_ds.attrs['absolute'])
+
+    gsm = load_gene_set_matrix(gene_sets)
+    gene_sets_idx = {gs: i for i, gs in enumerate(gsm.gene_sets)}
+    gsm_rows = np.array([gene_sets_idx.get(gs, -1)
+                         for gs in gsea_ds['gene_set'].values])
+    missing = gsm_rows < 0
+    if np.any(missing):
+        click.echo(f"{np.sum(missing)} gene sets not in {gene_sets}, their "
+                   "leading edges are left empty", err=True)
+
+    # Restrict the gene set matrix to the genes scored in the DE analysis.
+    gene_col = {g: i for i, g in enumerate(gsm.genes)}
+    scored_cols = np.array([gene_col[g] for g in de_ds['gene'].values])
+    membership = gsm.membership[np.where(missing, 0, gsm_rows), :]
+    membership = membership[:, scored_cols].multiply(
+        ~missing[:, np.newaxis])
+    membership = scipy.sparse.csr_matrix(membership, dtype='bool')
+    membership.eliminate_zeros()
+    membership.sort_indices()
+
+    n_genes = len(gsm.genes)
+    features = gsea_ds['mri_feature'].values
+    bits = np.zeros((len(features), membership.shape[0],
+                     bitset.n_words(n_genes)), dtype='uint64')
+    for i, feature in enumerate(features):
+        feature_gsea = gsea_ds.sel(mri_feature=feature)
+        bits[i] = leading_edge_bits(
+            membership,
+            de_ds['t'].sel(mri_feature=feature).values,
+            feature_gsea['max_es_at'].values,
+            np.sign(feature_gsea['nes'].values),
+            absolute,
+            n_genes,
+            scored_cols,
+        )
+
+    le_ds = xr.Dataset(
+        {
+            'leading_edge': (('mri_feature', 'gene_set', 'gene_word'), bits),
+            'le_size': (('mri_feature', 'gene_set'),
+                        bitset.cardinality(bits).astype('int32')),
+        },
+        coords={
+            'mri_feature': features,
+            'gene_set': gsea_ds['gene_set'].values,
+            'gene': gsm.genes,
+        },
+    )
+    le_ds['leading_edge'].attrs['long_name'] = (
+        "leading edge genes packed as bitsets, gene i is bit i % 64 of word "
+        "i // 64")
+    le_ds['le_size'].attrs['long_name'] = "number of genes in leading edge"
+    le_ds.attrs['absolute'] = int(absolute)
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    le_ds.attrs['history'] = (
+        f"{time_str} gsea_leading_edge.py Leading edges of {gsea}\n")
+
+    le_ds.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    gsea_leading_edge()
@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import xarray as xr
+
+from analysis.gsea_leading_edge import decode
+from lib import bitset
+from lib import click_utils
+
+
+def feature_overlaps(bits, fdr, max_fdr):
+    """Pairwise leading edge overlap of the significant gene sets."""
+    sig = np.where(fdr <= max_fdr)[0]
+    sig_bits = bits[sig]
+    inter = bitset.intersection_counts(sig_bits)
+    size = bitset.cardinality(sig_bits)
+    union = size[:, np.newaxis] + size[np.newaxis, :] - inter
+    a, b = np.where(np.triu(inter > 0, k=1))
+    return sig[a], sig[b], inter[a, b], union[a, b]
+
+
+def gene_counts(bits, n_genes, block_size=256):
+    counts = np.zeros(n_genes, dtype='int32')
+    for start in range(0, bits.shape[0], block_size):
+        block = bitset.to_bool(bits[start:start+block_size], n_genes)
+        counts += block.sum(0, dtype='int32')
+    return counts
+
+
+@click.command()
+@click.argument('gsea', type=click_utils.in_path)
+@click.argument('leading_edges', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--fdr', 'max_fdr', default=0.25,
+              help="Maximum FDR of significant gene sets.")
+def leading_edge_overlap(gsea, leading_edges, out, max_fdr):
+    """Jaccard overlap of leading edges of significant gene sets."""
+    gsea_ds = xr.open_dataset(gsea).load()
+    gsea_ds['gene_set'] = decode(gsea_ds['gene_set'].values)
+    gsea_ds['mri_feature'] = decode(gsea_ds['mri_feature'].values)
+    le_ds = xr.open_dataset(leading_edges).load()
+    gsea_ds = gsea_ds.sel(mri_feature=le_ds['mri_feature'],
+                          gene_set=le_ds['gene_set'])
+    n_genes = le_ds['gene'].size
+
+    pairs = {'mri_feature': [], 'gene_set_a': [], 'gene_set_b': [],
+             'intersection': [], 'union': []}
+    core_counts = np.zeros((le_ds['mri_feature'].size, n_genes),
+                           dtype='int32')
+    for i, feature in enumerate(le_ds['mri_feature'].values):
+        bits = le_ds['leading_edge'].values[i]
+        fdr = gsea_ds['fdr'].sel(mri_feature=feature).values
+        a, b, inter, union = feature_overlaps(bits, fdr, max_fdr)
+        pairs['mri_feature'].append(np.full(len(a), feature, dtype=object))
+        pairs['gene_set_a'].append(le_ds['gene_set'].values[a])
+        pairs['gene_set_b'].append(le_ds['gene_set'].values[b])
+        pairs['intersection'].append(inter)
+        pairs['union'].append(union)
+        core_counts[i] = gene_counts(bits[fdr <= max_fdr], n_genes)
+    pairs = {k: np.concatenate(v) for k, v in pairs.items()}
+
+    overlap = xr.Dataset(
+        {
+            'intersection': ('pair', pairs['intersection'].astype('int32')),
+            'union': ('pair', pairs['union'].astype('int32')),
+            'jaccard': ('pair', pairs['intersection'] / pairs['union']),
+            'mri_feature_pair': ('pair', pairs['mri_feature']),
+            'gene_set_a': ('pair', pairs['gene_set_a'].astype(object)),
+            'gene_set_b': ('pair', pairs['gene_set_b'].astype(object)),
+            'le_count': (('mri_feature', 'gene'), core_counts),
+        },
+        coords={
+            'mri_feature': le_ds['mri_feature'].values,
+            'gene': le_ds['gene'].values,
+        },
+    )
+    overlap['jaccard'].attrs['long_name'] = (
+        "Jaccard index of leading edges of significant gene sets")
+    overlap['le_count'].attrs['long_name'] = (
+        "number of significant gene sets with gene in leading edge")
+    overlap.attrs['max_fdr'] = max_fdr
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    overlap.attrs['history'] = (
+        f"{time_str} leading_edge_overlap.py Overlap of leading edges in "
+        f"{leading_edges}\n")
+
+    overlap.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    leading_edge_overlap()
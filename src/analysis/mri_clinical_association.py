@@ -0,0 +1,200 @@
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import yaml
+
+from lib import click_utils
+from lib.lazy import lazy_import
+from util import bh_adjust, _pearson_block, _rank, _spearman_block
+
+stats = lazy_import('scipy.stats')
+xr = lazy_import('xarray')
+
+# Codes of unknown values in the clinical export
+default_missing_codes = (777, 999)
+
+
+def read_mri(mri_features, cad_factors, factor_annotation):
+    """MRI features and annotated factors as one (case, mri_feature) array.
+
+    Factors are named `factor_<id>` after their annotation and multiplied
+    by its sign, so that a positive correlation follows the name.
+    """
+    features_ds = xr.open_dataset(mri_features).load()
+    features = features_ds[[v for v in features_ds.data_vars
+                            if v not in ('Comment', 'MultiFocal')]]
+    features = features.to_array('mri_feature').transpose('case',
+                                                          'mri_feature')
+    features = features.assign_coords(
+        source=('mri_feature', np.full(features.shape[1], 'feature')),
+        name=('mri_feature', features['mri_feature'].values),
+    )
+
+    factors = xr.open_dataset(cad_factors)['factors'].load()
+    with open(factor_annotation) as f:
+        annotation = yaml.safe_load(f)
+    numbers = [i for i in factors['factor'].values if int(i) in annotation]
+    factors = factors.sel(factor=numbers).transpose('case', 'factor')
+    ids = [annotation[int(i)]['id'] for i in numbers]
+    signs = np.array([annotation[int(i)]['sign'] for i in numbers])
+    factors = xr.DataArray(
+        factors.values * signs, dims=['case', 'mri_feature'],
+        coords={
+            'case': factors['case'],
+            'mri_feature': [f"factor_{i}" for i in ids],
+            'source': ('mri_feature', np.full(len(ids), 'factor')),
+            'name': ('mri_feature', ids),
+        },
+    )
+
+    features, factors = xr.align(features, factors, join='outer',
+                                 exclude=['mri_feature'])
+    return xr.concat([features, factors], 'mri_feature')
+
+
+def read_clinical(clinical_annotation, cases):
+    """Clinical variables of the cases, empty text where unknown."""
+    clinical = xr.open_dataset(clinical_annotation).load()
+    clinical = clinical.reindex(case=cases)
+    for name in clinical.data_vars:
+        if clinical[name].dtype == object:
+            clinical[name] = clinical[name].fillna('')
+    return clinical
+
+
+def clinical_codes(values, missing_codes):
+    """Group code of every case, -1 where unknown, and the group labels."""
+    values = np.asarray(values)
+    if values.dtype.kind in 'OUS':
+        values = values.astype(str)
+        known = ~np.isin(values, ['', 'nan'])
+    else:
+        values = values.astype(float)
+        known = np.isfinite(values) & ~np.isin(values, missing_codes)
+    labels, codes = np.unique(values[known], return_inverse=True)
+    all_codes = np.full(len(values), -1)
+    all_codes[known] = codes
+    return all_codes, labels
+
+
+def kruskal_block(x, codes):
+    """Kruskal-Wallis H and p-values of all columns of x between groups.
+
+    Cases of an unknown group (code -1) and missing values of x are left
+    out per column. The ranks of each column are computed once, and the
+    statistic follows from the rank sums of the groups, corrected for
+    ties like `scipy.stats.kruskal`.
+    """
+    obs = codes >= 0
+    x = x[obs]
+    codes = codes[obs]
+    ok = np.isfinite(x)
+    # Missing values rank after all others, so the ranks of the known
+    # values are those among the known values only
+    ranks, ties = _rank(np.where(ok, x, np.inf), tie_sizes=True)
+    ranks = np.where(ok, ranks, 0.0)
+    groups = np.zeros((len(codes), codes.max() + 1 if len(codes) else 0))
+    groups[np.arange(len(codes)), codes] = 1.0
+
+    n_group = groups.T @ ok.astype(float)
+    rank_sums = groups.T @ ranks
+    n = ok.sum(0).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = (12 / (n * (n + 1)) *
+             np.where(n_group > 0, rank_sums**2 / n_group, 0.0).sum(0) -
+             3 * (n + 1))
+        tie_sum = np.where(ok, ties**2 - 1.0, 0.0).sum(0)
+        h /= 1 - tie_sum / (n**3 - n)
+    df = (n_group > 0).sum(0) - 1
+    p = stats.chi2.sf(h, df)
+    invalid = (df < 1) | ~np.isfinite(h)
+    h[invalid] = np.nan
+    p[invalid] = np.nan
+    return h, p, n
+
+
+def association(mri, clinical, categorical, missing_codes):
+    """Association of every MRI feature with every clinical variable.
+
+    Kruskal-Wallis for categorical variables, point-biserial correlation
+    for variables with two values and Spearman correlation otherwise. The
+    FDR is computed over all tests of the matrix.
+    """
+    x = mri.values
+    shape = (x.shape[1], len(clinical))
+    statistic = np.full(shape, np.nan)
+    p = np.full(shape, np.nan)
+    n = np.zeros(shape, dtype='int32')
+    tests = []
+    for j, name in enumerate(clinical):
+        codes, labels = clinical_codes(clinical[name].values, missing_codes)
+        if name in categorical or clinical[name].dtype.kind in 'OUS':
+            test = 'kruskal'
+            statistic[:, j], p[:, j], n_j = kruskal_block(x, codes)
+        else:
+            # Spearman and point-biserial correlations of the known values
+            y = np.where(codes >= 0, labels[codes].astype(float), np.nan)
+            if len(labels) == 2:
+                test = 'point_biserial'
+                r, p_j = _pearson_block(x, y[:, np.newaxis], 'omit')
+            else:
+                test = 'spearman'
+                r, p_j = _spearman_block(x, y[:, np.newaxis], 'omit')
+            statistic[:, j], p[:, j] = r[:, 0], p_j[:, 0]
+            n_j = (np.isfinite(x) & np.isfinite(y)[:, np.newaxis]).sum(0)
+        n[:, j] = n_j
+        tests.append(test)
+
+    tested = np.isfinite(p)
+    fdr = np.full(shape, np.nan)
+    fdr[tested] = bh_adjust(p[tested])
+    dims = ['mri_feature', 'clinical']
+    return xr.Dataset(
+        {
+            'statistic': (dims, statistic),
+            'nominal_p': (dims, p),
+            'fdr': (dims, fdr),
+            'n': (dims, n),
+            'test': ('clinical', np.array(tests, dtype=object)),
+        },
+        coords={
+            'mri_feature': mri['mri_feature'].values,
+            'source': ('mri_feature', mri['source'].values.astype(object)),
+            'name': ('mri_feature', mri['name'].values.astype(object)),
+            'clinical': np.array(list(clinical), dtype=object),
+        },
+    )
+
+
+@click.command()
+@click.argument('mri_features', type=click_utils.in_path)
+@click.argument('cad_factors', type=click_utils.in_path)
+@click.argument('factor_annotation', type=click_utils.in_path)
+@click.argument('clinical_annotation', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--categorical', multiple=True, default=['grade'],
+              help="Numeric clinical variable to test as categorical, "
+                   "text variables always are.")
+@click.option('--missing-code', 'missing_codes', multiple=True, type=int,
+              default=default_missing_codes,
+              help="Code of unknown clinical values.")
+def mri_clinical_association(mri_features, cad_factors, factor_annotation,
+                             clinical_annotation, out, categorical,
+                             missing_codes):
+    """Test all MRI features and factors against all clinical variables."""
+    mri = read_mri(mri_features, cad_factors, factor_annotation)
+    clinical = read_clinical(clinical_annotation, mri['case'])
+
+    assoc = association(mri, clinical, set(categorical), missing_codes)
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    assoc.attrs['history'] = (f"{time_str} mri_clinical_association.py "
+                              f"{mri_features} {cad_factors} "
+                              f"{clinical_annotation}\n")
+    assoc.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    mri_clinical_association()
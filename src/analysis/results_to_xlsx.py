@@ -0,0 +1,178 @@
+"""Write GSEA or differential expression results to an Excel workbook.
+
+Every MRI feature gets a sheet with its name in the first row and a table
+of its results below it. Sheet titles are the feature names, shortened to
+the 31 characters Excel allows and made unique. Gene sets are
+filtered by FDR and leading edge proportion and sorted by the latter,
+genes are sorted by their absolute t-statistic. The results are read
+lazily, one feature at a time, and the workbook is written in write-only
+mode, which streams the rows to disk. Memory is that of the results of
+one feature.
+"""
+import warnings
+
+import click
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+import xarray as xr
+
+from lib import click_utils
+
+msigdb_prefix = ('http://software.broadinstitute.org/gsea/msigdb/'
+                 'geneset_page.jsp?geneSetName=')
+
+# Statistics of the gene set analysis that are left out of the workbook
+gsea_omitted = ('es', 'fwer')
+number_columns = ('es', 'p', 'nes', 'fdr', 'le_prop', 'fwer', 'coefficient',
+                  't')
+headers = {'gene_set': 'GeneSet'}
+max_column_width = 80
+max_title_length = 31
+invalid_title_characters = '[]:*?/\\'
+
+
+def decode(values):
+    return np.array([v.decode() if isinstance(v, bytes) else str(v)
+                     for v in values], dtype=object)
+
+
+def gsea_rows(ds, feature, max_fdr, min_le_prop):
+    """Columns of the gene sets of a feature passing the filters."""
+    stats = [v for v, da in ds.data_vars.items()
+             if 'gene_set' in da.dims and 'mri_feature' in da.dims and
+             v not in gsea_omitted]
+    feature_ds = ds.isel(mri_feature=feature)
+    fdr = feature_ds['fdr'].values
+    le_prop = feature_ds['le_prop'].values
+    keep = np.flatnonzero((fdr <= max_fdr) & (le_prop >= min_le_prop))
+    keep = keep[np.argsort(-le_prop[keep], kind='mergesort')]
+    columns = {'gene_set': decode(ds['gene_set'][keep].values)}
+    for v in stats:
+        columns[v] = feature_ds[v].values[keep]
+    columns['link'] = np.array(
+        [f'=HYPERLINK("{msigdb_prefix}{gs}", "link")'
+         for gs in columns['gene_set']], dtype=object)
+    return columns
+
+
+def de_rows(ds, feature):
+    """Columns of all genes of a feature, by decreasing absolute t."""
+    feature_ds = ds.isel(mri_feature=feature)
+    t = feature_ds['t'].values
+    order = np.argsort(-np.abs(t), kind='mergesort')
+    columns = {'gene': decode(ds['gene'].values[order])}
+    if 'hgnc_symbol' in ds:
+        columns['hgnc_symbol'] = decode(ds['hgnc_symbol'].values[order])
+    columns['coefficient'] = feature_ds['coefficient'].values[order]
+    columns['t'] = t[order]
+    return columns
+
+
+def sheet_titles(names):
+    """Valid and unique sheet titles of the names, ignoring case."""
+    titles = []
+    used = set()
+    for name in names:
+        title = ''.join('_' if c in invalid_title_characters else c
+                        for c in name)
+        candidate = title[:max_title_length]
+        n = 1
+        while candidate.lower() in used:
+            n += 1
+            suffix = f"~{n}"
+            candidate = title[:max_title_length - len(suffix)] + suffix
+        used.add(candidate.lower())
+        titles.append(candidate)
+    return titles
+
+
+def column_width(name, values):
+    if values.dtype.kind in 'fiu':
+        lengths = [10]
+    elif name == 'link':
+        lengths = [len('link')]
+    else:
+        lengths = [len(v) for v in values]
+    return min(max([len(headers.get(name, name))] + lengths) + 2,
+               max_column_width)
+
+
+def write_sheet(workbook, title, feature, columns, table_id):
+    """Write the feature name and the columns as a table of a write-only
+    sheet."""
+    sheet = workbook.create_sheet(title)
+    names = list(columns)
+    for i, name in enumerate(names, 1):
+        sheet.column_dimensions[get_column_letter(i)].width = column_width(
+            name, columns[name])
+    sheet.append([feature])
+    sheet.append([headers.get(name, name) for name in names])
+
+    n_rows = len(columns[names[0]])
+    number_format = [name in number_columns for name in names]
+    for row in zip(*columns.values()):
+        cells = []
+        for value, is_number in zip(row, number_format):
+            if isinstance(value, np.generic):
+                value = value.item()
+            # Excel has no NaN, leave the cell empty
+            if isinstance(value, float) and np.isnan(value):
+                value = None
+            cell = WriteOnlyCell(sheet, value)
+            if is_number:
+                cell.number_format = '0.00'
+            cells.append(cell)
+        sheet.append(cells)
+
+    # Excel tables need at least one row
+    if n_rows > 0:
+        ref = f"A2:{get_column_letter(len(names))}{n_rows + 2}"
+        # Write-only sheets cannot read the headings back, so the columns
+        # are given
+        table = Table(
+            displayName=f"Table{table_id}", ref=ref,
+            autoFilter=AutoFilter(ref=ref),
+            tableColumns=[TableColumn(id=i, name=headers.get(name, name))
+                          for i, name in enumerate(names, 1)])
+        table.tableStyleInfo = TableStyleInfo(name='TableStyleLight9',
+                                              showRowStripes=True)
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', "In write-only mode",
+                                    UserWarning)
+            sheet.add_table(table)
+
+
+@click.command()
+@click.argument('results', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--fdr', 'max_fdr', default=0.25,
+              help="Maximum FDR of the gene sets.")
+@click.option('--le-prop', 'min_le_prop', default=0.0,
+              help="Minimum leading edge proportion of the gene sets.")
+def results_to_xlsx(results, out, max_fdr, min_le_prop):
+    """Write GSEA or DE results with a sheet per MRI feature."""
+    workbook = Workbook(write_only=True)
+    with xr.open_dataset(results) as ds:
+        if 'nes' in ds:
+            def rows(i):
+                return gsea_rows(ds, i, max_fdr, min_le_prop)
+        elif 't' in ds:
+            def rows(i):
+                return de_rows(ds, i)
+        else:
+            raise click.ClickException(
+                f"{results} has neither GSEA nor DE results")
+
+        features = decode(ds['mri_feature'].values)
+        titles = sheet_titles(features)
+        for i, (title, feature) in enumerate(zip(titles, features)):
+            write_sheet(workbook, title, feature, rows(i), i + 1)
+    workbook.save(out)
+
+
+if __name__ == '__main__':
+    results_to_xlsx()
@@ -0,0 +1,113 @@
+import csv
+
+import click
+import numpy as np
+import xarray as xr
+
+from analysis.gsea_leading_edge import decode
+from lib import bitset
+from lib import click_utils
+from lib.gene_sets import load_gene_set_matrix
+
+sources = {
+    'KEGG': "KEGG",
+    'REACTOME': "Reactome",
+    'BIOCARTA': "BioCarta",
+    'PID': "PID",
+    'NABA': "Matrisome Project",
+    'SA': "SigmaAldrich",
+    'ST': "Signaling Gateway",
+    'HALLMARK': "Hallmark",
+}
+
+
+def describe_gene_set(name):
+    prefix, _, rest = name.partition('_')
+    if prefix in sources:
+        source = sources[prefix]
+    else:
+        source = prefix.title()
+    return source, rest.replace('_', ' ').capitalize()
+
+
+def rank_gene_sets(nes, fdr, max_fdr):
+    """Indices of significant gene sets, most significant first."""
+    sig = np.where(fdr <= max_fdr)[0]
+    order = np.lexsort((-np.abs(nes[sig]), fdr[sig]))
+    return sig[order]
+
+
+def select_representatives(bits, max_jaccard, n):
+    """Greedily pick bitsets that overlap little with earlier picks.
+
+    Returns the picks and the cluster of every bitset, the position among
+    the picks of the first pick it overlaps with by more than
+    `max_jaccard`, or -1 if it overlaps with none.
+    """
+    selected = []
+    for i in range(bits.shape[0]):
+        if selected:
+            similarity = bitset.jaccard(bits[i:i+1], bits[selected])
+            if np.any(similarity > max_jaccard):
+                continue
+        selected.append(i)
+        if len(selected) == n:
+            break
+
+    cluster = np.full(bits.shape[0], -1)
+    if selected:
+        overlaps = bitset.jaccard(bits, bits[selected]) > max_jaccard
+        cluster = np.where(overlaps.any(1), overlaps.argmax(1), -1)
+        cluster[selected] = np.arange(len(selected))
+    return selected, cluster
+
+
+@click.command()
+@click.argument('gsea', type=click_utils.in_path)
+@click.argument('gene_sets', type=click_utils.in_path)
+@click.argument('factor', type=int)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--fdr', 'max_fdr', default=0.25,
+              help="Maximum FDR of selected gene sets.")
+@click.option('--max-jaccard', default=0.5,
+              help="Maximum overlap between selected gene sets.")
+@click.option('-n', '--n-gene-sets', default=6,
+              help="Maximum number of selected gene sets.")
+@click.option('--clusters', type=click_utils.out_path,
+              help="Write the selected gene set that represents each "
+                   "significant gene set to this file.")
+def select_gene_sets(gsea, gene_sets, factor, out, max_fdr, max_jaccard,
+                     n_gene_sets, clusters):
+    """Select representative significant gene sets of a factor."""
+    gsea_ds = xr.open_dataset(gsea).load()
+    gsea_ds['gene_set'] = decode(gsea_ds['gene_set'].values)
+    factor_gsea = gsea_ds.isel(mri_feature=factor-1)
+
+    gsm = load_gene_set_matrix(gene_sets)
+    gsm_rows = {gs: i for i, gs in enumerate(gsm.gene_sets)}
+    ranked = [i for i in rank_gene_sets(factor_gsea['nes'].values,
+                                        factor_gsea['fdr'].values,
+                                        max_fdr)
+              if factor_gsea['gene_set'].values[i] in gsm_rows]
+    names = factor_gsea['gene_set'].values[ranked]
+
+    bits = bitset.from_csr(gsm.membership[[gsm_rows[gs] for gs in names]])
+    selected, cluster = select_representatives(bits, max_jaccard,
+                                               n_gene_sets)
+
+    with open(out, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['source', 'pathway', 'gene_set'])
+        for name in names[selected]:
+            writer.writerow(describe_gene_set(name) + (name,))
+
+    if clusters:
+        with open(clusters, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(['gene_set', 'representative'])
+            for name, c in zip(names, cluster):
+                writer.writerow([name, names[selected[c]] if c >= 0 else ''])
+
+
+if __name__ == '__main__':
+    select_gene_sets()
@@ -0,0 +1,20 @@
+import click
+import xarray as xr
+
+from lib import click_utils
+from lib.expression_store import write_store
+
+
+@click.command()
+@click.argument('gexp', type=click_utils.in_path)
+@click.argument('out', type=click.Path(file_okay=False, resolve_path=True))
+@click.option('--block-size', default=1024,
+              help="Number of cases or genes copied at a time.")
+def build_expression_store(gexp, out, block_size):
+    """Write gene expression as memory-mapped matrices with gene indexes."""
+    with xr.open_dataset(gexp) as data_set:
+        write_store(data_set, out, block_size=block_size)
+
+
+if __name__ == '__main__':
+    build_expression_store()
@@ -0,0 +1,48 @@
+import click
+import numpy as np
+import xarray as xr
+
+from lib import click_utils
+from lib.expression_store import entrez_gene_ids, hgnc_symbols
+from lib.gene_sets import gene_set_matrix, save_gene_set_matrix
+
+
+def read_gene_keys(ds, gene_ids):
+    """Identifiers of the genes as in the GMT files, '' if missing."""
+    if gene_ids == 'entrez':
+        ids = entrez_gene_ids(ds)
+        return np.where(ids == -1, '', ids.astype(str)).astype(object)
+    return hgnc_symbols(ds)
+
+
+@click.command()
+@click.argument('msigdb_zip', type=click_utils.in_path)
+@click.argument('gexp', type=click_utils.in_path)
+@click.argument('collection', type=str)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--gene-ids', type=click.Choice(['entrez', 'symbols']),
+              default='entrez')
+@click.option('--min-size', default=15, help="Minimum gene set size.")
+@click.option('--max-size', default=500, help="Maximum gene set size.")
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              default=None)
+def build_gene_sets(msigdb_zip, gexp, collection, out, gene_ids, min_size,
+                    max_size, cache_dir):
+    """Gene set membership matrix aligned to the gene expression genes."""
+    with xr.open_dataset(gexp) as ds:
+        genes = ds['gene'].values
+        gene_keys = read_gene_keys(ds, gene_ids)
+
+    gsm = gene_set_matrix(msigdb_zip, collection, gene_keys, genes,
+                          cache_dir=cache_dir, gene_ids=gene_ids,
+                          min_size=min_size, max_size=max_size)
+    if gsm.membership.nnz == 0:
+        raise click.ClickException(
+            f"No members of {collection} match the {gene_ids} IDs of the "
+            f"genes in {gexp}")
+    save_gene_set_matrix(gsm, out, collection=collection, gene_ids=gene_ids,
+                         min_size=min_size, max_size=max_size)
+
+
+if __name__ == '__main__':
+    build_gene_sets()
@@ -0,0 +1,214 @@
+"""Fetch raw data files from the project share.
+
+Files are transferred concurrently into `<dest>.part`, so an interrupted
+transfer resumes where it stopped and never leaves a partial file under the
+final name. A file is moved into place once its SHA-256 matches the
+manifest, destinations that already match are skipped.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import hashlib
+from pathlib import Path
+import shlex
+import shutil
+import subprocess
+
+import click
+
+
+class FetchError(Exception):
+    pass
+
+
+def sha256(path, chunk_size=2**20):
+    h = hashlib.sha256()
+    with Path(path).open('rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(path):
+    """Checksums by remote file from a file in `sha256sum` format."""
+    manifest = dict()
+    path = Path(path)
+    if not path.exists():
+        return manifest
+    with path.open() as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            checksum, name = line.rstrip('\n').split(maxsplit=1)
+            manifest[name.lstrip('*')] = checksum
+    return manifest
+
+
+def write_manifest(path, manifest):
+    path = Path(path)
+    header = ''
+    if path.exists():
+        with path.open() as f:
+            header = ''.join(line for line in f if line.startswith('#'))
+    with path.open('w') as f:
+        f.write(header)
+        for name, checksum in sorted(manifest.items()):
+            f.write(f"{checksum}  {name}\n")
+
+
+def update_manifest(path, checksums):
+    """Add checksums to the manifest, which other fetches may update too."""
+    path = Path(path)
+    with path.open('a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(path)
+        for name, checksum in checksums.items():
+            manifest.setdefault(name, checksum)
+        write_manifest(path, manifest)
+
+
+def _part_size(part):
+    return part.stat().st_size if part.exists() else 0
+
+
+class LocalBackend:
+    """Files under a local directory, such as a mirror on NFS."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def fetch(self, remote, part):
+        offset = _part_size(part)
+        with (self.root / remote).open('rb') as src, part.open('ab') as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, 2**20)
+
+
+class ScpBackend:
+    """Files on an SSH host, with root as `[user@]host:directory/`."""
+
+    def __init__(self, root):
+        self.host, sep, self.directory = root.partition(':')
+        if not sep:
+            raise FetchError(f"scp root {root!r} is not [user@]host:path/")
+
+    def fetch(self, remote, part):
+        offset = _part_size(part)
+        path = self.directory + remote
+        if offset == 0:
+            command = ['scp', '-q', '-o', 'BatchMode=yes',
+                       f"{self.host}:{path}", str(part)]
+            subprocess.run(command, check=True)
+            return
+        # scp cannot resume, read the rest of the file over ssh instead
+        command = ['ssh', '-o', 'BatchMode=yes', self.host,
+                   f"tail -c +{offset + 1} {shlex.quote(path)}"]
+        with part.open('ab') as f:
+            subprocess.run(command, stdout=f, check=True)
+
+
+backends = {
+    'local': LocalBackend,
+    'scp': ScpBackend,
+}
+
+
+def fetch_file(backend, remote, dest, checksum=None):
+    """Fetch a file unless it is there already, returns its checksum.
+
+    A partial file from an earlier attempt is resumed. If the result does
+    not match `checksum`, the file is fetched once more from the start.
+    """
+    dest = Path(dest)
+    part = dest.with_name(dest.name + '.part')
+    if checksum is not None and dest.exists() and sha256(dest) == checksum:
+        return checksum
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    for attempt in range(2):
+        backend.fetch(remote, part)
+        fetched = sha256(part)
+        if checksum is None or fetched == checksum:
+            part.replace(dest)
+            # Mark as new even if the transfer kept the remote time
+            dest.touch()
+            return fetched
+        part.unlink()
+    raise FetchError(f"{remote}: checksum {fetched} does not match "
+                     f"manifest {checksum}")
+
+
+def fetch_all(backend, files, manifest, jobs=4):
+    """Fetch (remote, dest) pairs concurrently.
+
+    Returns the checksums by remote file and the errors by remote file.
+    """
+    def fetch(remote, dest):
+        return fetch_file(backend, remote, dest, manifest.get(remote))
+
+    checksums = dict()
+    errors = dict()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {remote: pool.submit(fetch, remote, dest)
+                   for remote, dest in files}
+        for remote, future in futures.items():
+            try:
+                checksums[remote] = future.result()
+            except (OSError, subprocess.CalledProcessError,
+                    FetchError) as e:
+                errors[remote] = e
+    return checksums, errors
+
+
+def _parse_file(ctx, param, value):
+    files = []
+    for item in value:
+        remote, sep, dest = item.partition('=')
+        if not sep:
+            raise click.BadParameter(f"{item!r} is not REMOTE=DEST")
+        files.append((remote, dest))
+    return files
+
+
+@click.command()
+@click.argument('root')
+@click.argument('files', nargs=-1, required=True, callback=_parse_file,
+                metavar='REMOTE=DEST...')
+@click.option('--backend', type=click.Choice(list(backends)), default='scp')
+@click.option('--manifest', type=click.Path(dir_okay=False),
+              help="Checksums of the remote files in sha256sum format.")
+@click.option('--update-manifest', 'update', is_flag=True,
+              help="Add the checksums of files missing from the manifest.")
+@click.option('--require-checksums', is_flag=True,
+              help="Fail without fetching if a file is not in the manifest.")
+@click.option('-j', '--jobs', default=4, help="Concurrent transfers.")
+def fetch(root, files, backend, manifest, update, require_checksums,
+          jobs):
+    """Fetch remote files below ROOT and verify their checksums."""
+    known = read_manifest(manifest) if manifest else dict()
+    unknown = [remote for remote, _ in files if remote not in known]
+    if unknown and not update:
+        if require_checksums:
+            raise click.ClickException(
+                f"Not in manifest {manifest}: {', '.join(unknown)}. Add "
+                "their checksums, or record those of a trusted transfer "
+                "with --update-manifest")
+        click.echo("Not in manifest, not verified: " + ", ".join(unknown),
+                   err=True)
+
+    try:
+        source = backends[backend](root)
+    except FetchError as e:
+        raise click.BadParameter(str(e), param_hint='ROOT')
+    checksums, errors = fetch_all(source, files, known, jobs)
+    for remote, e in errors.items():
+        click.echo(f"Failed to fetch {remote}: {e}", err=True)
+
+    if manifest and update:
+        update_manifest(manifest, {r: c for r, c in checksums.items()
+                                   if r in unknown})
+    if errors:
+        raise click.ClickException(f"{len(errors)} of {len(files)} files "
+                                   "failed, rerun to resume")
+
+
+if __name__ == '__main__':
+    fetch()
@@ -0,0 +1,423 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+import io
+import zipfile
+
+import click
+import netCDF4
+import numpy as np
+import pandas as pd
+
+from lib import click_utils
+from lib.gene_sets import gmt_member_name
+from visualization.labels import feature_order
+
+Cohort = namedtuple('Cohort', [
+    'case', 'sample', 'factors', 'gene', 'entrez_gene_id', 'hgnc_symbol',
+    'gene_loadings',
+])
+
+# MRI features driven by each latent factor, after adjust_scale
+factor_features = [
+    ['volume', 'largest_diameter', 'vol_init_enhancement_GT100',
+     'ld_init_enhancement_GT100', 'vol_late_LT0', 'ld_late_LT0'],
+    ['mean_smoothness_uptake', 'variation_smoothness_uptake',
+     'mean_smoothness_all_timeframes', 'variation_smoothness_all_timeframes'],
+    ['mean_sharpness_uptake', 'mean_sharpness_all_timeframes'],
+    ['var_sharpness_uptake', 'var_sharpness_all_timeframes'],
+    ['uptake_speed', 'top_init_enhancement'],
+    ['top_late_enhancement', 'ser', 'washout'],
+    ['circularity', 'irregularity'],
+]
+n_factors = len(factor_features)
+
+# Genes whose expression follows each factor
+module_fraction = 0.02
+
+msigdb_collections = {
+    'c2.cgp': ['SMID', 'VANTVEER', 'WANG', 'CHARAFE', 'SOTIRIOU'],
+    'c2.cp': ['KEGG', 'REACTOME', 'BIOCARTA', 'PID', 'NABA', 'ST', 'SA'],
+    'h.all': ['HALLMARK'],
+}
+msigdb_n_gene_sets = {'c2.cgp': 3400, 'c2.cp': 1330, 'h.all': 50}
+msigdb_url = "http://www.broadinstitute.org/gsea/msigdb/cards/"
+
+sample_block_size = 64
+
+signature_cell_types = [
+    'B cells naive', 'B cells memory', 'Plasma cells', 'T cells CD8',
+    'T cells CD4 naive', 'T cells CD4 memory resting',
+    'T cells CD4 memory activated', 'T cells follicular helper',
+    'T cells regulatory (Tregs)', 'T cells gamma delta',
+    'NK cells resting', 'NK cells activated', 'Monocytes',
+    'Macrophages M0', 'Macrophages M1', 'Macrophages M2',
+    'Dendritic cells resting', 'Dendritic cells activated',
+    'Mast cells resting', 'Mast cells activated', 'Eosinophils',
+    'Neutrophils',
+]
+
+
+def rng(seed, *stream):
+    return np.random.RandomState([seed, *stream])
+
+
+def make_cohort(n_cases, n_genes, seed):
+    """Identifiers and latent structure shared by all synthetic files."""
+    r = rng(seed, 0)
+    case = np.sort(r.choice(np.arange(1, 10 * n_cases + 1000), n_cases,
+                            replace=False))
+    sample = np.array([f"IMG{i:06d}" for i in
+                       r.choice(10 * n_cases, n_cases, replace=False)],
+                      dtype=object)
+    factors = r.normal(size=(n_cases, n_factors))
+
+    gene_ids = np.sort(r.choice(n_genes * 5, n_genes, replace=False))
+    gene = np.array([f"ENSG{g:011d}.{v}" for g, v in
+                     zip(gene_ids, r.randint(1, 20, n_genes))], dtype=object)
+    entrez_gene_id = np.where(r.uniform(size=n_genes) < 0.4,
+                              r.permutation(n_genes) + 1, -1)
+    hgnc_symbol = np.array([f"SYN{g}" if e > 0 else '' for g, e in
+                            zip(gene_ids, entrez_gene_id)], dtype=object)
+
+    gene_loadings = np.zeros((n_factors, n_genes))
+    for f in range(n_factors):
+        module = r.uniform(size=n_genes) < module_fraction
+        gene_loadings[f, module] = r.choice([-0.7, 0.7], module.sum())
+
+    return Cohort(case, sample, factors, gene, entrez_gene_id, hgnc_symbol,
+                  gene_loadings)
+
+
+def _history(description):
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    return f"{time_str} generate_synthetic_cohort.py {description}\n"
+
+
+def write_gene_expression(cohort, out, seed):
+    """Negative binomial read counts with STAR summary counts."""
+    n_samples = len(cohort.sample)
+    n_genes = len(cohort.gene)
+    r = rng(seed, 1)
+    log_abundance = r.normal(0, 2.5, n_genes)
+    log_abundance[r.uniform(size=n_genes) < 0.3] -= 12  # not expressed
+    abundance = np.exp(log_abundance)
+    dispersion = 0.05 + r.gamma(2.0, 0.1, n_genes)
+    library_size = r.lognormal(np.log(3e7), 0.3, n_samples)
+
+    with netCDF4.Dataset(out, 'w') as ds:
+        ds.createDimension('sample', n_samples)
+        ds.createDimension('gene', n_genes)
+        sample = ds.createVariable('sample', str, ('sample',))
+        sample[:] = cohort.sample
+        gene = ds.createVariable('gene', str, ('gene',))
+        gene[:] = cohort.gene
+        read_count = ds.createVariable(
+            'read_count', 'i4', ('sample', 'gene'),
+            chunksizes=(min(sample_block_size, n_samples), n_genes))
+        read_count.long_name = "number of reads mapped to gene"
+        summaries = {
+            'N_unmapped': 0.05,
+            'N_multimapping': 0.08,
+            'N_noFeature': 0.1,
+            'N_ambiguous': 0.02,
+        }
+        for name, fraction in summaries.items():
+            v = ds.createVariable(name, 'i8', ('sample',))
+            v[:] = np.round(library_size * fraction *
+                            r.lognormal(0, 0.2, n_samples))
+
+        for start in range(0, n_samples, sample_block_size):
+            stop = min(start + sample_block_size, n_samples)
+            rb = rng(seed, 2, start)
+            log_effect = cohort.factors[start:stop] @ cohort.gene_loadings
+            mean = np.exp(log_effect) * abundance
+            mean *= (library_size[start:stop] / mean.sum(1))[:, np.newaxis]
+            expression = rb.gamma(1 / dispersion, mean * dispersion)
+            read_count[start:stop, :] = rb.poisson(expression)
+
+        ds.title = "Synthetic gene expression of the IMAGENE cohort"
+        ds.history = _history(f"Synthetic read counts, seed {seed}")
+
+
+def write_sample_tracking(cohort, out, seed):
+    pd.DataFrame({
+        'rna_sample': cohort.sample,
+        'margins_patient': cohort.case,
+    }).to_csv(out, sep='\t', index=False)
+
+
+def _positive(x, center, scale):
+    return np.maximum(center + scale * x, center * 1e-3)
+
+
+def write_mri_features(cohort, out, seed):
+    """Tumor features with the correlation structure of the factors."""
+    r = rng(seed, 3)
+    with_mri = r.uniform(size=len(cohort.case)) < 0.95
+    factors = cohort.factors[with_mri]
+    n_cases = factors.shape[0]
+
+    df = pd.DataFrame({'MARGINSstudyNr': cohort.case[with_mri]})
+    for f, features in enumerate(factor_features):
+        for feature in features:
+            loadings = 0.15 * r.normal(size=n_factors)
+            loadings[f] = 1.0
+            x = factors @ loadings + 0.1 * r.normal(size=n_cases)
+            x /= np.sqrt(loadings @ loadings + 0.01)
+            # Invert the transformations of fa_mri_features.adjust_scale
+            if feature[0:3] == 'vol':
+                df[feature] = _positive(x, 15.0, 3.0) ** 3
+            elif feature[0:3] == 'var':
+                df[feature] = _positive(x, 1.0, 0.15) ** 2
+            elif feature[0:2] == 'ld' or feature == 'largest_diameter':
+                df[feature] = _positive(x, 25.0, 6.0)
+            else:
+                df[feature] = _positive(x, 1.0, 0.15)
+    df['mean_vox_val'] = r.normal(300, 40, n_cases)
+    df['variance_vox_val'] = r.gamma(4.0, 500.0, n_cases)
+    df['PCE_top10percent'] = r.normal(1.5, 0.3, n_cases)
+    df['MultiFocal'] = (r.uniform(size=n_cases) < 0.15).astype(int)
+    df['Comment'] = np.where(r.uniform(size=n_cases) < 0.05,
+                             "segmentation checked", '')
+
+    incomplete = r.uniform(size=n_cases) < 0.02
+    df.loc[incomplete, 'washout'] = np.nan
+
+    df = df[['MARGINSstudyNr'] + feature_order +
+            ['mean_vox_val', 'variance_vox_val', 'PCE_top10percent',
+             'MultiFocal', 'Comment']]
+    df.to_excel(out, index=False, engine='openpyxl')
+
+
+def _with_sentinels(r, values, rates):
+    """Replace a fraction of `values` by each sentinel code."""
+    values = np.array(values, dtype=object)
+    u = r.uniform(size=len(values))
+    cutoff = 0.0
+    for code, rate in rates.items():
+        values[(u >= cutoff) & (u < cutoff + rate)] = code
+        cutoff += rate
+    return values
+
+
+def _clinical(case, factors, r):
+    n = len(case)
+    size = factors[:, 0]
+    enhancement = factors[:, 5]
+    subtype = np.where(enhancement + r.normal(0, 1, n) > -0.8,
+                       'ER+/HER2-',
+                       np.where(r.uniform(size=n) < 0.5, 'HER2+', 'TN'))
+    grade = np.clip(np.round(2 + 0.5 * factors[:, 2] + r.normal(0, 0.6, n)),
+                    1, 3).astype(int)
+    return {
+        'case': case,
+        'age': np.clip(np.round(r.normal(56, 11, n)), 25, 95).astype(int),
+        'diameter_mm': np.clip(np.round(25 + 6 * size + r.normal(0, 2, n)),
+                               3, 150).astype(int),
+        'positive_lymph_nodes': np.where(r.uniform(size=n) < 0.6, 0,
+                                         r.geometric(0.3, n)),
+        'grade': grade,
+        'subtype': subtype,
+        'therapy': {t: r.uniform(size=n) < p for t, p in
+                    [('RT', 0.7), ('Chemo', 0.45), ('Hormo', 0.5),
+                     ('HER2', 0.12)]},
+    }
+
+
+def write_clinical(cohort, out, seed):
+    """Clinical data of the cases with gene expression."""
+    r = rng(seed, 4)
+    c = _clinical(cohort.case, cohort.factors, r)
+    yes_no = np.array(['F', 'T'])
+    therapy = {t: yes_no[v.astype(int)] for t, v in c['therapy'].items()}
+    systemic = yes_no[(c['therapy']['Chemo'] | c['therapy']['Hormo'] |
+                       c['therapy']['HER2']).astype(int)]
+    pd.DataFrame({
+        'margins_patient': c['case'],
+        'rna_sample': cohort.sample,
+        'AdjRT': therapy['RT'],
+        'AdjChemo': therapy['Chemo'],
+        'AdjHormo': therapy['Hormo'],
+        'AdjAntiHER2': therapy['HER2'],
+        'AdjSystemic': systemic,
+        'pos_LN': _with_sentinels(r, c['positive_lymph_nodes'], {999: 0.02}),
+        'largest_diameter_MRI': _with_sentinels(
+            r, c['diameter_mm'] / 10, {999: 0.01}),
+        'histograde': _with_sentinels(r, c['grade'], {777: 0.03, 999: 0.02}),
+        'age_at_diag': c['age'],
+        'ihc_subtype': c['subtype'],
+    }).to_csv(out, sep='\t', index=False)
+
+
+def write_clinical_all_patients(cohort, out, seed):
+    """Clinical data of all cases in the study, coded as in the database."""
+    r = rng(seed, 5)
+    n_extra = len(cohort.case) * 3 // 2
+    extra_case = np.setdiff1d(np.arange(1, 10 * len(cohort.case) + 1000),
+                              cohort.case)
+    case = np.concatenate([cohort.case,
+                           r.choice(extra_case, n_extra, replace=False)])
+    factors = np.concatenate([cohort.factors,
+                              r.normal(size=(n_extra, n_factors))])
+    c = _clinical(case, factors, r)
+    yes_no = np.array(['N', 'J'])
+    therapy = {t: yes_no[v.astype(int)] for t, v in c['therapy'].items()}
+    ihc_code = np.select([c['subtype'] == 'ER+/HER2-',
+                          c['subtype'] == 'HER2+'], [1, 2], 3)
+    pd.DataFrame({
+        'StudyNumber': c['case'],
+        'AdjRT': therapy['RT'],
+        'AdjChemo': therapy['Chemo'],
+        'AdjHormo': therapy['Hormo'],
+        'AdjHER2': therapy['HER2'],
+        'LymphNodePos_BV': _with_sentinels(r, c['positive_lymph_nodes'],
+                                           {999: 0.02}),
+        'Diameter_BV': _with_sentinels(r, c['diameter_mm'], {999: 0.01}),
+        'Histograde_BV': _with_sentinels(r, c['grade'],
+                                         {777: 0.03, 999: 0.02}),
+        'Age': _with_sentinels(r, c['age'], {999: 0.005}),
+        'IHC_1erpos_2her2pos_3tripneg': _with_sentinels(
+            r, ihc_code, {555: 0.02, 999: 0.01}),
+    }).to_csv(out, sep='\t', index=False)
+
+
+def write_ensembl_annotation(cohort, out, seed):
+    """BioMart export of the genes, with duplicated and extra genes."""
+    r = rng(seed, 6)
+    n_genes = len(cohort.gene)
+    gene = np.array([g.split('.')[0] for g in cohort.gene], dtype=object)
+    entrez = np.where(cohort.entrez_gene_id > 0,
+                      cohort.entrez_gene_id.astype(str), '')
+    hgnc_id = np.array([f"HGNC:{e}" if e else '' for e in entrez],
+                       dtype=object)
+    chromosome = r.choice([str(c) for c in range(1, 23)] + ['X', 'Y', 'MT'],
+                          n_genes)
+
+    # Genes with several EntrezGene IDs get a row for each.
+    dup = np.where((cohort.entrez_gene_id > 0) &
+                   (r.uniform(size=n_genes) < 0.02))[0]
+    # Copies of genes on alternative haplotypes are not in the count data.
+    alt = np.where(r.uniform(size=n_genes) < 0.05)[0]
+    alt_gene = np.array([f"ENSG{i:011d}" for i in
+                         5 * n_genes + np.arange(len(alt))], dtype=object)
+
+    rows = np.concatenate([np.arange(n_genes), dup, alt])
+    start = r.randint(1, 2e8, len(rows))
+    annot = pd.DataFrame({
+        'Ensembl Gene ID': np.concatenate([gene, gene[dup], alt_gene]),
+        'Chromosome Name': np.concatenate([
+            chromosome, chromosome[dup],
+            [f"CHR_HSCHR{c}_1_CTG1" for c in chromosome[alt]]]),
+        'Gene Start (bp)': start,
+        'Gene End (bp)': start + r.randint(500, 200000, len(rows)),
+        'Strand': r.choice([-1, 1], len(rows)),
+        'EntrezGene ID': np.concatenate([
+            entrez, [str(e) for e in
+                     r.choice(10 * n_genes, len(dup)) + 10 * n_genes],
+            entrez[alt]]),
+        'HGNC symbol': cohort.hgnc_symbol[rows],
+        'HGNC ID(s)': hgnc_id[rows],
+    })
+    annot.to_csv(out, sep='\t', index=False)
+
+
+def _gene_sets(cohort, collection, r):
+    """Random gene sets, some of them enriched for a factor module."""
+    with_entrez = np.where(cohort.entrez_gene_id > 0)[0]
+    modules = [np.intersect1d(np.where(lo != 0)[0], with_entrez)
+               for lo in cohort.gene_loadings]
+    prefixes = msigdb_collections[collection]
+    for i in range(msigdb_n_gene_sets[collection]):
+        size = int(np.clip(r.lognormal(np.log(60), 0.9), 5, 1500))
+        members = r.choice(with_entrez, min(size, len(with_entrez)),
+                           replace=False)
+        if r.uniform() < 0.1:
+            module = modules[r.randint(n_factors)]
+            n_module = min(len(module), size // 2)
+            members = np.union1d(members[n_module:],
+                                 r.choice(module, n_module, replace=False))
+        yield f"{prefixes[i % len(prefixes)]}_SYNTHETIC_SET_{i}", members
+
+
+def write_msigdb(cohort, out, seed):
+    """MSigDB archive with GMTs of the collections used in the analyses."""
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i, collection in enumerate(msigdb_collections):
+            gmts = {'entrez': io.StringIO(), 'symbols': io.StringIO()}
+            for name, members in _gene_sets(cohort, collection,
+                                            rng(seed, 7, i)):
+                url = msigdb_url + name
+                gmts['entrez'].write('\t'.join(
+                    [name, url] +
+                    [str(e) for e in cohort.entrez_gene_id[members]]) + '\n')
+                gmts['symbols'].write('\t'.join(
+                    [name, url] + list(cohort.hgnc_symbol[members])) + '\n')
+            for gene_ids, gmt in gmts.items():
+                zf.writestr(gmt_member_name(collection, gene_ids),
+                            gmt.getvalue())
+
+
+def write_signature_matrix(cohort, out, seed):
+    """Cell type signature matrix like LM22, of genes with a symbol."""
+    r = rng(seed, 8)
+    with_symbol = np.where(cohort.hgnc_symbol != '')[0]
+    genes = np.sort(r.choice(with_symbol, min(500, len(with_symbol)),
+                             replace=False))
+    signature = pd.DataFrame(
+        r.lognormal(3, 2, (len(genes), len(signature_cell_types))),
+        index=pd.Index(cohort.hgnc_symbol[genes], name='Gene symbol'),
+        columns=signature_cell_types,
+    )
+    signature.to_csv(out, sep='\t', float_format='%.4f')
+
+
+def write_sfa_factors(cohort, out, seed):
+    """funcSFA factors of the cases, the latent factors with noise."""
+    r = rng(seed, 9)
+    factors = cohort.factors + 0.3 * r.normal(size=cohort.factors.shape)
+    with netCDF4.Dataset(out, 'w') as ds:
+        ds.createDimension('factor', n_factors)
+        ds.createDimension('case', len(cohort.case))
+        ds.createVariable('factor', 'i8', ('factor',))[:] = (
+            np.arange(1, n_factors + 1))
+        ds.createVariable('case', 'i8', ('case',))[:] = cohort.case
+        v = ds.createVariable('factors', 'f8', ('factor', 'case'))
+        v[:] = factors.T
+        v.long_name = "funcSFA factor score"
+        ds.title = "Synthetic funcSFA factors of the IMAGENE cohort"
+        ds.history = _history(f"Synthetic factors, seed {seed}")
+
+
+writers = {
+    'gene_expression': write_gene_expression,
+    'sample_tracking': write_sample_tracking,
+    'mri_features': write_mri_features,
+    'clinical': write_clinical,
+    'clinical_all_patients': write_clinical_all_patients,
+    'ensembl_annotation': write_ensembl_annotation,
+    'msigdb': write_msigdb,
+    'signature_matrix': write_signature_matrix,
+    'sfa_factors': write_sfa_factors,
+}
+
+
+@click.command()
+@click.argument('kind', type=click.Choice(list(writers)))
+@click.argument('out', type=click_utils.out_path)
+@click.option('--n-cases', default=300, help="Number of cases with RNA.")
+@click.option('--n-genes', default=60000, help="Number of genes.")
+@click.option('--seed', default=1, help="Seed of the random generator.")
+def generate_synthetic_cohort(kind, out, n_cases, n_genes, seed):
+    """Synthetic version of a raw input with the layout of the real one.
+
+    All kinds generated with the same size and seed describe the same
+    cohort.
+    """
+    cohort = make_cohort(n_cases, n_genes, seed)
+    writers[kind](cohort, out, seed)
+
+
+if __name__ == '__main__':
+    generate_synthetic_cohort()
@@ -2,6 +2,8 @@ import click
 import numpy as np
 import pandas as pd
 
+from lib import ensembl_reference
+
 
 def only(x):
     assert len(x) == 1, f"Length is {len(x)}"
@@ -32,21 +34,22 @@ def map_genes(xls, refseq, ensembl, out):
                            for r in genes_df['refseq_id']]
 
     # Map HGNC identifier to Ensembl identifier
-    ensembl_annot = pd.read_csv(ensembl, sep='\t')
-    hgnc_to_ensembl = dict()
-    for ensembl_id, hgnc_id in zip(ensembl_annot['Ensembl Gene ID'],
-                                   ensembl_annot['HGNC ID(s)']):
-        if hgnc_id:
-            hgnc_to_ensembl.setdefault(hgnc_id, set()).add(ensembl_id)
-    ensembl_annot = ensembl_annot.set_index('Ensembl Gene ID')
+    ref = ensembl_reference.read_reference(ensembl)
+    ensembl_gene_ids = ref['ensembl_gene_id'].values
+    chroms = ref['chromosome_name'].values
+    hgnc_rows = ensembl_reference.rows_with(ref, 'hgnc_id',
+                                            genes_df['hgnc_id'])
 
     genes_df['ensembl_id'] = np.full(genes_df.shape[0], None)
     ensembl_col = genes_df.columns.get_loc('ensembl_id')
-    for row_idx, hgnc_id in enumerate(genes_df['hgnc_id']):
-        ensembl_ids = hgnc_to_ensembl.get(hgnc_id, set())
+    for row_idx, (hgnc_id, rows) in enumerate(zip(genes_df['hgnc_id'],
+                                                  hgnc_rows)):
+        if not hgnc_id:
+            rows = []
+        ensembl_ids = set(ensembl_gene_ids[rows])
         if len(ensembl_ids) > 1:
-            chroms = ensembl_annot['Chromosome Name'].loc[list(ensembl_ids)]
-            ensembl_ids = set([e for e, c in chroms.items() if len(c) < 2])
+            ensembl_ids = set([ensembl_gene_ids[r] for r in rows
+                               if len(chroms[r]) < 2])
         if len(ensembl_ids) == 0:
             genes_df.iloc[row_idx, ensembl_col] = ''
         else:
@@ -3,10 +3,14 @@ import csv
 from datetime import datetime, timezone
 from pathlib import Path
 
+import netCDF4
 import numpy as np
-import pandas as pd
 import xarray as xr
 
+from lib import ensembl_reference
+from lib import instrument
+from lib import sparse_counts
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -25,19 +29,55 @@ def parse_args():
         help="Annotation of genes",
     )
     parser.add_argument('out', help='Output NetCDF file.')
+    parser.add_argument(
+        '--sparse-counts', choices=sparse_counts.formats,
+        help="Store the read counts as a sparse matrix in this format.",
+    )
+    parser.add_argument(
+        '--exclude-samples',
+        help="File with samples to leave out, one per line, such as the "
+             "outliers of qc_gene_expression.py.",
+    )
+    parser.add_argument(
+        '--append', action='store_true',
+        help="Append the samples that are not in the existing output file "
+             "to it, instead of writing it.",
+    )
     args = parser.parse_args()
 
     # Check for existence for paths
     args.gene_expression_data = Path(args.gene_expression_data).resolve()
     args.sample_tracking = Path(args.sample_tracking).resolve()
     args.gene_annotation = Path(args.gene_annotation).resolve()
+    if args.exclude_samples:
+        args.exclude_samples = Path(args.exclude_samples).resolve()
     args.out = Path(args.out)
     args.out = args.out.parent.resolve() / args.out.name
 
     return args
 
 
-def counts_to_log2_cpm(counts):
+def counts_to_log2_cpm(counts, genes=None):
+    """log2(counts per million) of dense or sparse (sample, gene) counts.
+
+    With `genes`, a mask or indices, only the selected genes are computed.
+    Library sizes include all genes.
+    """
+    if isinstance(counts, sparse_counts.SparseCounts):
+        coords = dict(counts.coords)
+        if genes is not None:
+            coords['gene'] = coords['gene'][genes]
+        return xr.DataArray(
+            data=sparse_counts.log2_cpm(counts.matrix, genes),
+            coords=coords,
+            dims=counts.dims,
+            attrs={'unit': "lb(re 1)",
+                   'long_name': "log(counts per million)"},
+        )
+
+    library_size = counts.sum('gene')
+    if genes is not None:
+        counts = counts.isel(gene=genes)
     cpm = xr.DataArray(
         data=np.full(counts.shape, np.nan, dtype=np.float64),
         coords=counts.coords,
@@ -45,7 +85,6 @@ def counts_to_log2_cpm(counts):
     )
     cpm.attrs['unit'] = "lb(re 1)"
     cpm.attrs['long_name'] = "log(counts per million)"
-    library_size = counts.sum('gene')
     cpm.values = np.log2((0.5 + counts) / (library_size+1)*1e6)
 
     return cpm
@@ -67,31 +106,24 @@ def map_sample_to_case(samples, sample_tracking_path):
     return cases
 
 
-def merge_vals(v):
-    v = set(v)
-    if len(v) > 1:
-        return ''
-    else:
-        return v.pop()
+def strip_gene_versions(genes):
+    return [s.split('.')[0] for s in genes]
 
 
 def annotate_genes(data_set, annot_path):
-    data_set['gene'].values = [s.split('.')[0]
-                               for s in data_set['gene'].values]
-    annot = pd.read_table(annot_path, dtype=str, na_filter=False)
-    annot = annot.groupby('Ensembl Gene ID').aggregate(merge_vals)
-    annot = annot.loc[data_set['gene']]
+    data_set['gene'].values = strip_gene_versions(data_set['gene'].values)
+    ref = ensembl_reference.read_reference(annot_path)
+    genes = data_set['gene'].values
 
     data_set['entrez_gene_id'] = xr.DataArray(
-        data=np.array(annot['EntrezGene ID'].fillna(-1).replace('', -1),
-                      dtype='int64'),
+        data=ensembl_reference.unique_by_gene(ref, 'entrezgene', genes, -1),
         dims=('gene',),
     )
     data_set['entrez_gene_id'].encoding['_FillValue'] = -1
     data_set['entrez_gene_id'].attrs['long_name'] = 'EntrezGene ID'
 
     data_set['hgnc_symbol'] = xr.DataArray(
-        data=np.array(annot['HGNC symbol'].fillna(''), dtype='object'),
+        data=ensembl_reference.unique_by_gene(ref, 'hgnc_symbol', genes, ''),
         dims=('gene',),
     )
     data_set['hgnc_symbol'].encoding['_FillValue'] = ''
@@ -100,18 +132,128 @@ def annotate_genes(data_set, annot_path):
     return data_set
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def read_sample_list(path):
+    with path.open() as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def exclude_samples(data_set, path):
+    """Data set without the samples listed in a file."""
+    if path is None:
+        return data_set
+    keep = ~np.isin(data_set['sample'].values, read_sample_list(path))
+    return data_set.isel(sample=np.flatnonzero(keep))
+
+
+def process_samples(data_set, sample_tracking, run, sparse_format=None):
+    """log2 CPM and cases of the samples of a lazily opened raw data set.
+
+    Returns the data set along case, and the counts, sparse if a format is
+    given.
+    """
+    with run.stage('load'):
+        if sparse_format:
+            # Convert block by block, never loading the dense counts
+            counts = sparse_counts.from_dense(data_set['read_count'],
+                                              sparse_format)
+            del data_set['read_count']
+        data_set.load()
+        if not sparse_format:
+            counts = data_set['read_count']
+
+    if sparse_format:
+        sizes = dict(zip(counts.dims, counts.matrix.shape))
+    else:
+        sizes = counts.sizes
+    with run.stage('counts_to_log2_cpm', **sizes):
+        data_set['log2_cpm'] = counts_to_log2_cpm(counts)
+    with run.stage('map_sample_to_case', sample=data_set['sample'].size):
+        data_set['case'] = map_sample_to_case(data_set['sample'],
+                                              sample_tracking)
+        data_set = data_set.swap_dims({'sample': 'case'})
+        data_set = data_set.reset_coords(['sample'])
+    if sparse_format:
+        counts = counts._replace(dims=('case', 'gene'))
+        data_set.update(sparse_counts.to_variables(counts, 'read_count'))
+    return data_set, counts
+
+
+def unlimited_dims(data_set):
+    """Dimensions along which appended samples extend the data set."""
+    dims = ['case']
+    if (sparse_counts.is_sparse(data_set, 'read_count') and
+            data_set['read_count_data'].attrs['sparse_format'] == 'csr'):
+        dims += ['read_count_nnz', 'read_count_ptr']
+    return dims
+
 
-    data_set = xr.open_dataset(str(args.gene_expression_data))
+def set_unlimited_chunks(data_set, unlimited, chunk_bytes=2**20):
+    """Chunk variables along unlimited dimensions in about 1 MiB.
 
-    data_set['log2_cpm'] = counts_to_log2_cpm(data_set['read_count'])
-    data_set['case'] = map_sample_to_case(data_set['sample'],
-                                          args.sample_tracking)
-    data_set = data_set.swap_dims({'sample': 'case'})
-    data_set = data_set.reset_coords(['sample'])
+    NetCDF otherwise stores them in chunks of a single element along these
+    dimensions.
+    """
+    for var in data_set.variables.values():
+        if not set(var.dims) & set(unlimited):
+            continue
+        row_size = var.dtype.itemsize * int(np.prod(
+            [n for d, n in zip(var.dims, var.shape) if d not in unlimited]))
+        rows = max(1, chunk_bytes // row_size)
+        var.encoding['chunksizes'] = tuple(
+            max(1, min(rows, n)) if d in unlimited else n
+            for d, n in zip(var.dims, var.shape))
 
-    data_set = annotate_genes(data_set, args.gene_annotation)
+
+def append_cases(data_set, path):
+    """Write the cases of a processed data set after those in a file.
+
+    Variables along case are extended in place along the unlimited case
+    dimension, CSR counts along the unlimited dimensions of their arrays.
+    The attributes of the file are replaced by those of the data set.
+    """
+    with netCDF4.Dataset(str(path), 'a') as nc:
+        for dim in unlimited_dims(data_set):
+            if dim not in nc.dimensions:
+                raise ValueError(f"{path} has no dimension {dim} to append "
+                                 "the samples along")
+            if not nc.dimensions[dim].isunlimited():
+                raise ValueError(f"Dimension {dim} of {path} is not "
+                                 "unlimited, process all samples again")
+        case_vars = {name for name, v in nc.variables.items()
+                     if 'case' in v.dimensions}
+        new_vars = {name for name, v in data_set.variables.items()
+                    if 'case' in v.dims}
+        if case_vars != new_vars:
+            raise ValueError(
+                f"Variables along case differ from {path}: "
+                f"{', '.join(sorted(case_vars ^ new_vars))}")
+
+        start = nc.dimensions['case'].size
+        stop = start + data_set.sizes['case']
+        for name in sorted(case_vars):
+            var = nc.variables[name]
+            index = tuple(slice(start, stop) if d == 'case' else slice(None)
+                          for d in var.dimensions)
+            var[index] = data_set[name].transpose(*var.dimensions).values
+        if sparse_counts.is_sparse(data_set, 'read_count'):
+            nnz_start = nc.dimensions['read_count_nnz'].size
+            for name in ('read_count_data', 'read_count_indices'):
+                nc.variables[name][nnz_start:] = data_set[name].values
+            nc.variables['read_count_indptr'][start + 1:stop + 1] = (
+                nnz_start + data_set['read_count_indptr'].values[1:])
+        nc.setncatts(data_set.attrs)
+
+
+def process(args, run):
+    """Process all samples and write the output file."""
+    with run.stage('open'):
+        data_set = xr.open_dataset(str(args.gene_expression_data))
+        data_set = exclude_samples(data_set, args.exclude_samples)
+    data_set, counts = process_samples(data_set, args.sample_tracking, run,
+                                       args.sparse_counts)
+
+    with run.stage('annotate_genes', gene=data_set['gene'].size):
+        data_set = annotate_genes(data_set, args.gene_annotation)
 
     time_str = (datetime.utcnow()
                 .replace(microsecond=0, tzinfo=timezone.utc)
@@ -123,5 +265,75 @@ if __name__ == "__main__":
         data_set.attrs['history']
     )
     data_set.attrs['date_metadata_modified'] = time_str
+    run.annotate(data_set)
+
+    unlimited = unlimited_dims(data_set)
+    set_unlimited_chunks(data_set, unlimited)
+    with run.stage('write'):
+        data_set.to_netcdf(str(args.out), unlimited_dims=unlimited)
+
+
+def append(args, run):
+    """Append the samples that are not yet in the output file to it."""
+    with xr.open_dataset(str(args.out)) as existing:
+        genes = existing['gene'].values
+        samples = existing['sample'].values
+        cases = existing['case'].values
+        attrs = dict(existing.attrs)
+        sparse_format = None
+        if sparse_counts.is_sparse(existing, 'read_count'):
+            sparse_format = existing['read_count_data'].attrs['sparse_format']
+    if sparse_format == 'csc':
+        raise ValueError(f"Cannot append to the CSC counts of {args.out}")
+
+    with run.stage('open'):
+        data_set = xr.open_dataset(str(args.gene_expression_data))
+        data_set = exclude_samples(data_set, args.exclude_samples)
+        new = ~np.isin(data_set['sample'].values, samples)
+        if not new.any():
+            print(f"All samples are in {args.out} already")
+            return
+        data_set = data_set.isel(sample=np.flatnonzero(new))
+        if not np.array_equal(
+                strip_gene_versions(data_set['gene'].values), genes):
+            raise ValueError(f"Genes of {args.gene_expression_data} differ "
+                             f"from those of {args.out}")
+
+    data_set, counts = process_samples(data_set, args.sample_tracking, run,
+                                       sparse_format)
+    duplicated = np.intersect1d(data_set['case'].values, cases)
+    if duplicated.size:
+        raise ValueError(f"Cases {', '.join(map(str, duplicated))} of new "
+                         f"samples are in {args.out} already")
+
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    data_set.attrs = attrs
+    data_set.attrs['history'] = (
+        f"{time_str} process_gene_expression.py Appended "
+        f"{data_set.sizes['case']} samples from "
+        f"{args.gene_expression_data.name}: "
+        f"{', '.join(data_set['sample'].values)}\n" +
+        attrs['history']
+    )
+    data_set.attrs['date_metadata_modified'] = time_str
+    run.annotate(data_set)
+
+    with run.stage('append', case=data_set.sizes['case']):
+        append_cases(data_set, args.out)
+
+
+if __name__ == "__main__":
+    args = parse_args()
 
-    data_set.to_netcdf(str(args.out))
+    with instrument.run('process_gene_expression.py',
+                        inputs=[args.gene_expression_data,
+                                args.sample_tracking, args.gene_annotation] +
+                        ([args.exclude_samples] if args.exclude_samples
+                         else []),
+                        outputs=[args.out]) as run:
+        if args.append:
+            append(args, run)
+        else:
+            process(args, run)
@@ -7,6 +7,9 @@ import click_log
 import numpy as np
 import xarray as xr
 
+from lib import instrument
+from lib import sparse_counts
+
 
 logger = logging.getLogger(__name__)
 
@@ -60,35 +63,42 @@ click_out_path = click.Path(exists=False, dir_okay=False, resolve_path=True)
 @click_log.simple_verbosity_option()
 @click_log.init(__name__)
 def run_sfa(gexp, out):
-    logging.info("Running limma voom")
-    ds = xr.open_dataset(gexp).load()
-    if 'log2_cpm' in ds:
-        del ds['log2_cpm']
-    library_size = (ds['read_count'].sum('gene') + ds['N_unmapped'] +
-                    ds['N_multimapping'] + ds['N_noFeature'] +
-                    ds['N_ambiguous'])
-    log2_cpm, weights = voom(ds['read_count'], library_size)
-
-    logger.info("Preparing output")
-    ds['log2_cpm'] = log2_cpm
-    ds['weight'] = weights
-    del ds['read_count']
-    del ds['N_unmapped']
-    del ds['N_multimapping']
-    del ds['N_noFeature']
-    del ds['N_ambiguous']
-
-    time_str = (datetime.utcnow()
-                .replace(microsecond=0, tzinfo=timezone.utc)
-                .isoformat())
-    ds.attrs['history'] = (
-        "{date} process_gene_expression_voom.py Apply Limma-Voom\n"
-        .format(date=time_str) +
-        ds.attrs['history']
-    )
-
-    logger.info("Writing result to {}".format(out))
-    ds.to_netcdf(out)
+    with instrument.run('process_gene_expression_voom.py', inputs=[gexp],
+                        outputs=[out]) as run:
+        logging.info("Running limma voom")
+        with run.stage('load'):
+            ds = xr.open_dataset(gexp).load()
+        if 'log2_cpm' in ds:
+            del ds['log2_cpm']
+        counts = sparse_counts.dense(ds, 'read_count')
+        library_size = (counts.sum('gene') + ds['N_unmapped'] +
+                        ds['N_multimapping'] + ds['N_noFeature'] +
+                        ds['N_ambiguous'])
+        with run.stage('voom', **counts.sizes):
+            log2_cpm, weights = voom(counts, library_size)
+
+        logger.info("Preparing output")
+        ds['log2_cpm'] = log2_cpm
+        ds['weight'] = weights
+        sparse_counts.drop(ds, 'read_count')
+        del ds['N_unmapped']
+        del ds['N_multimapping']
+        del ds['N_noFeature']
+        del ds['N_ambiguous']
+
+        time_str = (datetime.utcnow()
+                    .replace(microsecond=0, tzinfo=timezone.utc)
+                    .isoformat())
+        ds.attrs['history'] = (
+            "{date} process_gene_expression_voom.py Apply Limma-Voom\n"
+            .format(date=time_str) +
+            ds.attrs['history']
+        )
+        run.annotate(ds)
+
+        logger.info("Writing result to {}".format(out))
+        with run.stage('write'):
+            ds.to_netcdf(out)
 
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@ from pathlib import Path
 
 import pandas as pd
 
+from lib import instrument
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -42,19 +44,25 @@ def read_mri_xlsx(mri_path, study_nr_col):
 if __name__ == "__main__":
     args = parse_args()
 
-    data_set = read_mri_xlsx(args.mri_data, args.study_nr_col)
-    del data_set['mean_vox_val']
-    del data_set['variance_vox_val']
-    del data_set['PCE_top10percent']
-    data_set.attrs['title'] = ("MRI features from Margins of samples with "
-                               "gene expression data from Imagene")
-
-    time_str = (datetime.utcnow()
-                .replace(microsecond=0, tzinfo=timezone.utc)
-                .isoformat())
-    data_set.attrs['history'] = (
-        "{time} process_mri.py Converted from {fn}."
-        .format(time=time_str, fn=args.mri_data)
-    )
-
-    data_set.to_netcdf(str(args.out))
+    with instrument.run('process_mri.py', inputs=[args.mri_data],
+                        outputs=[args.out]) as run:
+        with run.stage('read_mri_xlsx'):
+            data_set = read_mri_xlsx(args.mri_data, args.study_nr_col)
+        del data_set['mean_vox_val']
+        del data_set['variance_vox_val']
+        del data_set['PCE_top10percent']
+        data_set.attrs['title'] = ("MRI features from Margins of samples "
+                                   "with gene expression data from Imagene")
+
+        time_str = (datetime.utcnow()
+                    .replace(microsecond=0, tzinfo=timezone.utc)
+                    .isoformat())
+        data_set.attrs['history'] = (
+            "{time} process_mri.py Converted from {fn}."
+            .format(time=time_str, fn=args.mri_data)
+        )
+        run.annotate(data_set)
+
+        with run.stage('write', case=data_set['case'].size,
+                       cad_feature=len(data_set.data_vars)):
+            data_set.to_netcdf(str(args.out))
@@ -0,0 +1,187 @@
+"""Quality control of the RNA-seq samples of the raw gene expression.
+
+The read counts are read a block of samples at a time, so memory does not
+grow with the size of the cohort. Per sample it computes the rates of the
+STAR summary counters, the number of detected genes and the fraction of
+reads in the most abundant genes. Samples are compared through a count
+sketch of their centred log2 CPM, which preserves their correlations
+approximately in `sketch_size` columns instead of all genes.
+
+Samples with a library size, or a median correlation with the other
+samples, more than `max_z` robust standard deviations from the median are
+excluded. Their identifiers are written to a list with one per line,
+which `process_gene_expression.py --exclude-samples` applies.
+"""
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+from lib import click_utils
+from lib import instrument
+
+# STAR summary counters and the name of their rate
+star_counters = {
+    'N_unmapped': 'unmapped_rate',
+    'N_multimapping': 'multimapping_rate',
+    'N_noFeature': 'no_feature_rate',
+    'N_ambiguous': 'ambiguous_rate',
+}
+
+
+def count_sketch(n_genes, sketch_size, seed):
+    """Sparse (gene, sketch) matrix hashing each gene to a signed column."""
+    r = np.random.RandomState(seed)
+    column = r.randint(sketch_size, size=n_genes)
+    sign = r.choice([-1.0, 1.0], size=n_genes)
+    return scipy.sparse.csc_matrix((sign, (np.arange(n_genes), column)),
+                                   shape=(n_genes, sketch_size))
+
+
+def block_metrics(counts, top_genes, sketch):
+    """Metrics and normalised sketch of a (sample, gene) block of counts."""
+    library_size = counts.sum(1, dtype='int64')
+    top_genes = min(top_genes, counts.shape[1])
+    top = -np.partition(-counts, top_genes - 1, axis=1)[:, :top_genes]
+    log2_cpm = np.log2((0.5 + counts) /
+                       (library_size[:, np.newaxis] + 1) * 1e6)
+    log2_cpm -= log2_cpm.mean(1, keepdims=True)
+    sketched = (sketch.T @ log2_cpm.T).T
+    sketched /= np.linalg.norm(sketched, axis=1, keepdims=True)
+    return {
+        'library_size': library_size,
+        'detected_genes': (counts > 0).sum(1),
+        'top_genes_fraction': top.sum(1) / np.maximum(library_size, 1),
+    }, sketched
+
+
+def median_correlation(sketched, block_size=256):
+    """Median correlation of each sample with the others."""
+    n = sketched.shape[0]
+    # The sample itself is sorted last, the median of the others is between
+    # these positions
+    lower, upper = (n - 2) // 2, (n - 1) // 2
+    median = np.empty(n)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        corr = sketched[start:stop] @ sketched.T
+        corr[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        corr.partition([lower, upper], axis=1)
+        median[start:stop] = (corr[:, lower] + corr[:, upper]) / 2
+    return median
+
+
+def robust_z(x):
+    """Distance from the median in robust standard deviations.
+
+    If more than half of the values equal the median, the standard deviation
+    is estimated from the mean absolute deviation instead of the median.
+    Values are 0 if all are equal.
+    """
+    median = np.median(x)
+    deviation = np.abs(x - median)
+    scale = 1.4826 * np.median(deviation)
+    if scale == 0:
+        scale = 1.2533 * np.mean(deviation)
+    if scale == 0:
+        return np.zeros(np.shape(x))
+    return (x - median) / scale
+
+
+def qc_metrics(data_set, block_size, top_genes, sketch_size, seed):
+    """Per-sample metrics of a lazily opened raw gene expression data set."""
+    counts = data_set['read_count']
+    n_samples = data_set.sizes['sample']
+    sketch = count_sketch(data_set.sizes['gene'], sketch_size, seed)
+    blocks = []
+    # Single precision is ample for the error of the sketch, and faster
+    sketched = np.empty((n_samples, sketch_size), dtype='float32')
+    for start in range(0, n_samples, block_size):
+        block = (counts.isel(sample=slice(start, start + block_size))
+                 .transpose('sample', 'gene').values)
+        metrics, sketched[start:start + block_size] = block_metrics(
+            block, top_genes, sketch)
+        blocks.append(metrics)
+    metrics = {name: np.concatenate([b[name] for b in blocks])
+               for name in blocks[0]}
+
+    library_size = metrics['library_size']
+    n_reads = library_size + sum(data_set[c].values.astype('int64')
+                                 for c in star_counters)
+    metrics['n_reads'] = n_reads
+    metrics['assigned_rate'] = library_size / n_reads
+    for counter, rate in star_counters.items():
+        metrics[rate] = data_set[counter].values / n_reads
+    metrics['median_correlation'] = median_correlation(sketched)
+    return metrics
+
+
+@click.command()
+@click.argument('gene_expression', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.argument('excluded', type=click_utils.out_path)
+@click.option('--block-size', default=64,
+              help="Number of samples read at a time.")
+@click.option('--top-genes', default=50,
+              help="Number of most abundant genes of top_genes_fraction.")
+@click.option('--sketch-size', default=1024,
+              help="Number of columns of the count sketch.")
+@click.option('--max-z', default=5.0,
+              help="Robust z-score beyond which a sample is an outlier.")
+@click.option('--seed', default=0, help="Seed of the count sketch.")
+def qc_gene_expression(gene_expression, out, excluded, block_size,
+                       top_genes, sketch_size, max_z, seed):
+    """Compute QC metrics of all samples and list the outliers."""
+    with instrument.run('qc_gene_expression.py', inputs=[gene_expression],
+                        outputs=[out, excluded]) as run:
+        data_set = xr.open_dataset(gene_expression)
+        with run.stage('qc_metrics', **data_set['read_count'].sizes):
+            metrics = qc_metrics(data_set, block_size, top_genes,
+                                 sketch_size, seed)
+
+        library_size_z = robust_z(np.log10(metrics['library_size'] + 1))
+        correlation_z = robust_z(metrics['median_correlation'])
+        library_size_outlier = np.abs(library_size_z) > max_z
+        correlation_outlier = correlation_z < -max_z
+        qc = xr.Dataset(
+            {name: ('sample', values) for name, values in metrics.items()},
+            coords={'sample': data_set['sample'].values},
+        )
+        qc['library_size_z'] = ('sample', library_size_z)
+        qc['correlation_z'] = ('sample', correlation_z)
+        qc['library_size_outlier'] = ('sample', library_size_outlier)
+        qc['correlation_outlier'] = ('sample', correlation_outlier)
+        qc['excluded'] = ('sample',
+                          library_size_outlier | correlation_outlier)
+        data_set.close()
+
+        qc['library_size'].attrs['long_name'] = "reads assigned to genes"
+        qc['n_reads'].attrs['long_name'] = "reads counted by STAR"
+        qc['detected_genes'].attrs['long_name'] = "genes with any reads"
+        qc['top_genes_fraction'].attrs['long_name'] = (
+            f"fraction of assigned reads in the {top_genes} most abundant "
+            "genes")
+        qc['median_correlation'].attrs['long_name'] = (
+            "median correlation of log2 CPM with the other samples")
+        qc.attrs['max_z'] = max_z
+        qc.attrs['sketch_size'] = sketch_size
+        time_str = (datetime.utcnow()
+                    .replace(microsecond=0, tzinfo=timezone.utc)
+                    .isoformat())
+        qc.attrs['history'] = (
+            f"{time_str} qc_gene_expression.py Computed QC metrics of "
+            f"{gene_expression}\n")
+        run.annotate(qc)
+        qc.to_netcdf(out)
+
+        samples = qc['sample'].values[qc['excluded'].values]
+        with open(excluded, 'w') as f:
+            f.writelines(f"{s}\n" for s in samples)
+        click.echo(f"Excluded {len(samples)} of {qc.sizes['sample']} "
+                   "samples", err=True)
+
+
+if __name__ == '__main__':
+    qc_gene_expression()
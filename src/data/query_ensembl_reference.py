@@ -1,55 +1,120 @@
-import argparse
-import click
+from datetime import datetime, timezone
+import hashlib
 from pathlib import Path
+import shutil
 
+import click
 import requests
+import xarray as xr
 
-biomart_url = 'http://sep2015.archive.ensembl.org/biomart/martservice'
+from lib import click_utils
+from lib import ensembl_reference
+from lib.gene_sets import file_hash
 
-fields = ["ensembl_gene_id",
-          "chromosome_name",
-          "start_position",
-          "end_position",
-          "strand",
-          "entrezgene",
-          "hgnc_symbol",
-          "hgnc_id"]
+biomart_urls = {
+    82: 'http://sep2015.archive.ensembl.org/biomart/martservice',
+}
 
 query_xml = '''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE Query>
 <Query  virtualSchemaName = "default" formatter = "TSV" header = "1"
         uniqueRows = "0" count = "" datasetConfigVersion = "0.6" >
     <Dataset name = "hsapiens_gene_ensembl" interface = "default" >
-''' + '\n'.join(['<Attribute name = "{}" />'.format(f) for f in fields]) + '''
+''' + '\n'.join(['<Attribute name = "{}" />'.format(f)
+                 for f in ensembl_reference.attributes]) + '''
     </Dataset>
 </Query>'''
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Download ensemble reference"
-    )
-    parser.add_argument('out', help='Output tsv file.')
-    args = parser.parse_args()
+def is_url(source):
+    return source.startswith(('http://', 'https://'))
 
-    # Check for existence for paths
-    args.out = Path(args.out)
-    args.out = args.out.parent.resolve() / args.out.name
 
-    return args
+def query_key(source, release):
+    """Hash of the query, the release and the source."""
+    if is_url(source):
+        source_id = source
+    else:
+        source_id = file_hash(source)
+    return hashlib.sha256("\0".join([
+        query_xml, str(release), source_id,
+    ]).encode()).hexdigest()
 
 
-if __name__ == '__main__':
-    args = parse_args()
+def stream_lines(source):
+    """Lines of the BioMart export as they are received."""
+    if not is_url(source):
+        with open(source) as f:
+            yield from f
+        return
 
-    r = requests.get(biomart_url, params={'query': query_xml}, stream=True)
+    r = requests.get(source, params={'query': query_xml}, stream=True)
     r.raise_for_status()
-
+    r.encoding = 'utf-8'
     r_length = r.headers.get('content-length')
     if r_length is not None:
         r_length = int(r_length)
+    with click.progressbar(length=r_length) as bar:
+        for line in r.iter_lines(decode_unicode=True):
+            bar.update(len(line) + 1)
+            yield line
+
+
+def cached_key(path):
+    if not Path(path).exists():
+        return None
+    with xr.open_dataset(str(path)) as ds:
+        return ds.attrs.get('query_sha256')
+
 
-    with args.out.open('wb') as file:
-        with click.progressbar(r.iter_content(1024), length=r_length) as bar:
-            for chunk in bar:
-                file.write(chunk)
+def build_reference(source, release, key, out):
+    """Parse the source while it streams in and write the reference."""
+    ref = ensembl_reference.to_dataset(
+        ensembl_reference.parse_tsv(stream_lines(source)))
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    ref.attrs['history'] = (f"{time_str} query_ensembl_reference.py "
+                            f"Ensembl release {release} from {source}\n")
+    ref.attrs['ensembl_release'] = release
+    ref.attrs['source'] = source
+    ref.attrs['query_sha256'] = key
+    # Never leave a partial reference under the final name
+    part = Path(f"{out}.part")
+    ensembl_reference.write_reference(ref, part)
+    part.replace(out)
+
+
+@click.command()
+@click.argument('out', type=click_utils.out_path)
+@click.option('--release', default=82, help="Ensembl release.")
+@click.option('--source', default=None,
+              help="BioMart URL or TSV file to read instead of the "
+                   "BioMart archive of the release.")
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              default=None)
+def query_ensembl_reference(out, release, source, cache_dir):
+    """Download the Ensembl gene reference into a NetCDF file."""
+    if source is None:
+        if release not in biomart_urls:
+            raise click.BadParameter(f"No BioMart archive of release "
+                                     f"{release}, use --source",
+                                     param_hint='--release')
+        source = biomart_urls[release]
+    key = query_key(source, release)
+    if cached_key(out) == key:
+        click.echo(f"{out} is up to date", err=True)
+        return
+    if cache_dir is None:
+        build_reference(source, release, key, out)
+        return
+
+    cache_path = Path(cache_dir) / f"ensembl-{release}-{key[:16]}.nc"
+    if cached_key(cache_path) != key:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        build_reference(source, release, key, cache_path)
+    shutil.copyfile(str(cache_path), out)
+
+
+if __name__ == '__main__':
+    query_ensembl_reference()
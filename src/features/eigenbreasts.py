@@ -0,0 +1,223 @@
+"""Eigenbreasts, principal components of stacks of downsampled breast images.
+
+Each stack is a (case, y, x) or (case, pixel) array in a `.npy` file, with
+the cases in the order of a case list. The stacks are memory-mapped and
+read a block of cases at a time, so memory does not grow with the number
+of cases. Blocks are processed in a pool of `jobs` processes.
+
+The randomized method computes the components like the randomized solver
+of `sklearn.decomposition.PCA`, with a pass over the images for the mean,
+one for the range of the centred images, two per power iteration and one
+to project on the range. The incremental method fits
+`sklearn.decomposition.IncrementalPCA` a block at a time in one process,
+and projects the blocks in the pool.
+
+The scores of all stacks are written as (PC, case) variables named after
+the stacks, the explained variance ratios as `expl_var_<stack>.csv` with
+one value per line, and the mean image, components and explained variance
+to a separate data set.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+import numpy as np
+import sklearn.decomposition
+import xarray as xr
+
+from lib import click_utils
+from lib import instrument
+
+
+def read_cases(path):
+    with open(path) as f:
+        return np.array([int(line) for line in f if line.strip()],
+                        dtype='int64')
+
+
+def read_block(path, start, stop):
+    """Images of a block of cases as (case, pixel) rows."""
+    stack = np.load(path, mmap_mode='r')
+    return stack[start:stop].reshape(stop - start, -1).astype('float64')
+
+
+def _block_sum(path, start, stop):
+    return read_block(path, start, stop).sum(0)
+
+
+def _block_project(path, start, stop, mean, right):
+    """Centred images times `right`, and their sum of squares."""
+    block = read_block(path, start, stop) - mean
+    return block @ right, np.einsum('ij,ij->', block, block)
+
+
+def _block_back_project(path, start, stop, mean, left):
+    """Transposed centred images times the rows of `left` of the block."""
+    block = read_block(path, start, stop) - mean
+    return block.T @ left[start:stop]
+
+
+def map_blocks(func, path, blocks, jobs, *args):
+    """func(path, start, stop, *args) over blocks of cases in a pool."""
+    if jobs == 1:
+        return [func(path, start, stop, *args) for start, stop in blocks]
+    with ProcessPoolExecutor(jobs) as pool:
+        n = len(blocks)
+        starts, stops = zip(*blocks)
+        return list(pool.map(func, [path] * n, starts, stops,
+                             *[[a] * n for a in args]))
+
+
+def case_blocks(n_cases, block_size):
+    return [(start, min(start + block_size, n_cases))
+            for start in range(0, n_cases, block_size)]
+
+
+def flip_signs(components, scores):
+    """Make the largest loading of each component positive, like sklearn."""
+    largest = np.argmax(np.abs(components), axis=1)
+    signs = np.sign(components[np.arange(components.shape[0]), largest])
+    return components * signs[:, np.newaxis], scores * signs
+
+
+def randomized_pca(path, n_components, block_size=256, jobs=1,
+                   n_oversamples=10, n_iter=4, seed=0):
+    """Randomized PCA of the images of a memory-mapped stack.
+
+    Returns the mean image, the (PC, pixel) components, the (case, PC)
+    scores, and the explained variance and its ratio.
+    """
+    shape = np.load(path, mmap_mode='r').shape
+    n_cases, n_pixels = shape[0], int(np.prod(shape[1:]))
+    blocks = case_blocks(n_cases, block_size)
+    mean = sum(map_blocks(_block_sum, path, blocks, jobs)) / n_cases
+
+    def project(right):
+        parts = map_blocks(_block_project, path, blocks, jobs, mean, right)
+        return (np.concatenate([p for p, _ in parts]),
+                sum(ss for _, ss in parts))
+
+    def back_project(left):
+        return sum(map_blocks(_block_back_project, path, blocks, jobs, mean,
+                              left))
+
+    size = min(n_components + n_oversamples, n_cases, n_pixels)
+    r = np.random.RandomState(seed)
+    range_, sum_of_squares = project(r.normal(size=(n_pixels, size)))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(range_)
+        q, _ = np.linalg.qr(back_project(q))
+        range_, _ = project(q)
+    q, _ = np.linalg.qr(range_)
+    u, s, vt = np.linalg.svd(back_project(q).T, full_matrices=False)
+
+    n_components = min(n_components, size)
+    components, scores = flip_signs(
+        vt[:n_components], (q @ u[:, :n_components]) * s[:n_components])
+    explained_variance = s[:n_components]**2 / (n_cases - 1)
+    total_variance = sum_of_squares / (n_cases - 1)
+    return (mean, components, scores, explained_variance,
+            explained_variance / total_variance)
+
+
+def incremental_pca(path, n_components, block_size=256, jobs=1):
+    """Incremental PCA of the images of a memory-mapped stack.
+
+    Returns the same as `randomized_pca`.
+    """
+    n_cases = np.load(path, mmap_mode='r').shape[0]
+    # Every partial fit needs at least as many cases as components
+    blocks = case_blocks(n_cases, max(block_size, n_components))
+    if len(blocks) > 1 and blocks[-1][1] - blocks[-1][0] < n_components:
+        blocks[-2:] = [(blocks[-2][0], n_cases)]
+    pca = sklearn.decomposition.IncrementalPCA(n_components)
+    for start, stop in blocks:
+        pca.partial_fit(read_block(path, start, stop))
+
+    scores = np.concatenate([
+        p for p, _ in map_blocks(_block_project, path, blocks, jobs,
+                                 pca.mean_, pca.components_.T)])
+    components, scores = flip_signs(pca.components_, scores)
+    return (pca.mean_, components, scores, pca.explained_variance_,
+            pca.explained_variance_ratio_)
+
+
+methods = {
+    'randomized': randomized_pca,
+    'incremental': incremental_pca,
+}
+
+
+@click.command()
+@click.argument('cases', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.argument('components_out', type=click_utils.out_path)
+@click.argument('ev_dir', type=click.Path(file_okay=False))
+@click.argument('stacks', type=click_utils.in_path, nargs=-1, required=True)
+@click.option('--method', type=click.Choice(list(methods)),
+              default='randomized', help="PCA method.")
+@click.option('--n-components', default=100,
+              help="Number of eigenbreasts of each stack.")
+@click.option('--block-size', default=256,
+              help="Number of cases read at a time.")
+@click.option('-j', '--jobs', default=1, help="Number of processes.")
+@click.option('--seed', default=0, help="Seed of the randomized method.")
+def eigenbreasts(cases, out, components_out, ev_dir, stacks, method,
+                 n_components, block_size, jobs, seed):
+    """Compute the eigenbreasts of stacks of downsampled images."""
+    ev_dir = Path(ev_dir)
+    ev_paths = [ev_dir / f"expl_var_{Path(s).stem}.csv" for s in stacks]
+    with instrument.run('eigenbreasts.py', inputs=[cases] + list(stacks),
+                        outputs=[out, components_out] + ev_paths,
+                        n_components=n_components) as run:
+        case = read_cases(cases)
+        scores_ds = xr.Dataset(coords={'case': case})
+        components_ds = xr.Dataset()
+        ev_dir.mkdir(parents=True, exist_ok=True)
+
+        for path, ev_path in zip(stacks, ev_paths):
+            name = Path(path).stem
+            shape = np.load(path, mmap_mode='r').shape
+            if shape[0] != case.size:
+                raise click.ClickException(
+                    f"{path} has {shape[0]} images for {case.size} cases")
+            kwargs = {'seed': seed} if method == 'randomized' else {}
+            with run.stage(name, case=shape[0],
+                           pixel=int(np.prod(shape[1:]))):
+                mean, components, scores, ev, ev_ratio = methods[method](
+                    path, n_components, block_size, jobs, **kwargs)
+
+            pc = np.arange(1, ev.size + 1)
+            image_dims = ([f'{name}_y', f'{name}_x'] if len(shape) == 3
+                          else [f'{name}_pixel'])
+            scores_ds[name] = xr.DataArray(
+                scores.T, dims=['PC', 'case'],
+                coords={'PC': pc, 'case': case})
+            scores_ds[name].attrs['long_name'] = f"{name} eigenbreast score"
+            components_ds[f'{name}_mean'] = (image_dims,
+                                             mean.reshape(shape[1:]))
+            components_ds[name] = xr.DataArray(
+                components.reshape((-1,) + shape[1:]),
+                dims=['PC'] + image_dims, coords={'PC': pc})
+            components_ds[f'{name}_explained_variance'] = ('PC', ev)
+            components_ds[f'{name}_explained_variance_ratio'] = (
+                'PC', ev_ratio)
+            np.savetxt(ev_path, ev_ratio)
+
+        time_str = (datetime.utcnow()
+                    .replace(microsecond=0, tzinfo=timezone.utc)
+                    .isoformat())
+        for ds in (scores_ds, components_ds):
+            ds.attrs['method'] = method
+            ds.attrs['history'] = (
+                f"{time_str} eigenbreasts.py Computed {method} PCA of "
+                f"{', '.join(Path(s).name for s in stacks)}\n")
+            run.annotate(ds)
+        with run.stage('write'):
+            scores_ds.to_netcdf(out)
+            components_ds.to_netcdf(components_out)
+
+
+if __name__ == '__main__':
+    eigenbreasts()
@@ -6,6 +6,8 @@ import numpy as np
 import sklearn.decomposition
 import xarray as xr
 
+from lib import instrument
+
 
 def read_mri(data_set):
     data_set = data_set.copy()
@@ -78,25 +80,35 @@ def compute_factors(mri, n_components):
 @click.argument('out_filename', type=click.Path())
 def fa_mri_features(filename, out_filename, n_components):
     """Regress volume out of MRI features."""
-    mri_data_set = xr.open_dataset(filename).load()
-
-    mri = read_mri(mri_data_set)
-    mri = adjust_scale(mri)
-
-    factors, loadings = compute_factors(mri, n_components)
-
-    fa_data_set = xr.Dataset({'factors': factors, 'loadings': loadings})
-
-    time_str = (datetime.utcnow()
-                .replace(microsecond=0, tzinfo=timezone.utc)
-                .isoformat())
-    fa_data_set.attrs['history'] = (
-        "{time} fa_mri_features.py Factor analysis\n"
-        .format(time=time_str) +
-        mri_data_set.attrs['history']
-    )
-
-    fa_data_set.to_netcdf(out_filename)
+    with instrument.run('fa_mri_features.py', inputs=[filename],
+                        outputs=[out_filename],
+                        n_components=n_components) as run:
+        with run.stage('load'):
+            mri_data_set = xr.open_dataset(filename).load()
+
+        mri = read_mri(mri_data_set)
+        with run.stage('adjust_scale', **mri.sizes):
+            mri = adjust_scale(mri)
+
+        with run.stage('compute_factors', **mri.sizes):
+            factors, loadings = compute_factors(mri, n_components)
+
+        fa_data_set = xr.Dataset({'factors': factors, 'loadings': loadings})
+
+        time_str = (datetime.utcnow()
+                    .replace(microsecond=0, tzinfo=timezone.utc)
+                    .isoformat())
+        fa_data_set.attrs['history'] = (
+            "{time} fa_mri_features.py Factor analysis\n"
+            .format(time=time_str) +
+            mri_data_set.attrs['history']
+        )
+        fa_data_set.attrs['instrumentation'] = (
+            mri_data_set.attrs.get('instrumentation', ''))
+        run.annotate(fa_data_set)
+
+        with run.stage('write'):
+            fa_data_set.to_netcdf(out_filename)
 
 
 if __name__ == '__main__':
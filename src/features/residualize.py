@@ -0,0 +1,149 @@
+"""Regress covariates out of every feature of a data set.
+
+The covariates and their transformations are read from a YAML spec, like
+
+    covariates:
+      volume: cbrt
+
+All numeric variables along case, such as MRI features, factors or
+log2_cpm, are residualised in one batch. Features missing the same cases
+share one pivoted QR factorisation of the design, so a complete data set
+needs only one.
+"""
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import scipy.linalg
+import xarray as xr
+import yaml
+
+from lib import click_utils
+
+transforms = {
+    'identity': lambda x: x,
+    'log': np.log,
+    'log1p': np.log1p,
+    'sqrt': np.sqrt,
+    'cbrt': np.cbrt,
+}
+
+
+def read_spec(path):
+    """Covariates with the name of their transformation."""
+    with open(path) as f:
+        spec = yaml.safe_load(f)
+    covariates = spec['covariates']
+    for name, transform in covariates.items():
+        if transform not in transforms:
+            raise ValueError(f"Unknown transformation {transform} of "
+                             f"covariate {name}")
+    return covariates
+
+
+def design_matrix(covariates_ds, covariates, cases):
+    """Intercept and transformed covariates of the cases, NaN if missing."""
+    columns = [np.ones(len(cases))]
+    for name, transform in covariates.items():
+        values = covariates_ds[name].reindex(case=cases).values
+        columns.append(transforms[transform](values.astype(float)))
+    return np.column_stack(columns)
+
+
+def residualize(design, y):
+    """Residuals of the columns of y after least squares on the design.
+
+    Every column uses the cases where it and the design are finite.
+    Columns are grouped by these cases, so each group is solved with one
+    pivoted QR factorisation. Covariates that are constant or collinear in
+    the cases of a group are left out of its fit. Residuals of columns with
+    no more cases than terms in the design are NaN.
+    """
+    resid = np.full(y.shape, np.nan)
+    observed = np.isfinite(y) & np.isfinite(design).all(1)[:, np.newaxis]
+    patterns, group = np.unique(observed.T, axis=0, return_inverse=True)
+    group = group.ravel()
+    for g, rows in enumerate(patterns):
+        if rows.sum() <= design.shape[1]:
+            continue
+        x = design[rows]
+        q, r, _ = scipy.linalg.qr(x, mode='economic', pivoting=True)
+        # With pivoting the diagonal of r decreases, the columns of q past
+        # the rank span no direction of the design
+        diag = np.abs(np.diag(r))
+        tol = diag[0] * max(x.shape) * np.finfo(float).eps
+        q = q[:, :np.count_nonzero(diag > tol)]
+        cols = np.flatnonzero(group == g)
+        y_g = y[np.ix_(rows, cols)]
+        resid[np.ix_(rows, cols)] = y_g - q @ (q.T @ y_g)
+
+        # Check results
+        check = y_g[:, :10]
+        coef = np.linalg.lstsq(x, check, rcond=None)[0]
+        assert np.allclose(resid[np.ix_(rows, cols[:10])],
+                           check - x @ coef), (
+            "Residuals differ from least squares")
+    return resid
+
+
+def residualize_dataset(ds, design, exclude=()):
+    """Data set with its numeric case variables residualised.
+
+    All variables are solved as one matrix of columns. Variables in
+    `exclude` are dropped, other variables are kept as they are.
+    """
+    names = [name for name, v in ds.data_vars.items()
+             if 'case' in v.dims and v.dtype.kind == 'f' and
+             name not in exclude]
+    blocks = [ds[name].transpose(
+        'case', *[d for d in ds[name].dims if d != 'case'])
+        for name in names]
+    n_cases = ds.sizes['case']
+    y = np.concatenate([b.values.reshape(n_cases, -1) for b in blocks],
+                       axis=1)
+    resid = residualize(design, y)
+
+    out = ds.copy()
+    for name in exclude:
+        del out[name]
+    start = 0
+    for name, block in zip(names, blocks):
+        size = block[0].size
+        values = resid[:, start:start + size].reshape(block.shape)
+        out[name] = xr.DataArray(values, block.coords, block.dims,
+                                 attrs=block.attrs).transpose(*ds[name].dims)
+        start += size
+    return out
+
+
+@click.command()
+@click.argument('data', type=click_utils.in_path)
+@click.argument('covariates', type=click_utils.in_path)
+@click.argument('spec', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+def residualize_features(data, covariates, spec, out):
+    """Regress covariates out of all features of a data set."""
+    covariate_spec = read_spec(spec)
+    ds = xr.open_dataset(data).load()
+    covariates_ds = xr.open_dataset(covariates).load()
+    design = design_matrix(covariates_ds, covariate_spec, ds['case'].values)
+
+    # The covariates themselves have nothing left to analyse
+    exclude = [name for name in covariate_spec if name in ds.data_vars]
+    residuals = residualize_dataset(ds, design, exclude)
+
+    residuals.attrs['covariates'] = ", ".join(
+        f"{t}({name})" if t != 'identity' else name
+        for name, t in covariate_spec.items())
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    residuals.attrs['history'] = (
+        f"{time_str} residualize.py Regressed {residuals.attrs['covariates']}"
+        f" from {covariates} out of all features\n" +
+        ds.attrs.get('history', ''))
+    residuals.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    residualize_features()
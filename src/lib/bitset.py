@@ -0,0 +1,96 @@
+import numpy as np
+
+word_bits = 64
+
+_m1 = np.uint64(0x5555555555555555)
+_m2 = np.uint64(0x3333333333333333)
+_m4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_h01 = np.uint64(0x0101010101010101)
+
+
+def n_words(n_bits):
+    return (n_bits + word_bits - 1) // word_bits
+
+
+def from_indices(rows, cols, n_rows, n_bits):
+    """Packed bitsets with bit `cols[i]` set in row `rows[i]`.
+
+    Bit i of a bitset is bit i % 64 of word i // 64.
+    """
+    bits = np.zeros((n_rows, n_words(n_bits)), dtype='uint64')
+    cols = np.asarray(cols, dtype='uint64')
+    np.bitwise_or.at(
+        bits,
+        (np.asarray(rows, dtype='int64'),
+         (cols // np.uint64(word_bits)).astype('int64')),
+        np.left_shift(np.uint64(1), cols % np.uint64(word_bits)),
+    )
+    return bits
+
+
+def from_csr(matrix):
+    """Packed bitsets of the rows of a boolean CSR matrix."""
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return from_indices(rows, matrix.indices, matrix.shape[0],
+                        matrix.shape[1])
+
+
+def to_bool(bits, n_bits):
+    bytes_ = bits.astype('<u8').view('uint8').reshape(bits.shape[0], -1)
+    return np.unpackbits(bytes_, axis=1)[:, _bit_order(bytes_.shape[1])][
+        :, :n_bits].astype('bool')
+
+
+def _bit_order(n_bytes):
+    # unpackbits is big endian within a byte, our bitsets little endian
+    return (np.arange(n_bytes * 8).reshape(-1, 8)[:, ::-1]).ravel()
+
+
+def popcount(words):
+    """Number of set bits in every element of a uint64 array."""
+    x = np.asarray(words, dtype='uint64')
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype('int64')
+    x = x - ((x >> np.uint64(1)) & _m1)
+    x = (x & _m2) + ((x >> np.uint64(2)) & _m2)
+    x = (x + (x >> np.uint64(4))) & _m4
+    return ((x * _h01) >> np.uint64(56)).astype('int64')
+
+
+def cardinality(bits):
+    return popcount(bits).sum(axis=-1)
+
+
+def intersection_counts(a, b=None, block_size=64, max_bytes=2**25):
+    """Matrix of |a_i & b_j| for all pairs of bitsets.
+
+    Blocks of `block_size` bitsets of `a` are intersected with as many
+    bitsets of `b` at a time as fit in a temporary of `max_bytes`.
+    """
+    if b is None:
+        b = a
+    # Words that are empty in every bitset do not contribute
+    used = np.any(a != 0, axis=0) & np.any(b != 0, axis=0)
+    a = a[:, used]
+    b = b[:, used]
+    counts = np.zeros((a.shape[0], b.shape[0]), dtype='int64')
+    b_block_size = max(1, max_bytes // (8 * block_size * max(1, a.shape[1])))
+    for start in range(0, a.shape[0], block_size):
+        stop = min(start + block_size, a.shape[0])
+        for b_start in range(0, b.shape[0], b_block_size):
+            b_stop = min(b_start + b_block_size, b.shape[0])
+            counts[start:stop, b_start:b_stop] = popcount(
+                a[start:stop, np.newaxis, :] &
+                b[np.newaxis, b_start:b_stop, :]).sum(-1)
+    return counts
+
+
+def jaccard(a, b=None, block_size=64, max_bytes=2**25):
+    """Pairwise Jaccard similarity of two sets of packed bitsets."""
+    if b is None:
+        b = a
+    inter = intersection_counts(a, b, block_size, max_bytes)
+    union = cardinality(a)[:, np.newaxis] + cardinality(b)[np.newaxis, :] \
+        - inter
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, inter / union, 0.0)
@@ -0,0 +1,167 @@
+"""Ensembl gene reference as a typed, compressed NetCDF file.
+
+The reference has one row per BioMart row, sorted by Ensembl gene ID so
+the rows of a gene are found by binary search. `hgnc_id_order` and
+`entrezgene_order` sort the rows by those IDs for lookups the other way.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# BioMart attribute, column header in the TSV export, type
+columns = [
+    ('ensembl_gene_id', 'Ensembl Gene ID', str),
+    ('chromosome_name', 'Chromosome Name', str),
+    ('start_position', 'Gene Start (bp)', int),
+    ('end_position', 'Gene End (bp)', int),
+    ('strand', 'Strand', int),
+    ('entrezgene', 'EntrezGene ID', int),
+    ('hgnc_symbol', 'HGNC symbol', str),
+    ('hgnc_id', 'HGNC ID(s)', str),
+]
+attributes = [name for name, _, _ in columns]
+
+# Value of missing integers
+int_fill = -1
+
+_index_fields = ['hgnc_id', 'entrezgene']
+
+
+class BiomartError(Exception):
+    pass
+
+
+def parse_tsv(lines):
+    """Parse BioMart TSV lines into columns as they are read.
+
+    The header may have the attribute names or the display names of the
+    BioMart export, columns other than the Ensembl gene ID are optional.
+    """
+    lines = iter(lines)
+    header = next(lines, '').rstrip('\r\n')
+    if header.startswith('Query ERROR'):
+        raise BiomartError(header)
+    names = header.split('\t')
+    by_header = {h: (name, kind) for name, h, kind in columns}
+    by_header.update({name: (name, kind) for name, _, kind in columns})
+    fields = [by_header.get(n, (None, None)) for n in names]
+    if 'ensembl_gene_id' not in {name for name, _ in fields}:
+        raise BiomartError(f"No Ensembl gene ID in header: {header}")
+
+    values = {name: [] for name in attributes}
+    n_rows = 0
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        for (name, kind), value in zip(fields, line.split('\t')):
+            if name is None:
+                continue
+            if kind is int:
+                value = int(value) if value else int_fill
+            values[name].append(value)
+        n_rows += 1
+    # Columns absent from the export are missing for every row
+    for name, _, kind in columns:
+        if not values[name]:
+            values[name] = [int_fill if kind is int else ''] * n_rows
+    return values
+
+
+def to_dataset(values):
+    """Reference data set sorted by gene, with indexes of the other IDs."""
+    arrays = dict()
+    for name, _, kind in columns:
+        if kind is int:
+            arrays[name] = np.array(values[name], dtype='int64')
+        else:
+            arrays[name] = np.array(values[name], dtype=object)
+    order = np.lexsort((arrays['entrezgene'],
+                        arrays['ensembl_gene_id'].astype(str)))
+
+    ds = xr.Dataset()
+    for name, header, kind in columns:
+        ds[name] = ('row', arrays[name][order])
+        ds[name].attrs['long_name'] = header
+    for name in _index_fields:
+        key = ds[name].values
+        if key.dtype == object:
+            key = key.astype(str)
+        ds[f'{name}_order'] = ('row', np.argsort(key, kind='mergesort'))
+    ds['strand'] = ds['strand'].astype('int8')
+    return ds
+
+
+def write_reference(ds, path):
+    encoding = dict()
+    for name in ds.data_vars:
+        encoding[name] = {'zlib': True, 'complevel': 4}
+        if ds[name].dtype == object:
+            # Fixed width characters compress, variable length strings not
+            encoding[name].update(dtype='S1', _Encoding='utf-8')
+        elif name in attributes:
+            encoding[name]['_FillValue'] = int_fill
+    ds.to_netcdf(str(path), encoding=encoding)
+
+
+def read_reference(path):
+    """Reference from a NetCDF file, or from a BioMart TSV export."""
+    path = Path(path)
+    if path.suffix == '.nc':
+        with xr.open_dataset(str(path), mask_and_scale=False) as ds:
+            return ds.load()
+    with path.open() as f:
+        return to_dataset(parse_tsv(f))
+
+
+def gene_rows(ref, genes):
+    """First and one past the last row of every Ensembl gene ID."""
+    ids = ref['ensembl_gene_id'].values.astype(str)
+    genes = np.asarray(genes).astype(str)
+    return (np.searchsorted(ids, genes, side='left'),
+            np.searchsorted(ids, genes, side='right'))
+
+
+def unique_by_gene(ref, name, genes, missing):
+    """Value of `name` of each gene, `missing` if absent or ambiguous.
+
+    Like the TSV export, a missing value counts as a value of its own, so
+    a gene with rows with and without an ID has no unique ID.
+    """
+    values = ref[name].values
+    start, end = gene_rows(ref, genes)
+    found = end > start
+    result = np.full(len(start), missing, dtype=values.dtype)
+    if not found.any():
+        return result
+    differs = np.concatenate([[0], np.cumsum(values[1:] != values[:-1])])
+    first = start[found]
+    last = end[found] - 1
+    unique = differs[last] == differs[first]
+    first_value = values[first]
+    result[np.where(found)[0][unique]] = first_value[unique]
+    return result
+
+
+def rows_with(ref, name, keys):
+    """Rows with each of `keys` as `name`, found through its index."""
+    order = ref[f'{name}_order'].values
+    values = ref[name].values[order]
+    if values.dtype == object:
+        values = values.astype(str)
+        keys = np.asarray(keys).astype(str)
+    start = np.searchsorted(values, keys, side='left')
+    end = np.searchsorted(values, keys, side='right')
+    return [np.sort(order[s:e]) for s, e in zip(start, end)]
+
+
+def to_frame(ref):
+    """Reference as a data frame with the columns of the TSV export.
+
+    Missing integers are -1, missing strings empty.
+    """
+    return pd.DataFrame({header: ref[name].values
+                         for name, header, _ in columns},
+                        columns=[header for _, header, _ in columns])
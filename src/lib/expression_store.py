@@ -0,0 +1,273 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+layouts = ('case-major', 'gene-major')
+
+index_keys = {
+    'gene': 'ensembl',
+    'entrez_gene_id': 'entrez',
+    'hgnc_symbol': 'hgnc',
+}
+
+_index_dtype = np.dtype([('hash', '<u8'), ('row', '<i8')])
+
+
+def _key_hash(key):
+    h = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    # Zero marks an empty slot
+    return int.from_bytes(h, 'little') or 1
+
+
+def entrez_gene_ids(data_set):
+    """Entrez IDs as int64, with -1 for genes without one.
+
+    The variable has a _FillValue of -1, so xarray decodes it as float
+    with NaN for missing IDs.
+    """
+    return data_set['entrez_gene_id'].fillna(-1).values.astype('int64')
+
+
+def hgnc_symbols(data_set):
+    """HGNC symbols as str, with '' for genes without one."""
+    return np.array(['' if isinstance(s, float) or s is None else str(s)
+                     for s in data_set['hgnc_symbol'].values], dtype=object)
+
+
+def build_index(keys):
+    """Open addressing hash table mapping keys to their rows."""
+    n_slots = 1 << max(4, int(2 * len(keys)).bit_length())
+    table = np.zeros(n_slots, dtype=_index_dtype)
+    mask = n_slots - 1
+    for row, key in enumerate(keys):
+        if key in ('', -1, None):
+            continue
+        h = _key_hash(key)
+        slot = h & mask
+        while table['hash'][slot] != 0:
+            slot = (slot + 1) & mask
+        table[slot] = (h, row)
+    return table
+
+
+def lookup_index(table, key):
+    h = _key_hash(key)
+    mask = len(table) - 1
+    slot = h & mask
+    rows = []
+    while True:
+        slot_hash, row = table[slot]
+        if slot_hash == 0:
+            return rows
+        if slot_hash == h:
+            rows.append(int(row))
+        slot = (slot + 1) & mask
+
+
+def _raw_path(path, var, layout):
+    return path / f"{var}.{layout}.bin"
+
+
+def write_store(data_set, path, block_size=1024):
+    """Write case x gene variables of `data_set` as raw memory maps."""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    variables = [v for v, da in data_set.data_vars.items()
+                 if set(da.dims) == {'case', 'gene'}]
+    n_case = data_set['case'].size
+    n_gene = data_set['gene'].size
+
+    meta = {
+        'shape': [n_case, n_gene],
+        'variables': {},
+        'attrs': {k: str(v) for k, v in data_set.attrs.items()},
+    }
+    for var in variables:
+        da = data_set[var].transpose('case', 'gene')
+        dtype = da.dtype.newbyteorder('<')
+        meta['variables'][var] = {
+            'dtype': dtype.str,
+            'attrs': {k: str(v) for k, v in da.attrs.items()},
+        }
+
+        case_major = np.memmap(_raw_path(path, var, 'case-major'), dtype,
+                               'w+', shape=(n_case, n_gene))
+        for start in range(0, n_case, block_size):
+            stop = min(start + block_size, n_case)
+            case_major[start:stop, :] = da[start:stop, :].values
+        case_major.flush()
+        del case_major
+
+        gene_major = np.memmap(_raw_path(path, var, 'gene-major'), dtype,
+                               'w+', shape=(n_gene, n_case))
+        for start in range(0, n_gene, block_size):
+            stop = min(start + block_size, n_gene)
+            gene_major[start:stop, :] = da[:, start:stop].values.T
+        gene_major.flush()
+        del gene_major
+
+    keys = {
+        'gene': data_set['gene'].values.astype('U'),
+        'entrez_gene_id': entrez_gene_ids(data_set).astype('<i8'),
+        'hgnc_symbol': hgnc_symbols(data_set).astype('U'),
+    }
+    np.save(path / 'case.npy', data_set['case'].values.astype('<i8'))
+    for coord, index_name in index_keys.items():
+        np.save(path / f"{coord}.npy", keys[coord])
+        table = build_index(keys[coord].tolist())
+        np.save(path / f"index-{index_name}.npy", table)
+
+    with (path / 'store.json').open('w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Check that genes are found by their identifiers
+    store = ExpressionStore(path)
+    for coord, values in keys.items():
+        found = [row for row, key in enumerate(values.tolist())
+                 if key not in ('', -1)][:10]
+        rows = [store.gene_rows(values[row], by=coord) for row in found]
+        assert all(row in r for row, r in zip(found, rows)), (
+            f"Genes not found by {coord} in {path}")
+
+
+class ExpressionStore:
+    """Gene expression matrices stored as raw little-endian memory maps.
+
+    Variables are accessed by name and behave like a minimal
+    `xarray.DataArray`, e.g. ``store['log2_cpm'].sel(hgnc_symbol=['ESR1'])``.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with (self.path / 'store.json').open() as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta['shape'])
+        self.attrs = self.meta['attrs']
+        self._labels = dict()
+        self._indexes = dict()
+        self._case_rows = None
+
+    @property
+    def variables(self):
+        return list(self.meta['variables'])
+
+    def __contains__(self, var):
+        return var in self.meta['variables']
+
+    def __getitem__(self, var):
+        if var not in self:
+            raise KeyError(var)
+        return StoreArray(self, var)
+
+    def labels(self, name):
+        if name not in self._labels:
+            self._labels[name] = np.load(self.path / f"{name}.npy",
+                                         mmap_mode='r')
+        return self._labels[name]
+
+    def raw(self, var, layout):
+        if layout not in layouts:
+            raise ValueError("layout must be one of {" +
+                             ",".join(layouts) + "}")
+        var_meta = self.meta['variables'][var]
+        n_case, n_gene = self.shape
+        shape = (n_case, n_gene) if layout == 'case-major' else (n_gene,
+                                                                 n_case)
+        return np.memmap(_raw_path(self.path, var, layout),
+                         np.dtype(var_meta['dtype']), 'r', shape=shape)
+
+    def gene_rows(self, keys, by='gene'):
+        if by not in index_keys:
+            raise ValueError("by must be one of {" +
+                             ",".join(index_keys) + "}")
+        index_name = index_keys[by]
+        if index_name not in self._indexes:
+            self._indexes[index_name] = np.load(
+                self.path / f"index-{index_name}.npy", mmap_mode='r')
+        table = self._indexes[index_name]
+        rows = []
+        for key in np.atleast_1d(keys):
+            key_rows = lookup_index(table, key)
+            if len(key_rows) == 0:
+                raise KeyError(f"{by} {key} not in expression store")
+            rows.extend(sorted(key_rows))
+        return np.array(rows, dtype='int64')
+
+    def case_rows(self, cases):
+        if self._case_rows is None:
+            self._case_rows = {c: i for i, c in
+                               enumerate(self.labels('case').tolist())}
+        try:
+            return np.array([self._case_rows[int(c)]
+                             for c in np.atleast_1d(cases)], dtype='int64')
+        except KeyError as e:
+            raise KeyError(f"case {e.args[0]} not in expression store")
+
+
+class StoreArray:
+
+    def __init__(self, store, var):
+        self.store = store
+        self.name = var
+        self.dims = ('case', 'gene')
+        self.shape = store.shape
+        self.dtype = np.dtype(store.meta['variables'][var]['dtype'])
+        self.attrs = store.meta['variables'][var]['attrs']
+
+    def sel(self, case=None, gene=None, entrez_gene_id=None,
+            hgnc_symbol=None):
+        gene_sel = [(k, v) for k, v in [('gene', gene),
+                                        ('entrez_gene_id', entrez_gene_id),
+                                        ('hgnc_symbol', hgnc_symbol)]
+                    if v is not None]
+        if len(gene_sel) > 1:
+            raise ValueError("Select genes by only one identifier")
+        gene_rows = None
+        if gene_sel:
+            gene_rows = self.store.gene_rows(gene_sel[0][1], by=gene_sel[0][0])
+        case_rows = None
+        if case is not None:
+            case_rows = self.store.case_rows(case)
+        return self.isel(case=case_rows, gene=gene_rows)
+
+    def isel(self, case=None, gene=None):
+        if gene is not None:
+            # Each gene is one contiguous row in the gene-major layout
+            gene = np.atleast_1d(gene)
+            values = self.store.raw(self.name, 'gene-major')[gene, :].T
+            if case is not None:
+                values = values[np.atleast_1d(case), :]
+        elif case is not None:
+            case = np.atleast_1d(case)
+            values = self.store.raw(self.name, 'case-major')[case, :]
+        else:
+            values = np.array(self.store.raw(self.name, 'case-major'))
+
+        gene_idx = slice(None) if gene is None else gene
+        case_idx = slice(None) if case is None else case
+        labels = self.store.labels
+        return xr.DataArray(
+            np.asarray(values),
+            dims=self.dims,
+            coords={
+                'case': np.asarray(labels('case')[case_idx]),
+                'gene': np.asarray(labels('gene')[gene_idx], dtype=object),
+                'entrez_gene_id': ('gene', np.asarray(
+                    labels('entrez_gene_id')[gene_idx])),
+                'hgnc_symbol': ('gene', np.asarray(
+                    labels('hgnc_symbol')[gene_idx], dtype=object)),
+            },
+            name=self.name,
+            attrs=self.attrs,
+        )
+
+    def load(self):
+        return self.isel()
+
+
+def open_store(path):
+    return ExpressionStore(path)
@@ -0,0 +1,150 @@
+from collections import namedtuple
+import hashlib
+import io
+from pathlib import Path
+import zipfile
+
+import numpy as np
+import scipy.sparse
+
+msigdb_gmt_dir = ("msigdb_v5.2_files_to_download_locally/"
+                  "msigdb_v5.2_GMTs/")
+
+
+GeneSetMatrix = namedtuple('GeneSetMatrix', ['membership', 'gene_sets',
+                                             'genes'])
+GeneSetMatrix.__doc__ = """Gene set x gene membership matrix.
+
+membership is a boolean CSR matrix with one row per gene set and one
+column per gene, in the order of the gene index it was aligned to.
+"""
+
+
+def gmt_member_name(collection, gene_ids='entrez', version='5.2'):
+    return f"{msigdb_gmt_dir}{collection}.v{version}.{gene_ids}.gmt"
+
+
+def iter_gmt(zip_path, collection, gene_ids='entrez'):
+    """Stream (name, description, members) from a GMT inside the zip."""
+    with zipfile.ZipFile(str(zip_path)) as zf:
+        with zf.open(gmt_member_name(collection, gene_ids)) as raw:
+            for line in io.TextIOWrapper(raw, encoding='utf-8'):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 2:
+                    continue
+                yield fields[0], fields[1], [f for f in fields[2:] if f]
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def gene_index_hash(genes):
+    h = hashlib.sha256()
+    for g in genes:
+        h.update(str(g).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def build_gene_set_matrix(gmt_records, gene_keys, genes=None, min_size=15,
+                          max_size=500):
+    """Align gene set members to `gene_keys` and apply size filters.
+
+    `gene_keys` holds the identifier used in the GMT for every gene in the
+    index, `genes` the labels of the matrix columns. Set sizes are counted
+    after matching members to the gene index. A member that maps to several
+    genes in the index marks all of them. Genes with an empty key are in
+    no gene set.
+    """
+    if genes is None:
+        genes = gene_keys
+    gene_cols = dict()
+    for col, g in enumerate(gene_keys):
+        if g != '':
+            gene_cols.setdefault(str(g), []).append(col)
+
+    names = []
+    indptr = [0]
+    indices = []
+    for name, _, members in gmt_records:
+        cols = sorted({c for m in members for c in gene_cols.get(m, [])})
+        if len(cols) < min_size or len(cols) > max_size:
+            continue
+        names.append(name)
+        indices.extend(cols)
+        indptr.append(len(indices))
+
+    membership = scipy.sparse.csr_matrix(
+        (np.ones(len(indices), dtype='bool'),
+         np.array(indices, dtype='int32'),
+         np.array(indptr, dtype='int64')),
+        shape=(len(names), len(genes)),
+    )
+    return GeneSetMatrix(membership, np.array(names, dtype=object),
+                         np.asarray(genes))
+
+
+def save_gene_set_matrix(gsm, path, **attrs):
+    np.savez_compressed(
+        str(path),
+        indptr=gsm.membership.indptr,
+        indices=gsm.membership.indices,
+        shape=np.array(gsm.membership.shape),
+        gene_sets=gsm.gene_sets.astype('U'),
+        genes=gsm.genes.astype('U'),
+        **{f"attr_{k}": np.array(v) for k, v in attrs.items()}
+    )
+
+
+def load_gene_set_matrix(path):
+    with np.load(str(path)) as f:
+        membership = scipy.sparse.csr_matrix(
+            (np.ones(len(f['indices']), dtype='bool'), f['indices'],
+             f['indptr']),
+            shape=tuple(f['shape']),
+        )
+        return GeneSetMatrix(membership, f['gene_sets'].astype(object),
+                             f['genes'].astype(object))
+
+
+def _cached_attr(path, name):
+    with np.load(str(path)) as f:
+        key = f"attr_{name}"
+        return str(f[key]) if key in f else None
+
+
+def gene_set_matrix(zip_path, collection, gene_keys, genes=None,
+                    cache_dir=None, gene_ids='entrez', min_size=15,
+                    max_size=500):
+    """Gene set matrix of an MSigDB collection, cached on disk.
+
+    The cache is keyed by the hash of the zip archive, the hash of the
+    gene index and the size filters.
+    """
+    gene_keys = np.asarray(gene_keys)
+    genes = gene_keys if genes is None else np.asarray(genes)
+    if cache_dir is None:
+        return build_gene_set_matrix(
+            iter_gmt(zip_path, collection, gene_ids), gene_keys, genes,
+            min_size, max_size)
+
+    key = hashlib.sha256("\0".join([
+        file_hash(zip_path), gene_index_hash(gene_keys),
+        gene_index_hash(genes), collection, gene_ids, str(min_size),
+        str(max_size),
+    ]).encode()).hexdigest()
+    cache_dir = Path(cache_dir)
+    cache_path = cache_dir / f"{collection}.{gene_ids}.{key[:16]}.npz"
+    if cache_path.exists() and _cached_attr(cache_path, 'key') == key:
+        return load_gene_set_matrix(cache_path)
+
+    gsm = build_gene_set_matrix(iter_gmt(zip_path, collection, gene_ids),
+                                gene_keys, genes, min_size, max_size)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    save_gene_set_matrix(gsm, cache_path, key=key)
+    return gsm
@@ -0,0 +1,252 @@
+"""Wall time, CPU time and peak memory of processing scripts and stages.
+
+On success every output of a run gets an `<output>.instrumentation.json`
+with all stages. `Run.annotate` prepends a compact summary of the stages
+to the `instrumentation` attribute of a data set. Run as a script, it
+records an external command such as an R script in the same way.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import click
+
+_status_path = Path('/proc/self/status')
+_clear_refs_path = Path('/proc/self/clear_refs')
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process, if the kernel allows it."""
+    try:
+        with _clear_refs_path.open('w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Peak resident set size in bytes since the last reset."""
+    try:
+        with _status_path.open() as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _children_peak_rss():
+    """Peak RSS of the largest finished child, not of all together."""
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _tree_rss(pid):
+    """Resident set size in bytes of a process and all its descendants."""
+    children = dict()
+    rss = dict()
+    for status_path in Path('/proc').glob('[0-9]*/status'):
+        try:
+            with status_path.open() as f:
+                fields = dict(line.split(':', 1) for line in f
+                              if line.startswith(('PPid:', 'VmRSS:')))
+        except OSError:
+            continue
+        p = int(status_path.parent.name)
+        children.setdefault(int(fields['PPid']), []).append(p)
+        # Kernel threads have no VmRSS
+        rss[p] = int(fields.get('VmRSS', '0 kB').split()[0]) * 1024
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        total += rss.get(p, 0)
+        stack.extend(children.get(p, []))
+    return total
+
+
+def call_tree_peak_rss(command, interval=0.2):
+    """Exit code of a command and the peak RSS of its process tree.
+
+    Forked workers, such as those of doMC, run concurrently, so their peak
+    is that of their sum. The tree is sampled every `interval` seconds,
+    shorter peaks are missed.
+    """
+    process = subprocess.Popen(command)
+    peak = 0
+    while process.poll() is None:
+        if _status_path.exists():
+            peak = max(peak, _tree_rss(process.pid))
+        time.sleep(interval)
+    return process.returncode, peak
+
+
+def _cpu_time():
+    """CPU time of this process and its finished children."""
+    usage = [resource.getrusage(who) for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def path_size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    if path.exists():
+        return path.stat().st_size
+    return None
+
+
+def json_path(output):
+    output = Path(output)
+    return output.with_name(output.name + '.instrumentation.json')
+
+
+class _Stage:
+
+    def __init__(self, name, parent, sizes):
+        self.name = name
+        self.parent = parent
+        self.sizes = sizes
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_rss = 0
+        self._start_wall = time.perf_counter()
+        self._start_cpu = _cpu_time()
+
+    def elapsed(self):
+        return (time.perf_counter() - self._start_wall,
+                _cpu_time() - self._start_cpu)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'parent': self.parent.name if self.parent else None,
+            'wall_s': self.wall_s,
+            'cpu_s': self.cpu_s,
+            'peak_rss_bytes': self.peak_rss,
+            'sizes': self.sizes,
+        }
+
+
+class Run:
+    """Stages of one script run."""
+
+    def __init__(self, script, inputs=(), outputs=()):
+        self.script = script
+        self.inputs = [str(p) for p in inputs]
+        self.outputs = [str(p) for p in outputs]
+        self.start_time = (datetime.utcnow()
+                           .replace(microsecond=0, tzinfo=timezone.utc)
+                           .isoformat())
+        self.stages = []
+        self._stack = []
+        # Without a resettable peak, peaks are those of the whole process
+        self.per_stage_peak = _reset_peak_rss()
+
+    def _update_peak(self):
+        """Fold the current peak into all running stages and reset it."""
+        peak = _peak_rss()
+        for stage in self._stack:
+            stage.peak_rss = max(stage.peak_rss, peak)
+        if self.per_stage_peak:
+            _reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name, **sizes):
+        """Measure a named stage, `sizes` records the size of its inputs."""
+        self._update_peak()
+        parent = self._stack[-1] if self._stack else None
+        stage = _Stage(name, parent, {k: int(v) for k, v in sizes.items()})
+        self._stack.append(stage)
+        try:
+            yield stage
+        finally:
+            self._update_peak()
+            stage.wall_s, stage.cpu_s = stage.elapsed()
+            self._stack.pop()
+            self.stages.append(stage)
+
+    def summary(self):
+        """One line per stage, the running stages with their time so far."""
+        lines = []
+        for stage in self.stages + self._stack[::-1]:
+            wall_s, cpu_s = (stage.wall_s, stage.cpu_s)
+            if wall_s is None:
+                wall_s, cpu_s = stage.elapsed()
+            lines.append(
+                f"{self.start_time} {self.script} {stage.name} "
+                f"wall={wall_s:.1f}s cpu={cpu_s:.1f}s "
+                f"peak_rss={stage.peak_rss / 2**20:.0f}MiB\n")
+        return ''.join(lines)
+
+    def annotate(self, data_set):
+        """Prepend the stage summary to the instrumentation attribute."""
+        self._update_peak()
+        data_set.attrs['instrumentation'] = (
+            self.summary() + data_set.attrs.get('instrumentation', ''))
+
+    def to_dict(self):
+        return {
+            'script': self.script,
+            'argv': sys.argv,
+            'host': platform.node(),
+            'pid': os.getpid(),
+            'start_time': self.start_time,
+            'peak_rss_scope': 'stage' if self.per_stage_peak else 'process',
+            'inputs': {p: path_size(p) for p in self.inputs},
+            'outputs': {p: path_size(p) for p in self.outputs},
+            'stages': [s.to_dict() for s in self.stages],
+        }
+
+    def write(self):
+        record = self.to_dict()
+        for output in self.outputs:
+            with json_path(output).open('w') as f:
+                json.dump(record, f, indent=2)
+                f.write('\n')
+
+
+@contextmanager
+def run(script, inputs=(), outputs=(), **sizes):
+    """Instrument the main body of a script as the stage 'total'."""
+    r = Run(script, inputs, outputs)
+    with r.stage('total', **sizes):
+        yield r
+    r.write()
+
+
+@click.command(context_settings={'ignore_unknown_options': True})
+@click.option('--script', required=True, help="Name of the run.")
+@click.option('-i', '--input', 'inputs', multiple=True)
+@click.option('-o', '--output', 'outputs', multiple=True)
+@click.option('--size', 'sizes', multiple=True, metavar='NAME=VALUE',
+              help="Size of the inputs, such as perms=1000.")
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+def instrument_command(script, inputs, outputs, sizes, command):
+    """Run a command and record its time and peak memory."""
+    sizes = dict(s.split('=', 1) for s in sizes)
+    with run(script, inputs, outputs, **sizes) as r:
+        returncode, tree_peak_rss = call_tree_peak_rss(command)
+        if returncode != 0:
+            sys.exit(returncode)
+        # The sampled peak of the tree of the command, at least that of its
+        # largest process
+        stage = r._stack[-1]
+        stage.peak_rss = max(stage.peak_rss, tree_peak_rss,
+                             _children_peak_rss())
+
+
+if __name__ == '__main__':
+    instrument_command()
@@ -0,0 +1,35 @@
+"""Modules that are imported on first use.
+
+Command line scripts import plotting and statistics libraries that take
+a large part of a second each to load. Importing them lazily keeps
+`--help` and argument errors fast, and only the code that runs pays for
+the modules it uses.
+"""
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        # Later lookups find the attributes without calling __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Module `name`, imported when one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
+
+
+def is_instance(obj, module, name):
+    """isinstance of a class of a module, without importing the module.
+
+    An object can only be an instance if its module was imported already.
+    """
+    mod = sys.modules.get(module)
+    return mod is not None and isinstance(obj, getattr(mod, name))
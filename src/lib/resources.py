@@ -0,0 +1,202 @@
+"""Peak memory and runtime of workflow rules predicted from input sizes.
+
+Each rule is modelled as `intercept + sum(coef * product of sizes)` over a
+few terms, such as case x gene. Sizes are read from the NetCDF headers of
+the inputs, gene set files and rule parameters, so a prediction does not
+load any data. The coefficients live in config/resources.yaml and are
+calibrated from instrumentation records of earlier runs.
+"""
+import json
+from pathlib import Path
+
+import click
+import netCDF4
+import numpy as np
+import scipy.optimize
+import yaml
+
+# Dimensions along which MRI features are stored in the various data sets
+_mri_feature_dims = ('mri_feature', 'factor', 'cad_feature')
+
+
+def netcdf_sizes(path):
+    """Dimension sizes of a NetCDF file, read from its header."""
+    with netCDF4.Dataset(str(path)) as ds:
+        sizes = {name: len(dim) for name, dim in ds.dimensions.items()}
+        n_case_vars = sum(1 for v in ds.variables.values()
+                          if v.dimensions == ('case',) and
+                          v.dtype != str and v.dtype.kind == 'f')
+    feature_dims = [d for d in _mri_feature_dims if d in sizes]
+    if feature_dims:
+        sizes['mri_feature'] = sizes[feature_dims[0]]
+    elif 'case' in sizes and n_case_vars > 0:
+        # MRI features stored as one variable per feature
+        sizes['mri_feature'] = n_case_vars
+    return sizes
+
+
+def gene_set_sizes(path):
+    path = Path(path)
+    if path.suffix == '.gmt':
+        with path.open() as f:
+            return {'gene_set': sum(1 for _ in f)}
+    if path.suffix == '.npz':
+        with np.load(str(path)) as f:
+            return {'gene_set': int(f['shape'][0]),
+                    'gene': int(f['shape'][1])}
+    return {}
+
+
+def input_sizes(paths):
+    """Sizes of all inputs, the largest size of each dimension."""
+    sizes = {'input_bytes': 0}
+    for path in paths:
+        path = Path(path)
+        if not path.exists():
+            continue
+        if path.is_file():
+            sizes['input_bytes'] += path.stat().st_size
+        if path.suffix == '.nc':
+            file_sizes = netcdf_sizes(path)
+        elif path.suffix in ('.gmt', '.npz'):
+            file_sizes = gene_set_sizes(path)
+        else:
+            continue
+        for k, v in file_sizes.items():
+            sizes[k] = max(sizes.get(k, 0), v)
+    return sizes
+
+
+def term_values(terms, sizes):
+    """Products of the sizes in each term, None if a size is unknown."""
+    values = []
+    for term in terms:
+        if not all(d in sizes for d in term):
+            return None
+        values.append(float(np.prod([sizes[d] for d in term])))
+    return np.array(values)
+
+
+class ResourceModel:
+
+    def __init__(self, config):
+        self.config = config
+        self.rules = config['rules']
+        self.margin = config.get('margin', 1.0)
+        for rule in self.rules:
+            for resource in ('mem_mb', 'runtime'):
+                coefs = self.rules[rule].get(resource)
+                n_terms = len(self._terms(rule, resource))
+                if coefs is not None and len(coefs) != 1 + n_terms:
+                    raise ValueError(
+                        f"{resource} of rule {rule} has {len(coefs)} "
+                        f"coefficients, expected {1 + n_terms}: an "
+                        "intercept and one per term")
+
+    @classmethod
+    def from_yaml(cls, path):
+        with open(str(path)) as f:
+            return cls(yaml.safe_load(f))
+
+    def _terms(self, rule, resource):
+        model = self.rules[rule]
+        return model.get(f'{resource}_terms', model['terms'])
+
+    def predict(self, rule, resource, sizes):
+        """Predicted resource use, the default if sizes are missing."""
+        model = self.rules.get(rule)
+        default = self.config['default'][resource]
+        if model is None:
+            return default
+        x = term_values(self._terms(rule, resource), sizes)
+        if x is None:
+            return model.get(f'default_{resource}', default)
+        intercept, *coefs = model[resource]
+        return self.margin * (intercept + x @ np.array(coefs))
+
+    def _resource(self, rule, resource, params):
+        def predict(wildcards, input, threads, attempt):
+            sizes = input_sizes(input)
+            sizes.update(params, threads=threads)
+            # Give retries of a job that ran out of resources more room
+            return int(np.ceil(self.predict(rule, resource, sizes) *
+                               attempt))
+        return predict
+
+    def mem_mb(self, rule, **params):
+        """Snakemake resource function of the peak memory in MB."""
+        return self._resource(rule, 'mem_mb', params)
+
+    def runtime(self, rule, **params):
+        """Snakemake resource function of the runtime in minutes."""
+        return self._resource(rule, 'runtime', params)
+
+    def calibrate(self, records):
+        """Refit the coefficients to instrumentation records.
+
+        With more records than coefficients every coefficient is fitted by
+        non-negative least squares, with fewer the current model is only
+        scaled.
+        """
+        scripts = {m['script']: rule for rule, m in self.rules.items()
+                   if 'script' in m}
+        observed = {}
+        for record in records:
+            rule = scripts.get(record['script'])
+            if rule is None:
+                continue
+            total = [s for s in record['stages'] if s['parent'] is None][0]
+            sizes = input_sizes(record['inputs'])
+            for stage in record['stages']:
+                sizes.update(stage['sizes'])
+            observed.setdefault(rule, []).append(
+                (sizes, total['peak_rss_bytes'] / 2**20,
+                 total['wall_s'] / 60))
+
+        for rule, obs in observed.items():
+            for i, resource in enumerate(['mem_mb', 'runtime']):
+                terms = self._terms(rule, resource)
+                xs, ys = [], []
+                for sizes, *y in obs:
+                    x = term_values(terms, sizes)
+                    if x is not None:
+                        xs.append(np.concatenate([[1.0], x]))
+                        ys.append(y[i])
+                if not xs:
+                    continue
+                X, y = np.array(xs), np.array(ys)
+                if len(y) > X.shape[1]:
+                    # Scale columns so the fit is not dominated by large terms
+                    scale = np.maximum(X.max(0), 1.0)
+                    coefs, _ = scipy.optimize.nnls(X / scale, y)
+                    coefs = coefs / scale
+                else:
+                    current = np.array(self.rules[rule][resource])
+                    coefs = current * np.median(y / (X @ current))
+                self.rules[rule][resource] = [float(f'{c:.4g}')
+                                              for c in coefs]
+        return sorted(observed)
+
+
+@click.command()
+@click.argument('config', type=click.Path(exists=True, dir_okay=False))
+@click.argument('records', nargs=-1,
+                type=click.Path(exists=True, dir_okay=False))
+def calibrate(config, records):
+    """Calibrate resource models to .instrumentation.json records."""
+    model = ResourceModel.from_yaml(config)
+    loaded = []
+    for path in records:
+        with open(path) as f:
+            loaded.append(json.load(f))
+    rules = model.calibrate(loaded)
+    with open(config) as f:
+        header = ''.join(line for line in f if line.startswith('#'))
+    with open(config, 'w') as f:
+        f.write(header)
+        yaml.safe_dump(model.config, f, default_flow_style=None)
+    click.echo(f"Calibrated {', '.join(rules) or 'no rules'}", err=True)
+
+
+if __name__ == '__main__':
+    calibrate()
@@ -0,0 +1,134 @@
+"""Mergeable summaries of the distribution of many values.
+
+Sketches are built chunk by chunk, or by separate workers and merged, in
+memory that does not grow with the number of values. `plot.qqplot` and
+`plot.hist` accept them in place of arrays.
+"""
+import numpy as np
+
+
+class QuantileSketch:
+    """Approximate quantiles, like a merging t-digest.
+
+    Values are summarised by centroids, a mean and a weight. Centroids are
+    small in the tails, with a scale function logarithmic in the
+    quantile, so the quantiles of the smallest p-values of a genome-wide
+    scan stay accurate. The number of centroids is of the order of
+    `compression`.
+    """
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def update(self, values):
+        """Add the finite values of an array, return the sketch."""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return self
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._compress(np.concatenate([self.means, values]),
+                       np.concatenate([self.weights, np.ones(values.size)]))
+        return self
+
+    def merge(self, other):
+        """Add the values summarised by another sketch, return the sketch."""
+        if other.weights.size == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(np.concatenate([self.means, other.means]),
+                       np.concatenate([self.weights, other.weights]))
+        return self
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        # Centroids in the same unit of the scale function are merged, it
+        # spans about `compression` units from the first to the last value
+        k = (self.compression / (2 * np.log(2 * total + 1)) *
+             np.log(q / (1 - q)))
+        cluster = np.floor(k - k[0])
+        starts = np.flatnonzero(np.r_[True, cluster[1:] != cluster[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        """Approximate quantiles `q`, between 0 and 1."""
+        if self.weights.size == 0:
+            return np.full(np.shape(q), np.nan)
+        total = self.count
+        centers = (np.cumsum(self.weights) - self.weights / 2) / total
+        return np.interp(q, np.r_[0.0, centers, 1.0],
+                         np.r_[self.min, self.means, self.max])
+
+
+class HistogramSketch:
+    """Histogram with fixed, equal width bins over `range`.
+
+    Values outside the range are counted in `underflow` and `overflow`,
+    the last bin includes its right edge like `np.histogram`.
+    """
+
+    def __init__(self, bins, range):
+        self.bins = bins
+        self.range = (float(range[0]), float(range[1]))
+        self.counts = np.zeros(bins)
+        self.underflow = 0.0
+        self.overflow = 0.0
+
+    @property
+    def edges(self):
+        return np.linspace(self.range[0], self.range[1], self.bins + 1)
+
+    @property
+    def count(self):
+        return self.counts.sum() + self.underflow + self.overflow
+
+    def update(self, values, weights=None):
+        """Add the finite values of an array, return the sketch."""
+        values = np.asarray(values, dtype=float).ravel()
+        if weights is None:
+            weights = np.ones(values.size)
+        else:
+            weights = np.asarray(weights, dtype=float).ravel()
+        finite = np.isfinite(values)
+        values = values[finite]
+        weights = weights[finite]
+
+        low, high = self.range
+        below = values < low
+        above = values > high
+        self.underflow += weights[below].sum()
+        self.overflow += weights[above].sum()
+        inside = ~(below | above)
+        i = np.floor((values[inside] - low) / (high - low) * self.bins)
+        i = np.minimum(i.astype(int), self.bins - 1)
+        self.counts += np.bincount(i, weights[inside], minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        """Add the counts of a sketch with the same bins, return the sketch."""
+        if other.bins != self.bins or other.range != self.range:
+            raise ValueError("Histogram sketches have different bins")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def density(self):
+        """Counts normalised to integrate to one over the range."""
+        width = (self.range[1] - self.range[0]) / self.bins
+        return self.counts / (self.counts.sum() * width)
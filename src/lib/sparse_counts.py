@@ -0,0 +1,144 @@
+"""Read counts stored as a compressed sparse matrix.
+
+Most genes have no reads in most samples. In a data set, the counts of
+a (case, gene) variable `read_count` can be stored as the three arrays of
+a CSR or CSC matrix instead:
+
+    read_count_data     (read_count_nnz)  non-zero counts
+    read_count_indices  (read_count_nnz)  their column (CSR) or row (CSC)
+    read_count_indptr   (read_count_ptr)  start of each row or column
+
+The attributes of `read_count_data` are those of the counts, with the
+format and dimensions of the matrix in `sparse_format` and `sparse_dims`.
+CSR keeps the counts of a case together, CSC those of a gene.
+"""
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+formats = ('csr', 'csc')
+
+_matrix_types = {
+    'csr': scipy.sparse.csr_matrix,
+    'csc': scipy.sparse.csc_matrix,
+}
+
+SparseCounts = namedtuple('SparseCounts', ['matrix', 'dims', 'coords',
+                                           'attrs'])
+
+
+def from_dense(counts, format='csr', block_size=256):
+    """Sparse counts of a two-dimensional DataArray.
+
+    The counts are read in blocks along the first dimension, so a lazily
+    loaded variable is never completely in memory.
+    """
+    if format not in formats:
+        raise ValueError(f"Unknown sparse format {format}")
+    blocks = [scipy.sparse.csr_matrix(counts[start:start + block_size].values)
+              for start in range(0, counts.shape[0], block_size)]
+    matrix = scipy.sparse.vstack(blocks, format=format)
+    coords = {d: counts[d].values for d in counts.dims}
+    return SparseCounts(matrix, counts.dims, coords, dict(counts.attrs))
+
+
+def is_sparse(data_set, name):
+    return f'{name}_indptr' in data_set
+
+
+def read(data_set, name):
+    """Sparse counts of a variable, converting it if it is dense."""
+    if not is_sparse(data_set, name):
+        return from_dense(data_set[name])
+    data = data_set[f'{name}_data']
+    attrs = {k: v for k, v in data.attrs.items()
+             if not k.startswith('sparse_')}
+    dims = tuple(data.attrs['sparse_dims'].split())
+    shape = tuple(data_set.sizes[d] for d in dims)
+    matrix = _matrix_types[data.attrs['sparse_format']](
+        (data.values, data_set[f'{name}_indices'].values,
+         data_set[f'{name}_indptr'].values),
+        shape=shape)
+    coords = {d: data_set[d].values for d in dims}
+    return SparseCounts(matrix, dims, coords, attrs)
+
+
+def to_variables(counts, name):
+    """Variables to store the counts in a data set as `name`."""
+    matrix = counts.matrix
+    attrs = dict(counts.attrs,
+                 sparse_format=matrix.format,
+                 sparse_dims=" ".join(counts.dims))
+    nnz_dim = f'{name}_nnz'
+    return {
+        f'{name}_data': xr.Variable(nnz_dim, matrix.data, attrs),
+        f'{name}_indices': xr.Variable(nnz_dim, matrix.indices.astype(
+            np.min_scalar_type(max(matrix.shape) - 1))),
+        f'{name}_indptr': xr.Variable(f'{name}_ptr',
+                                      matrix.indptr.astype('int64')),
+    }
+
+
+def drop(data_set, name):
+    """Remove dense or sparse counts from a data set in place."""
+    if is_sparse(data_set, name):
+        for suffix in ('data', 'indices', 'indptr'):
+            del data_set[f'{name}_{suffix}']
+    else:
+        del data_set[name]
+
+
+def to_dataarray(counts, genes=None):
+    """Dense counts, of all genes or the selected ones."""
+    matrix = counts.matrix
+    coords = dict(counts.coords)
+    if genes is not None:
+        matrix = matrix[:, genes]
+        coords[counts.dims[1]] = coords[counts.dims[1]][genes]
+    return xr.DataArray(matrix.toarray(), coords=coords, dims=counts.dims,
+                        attrs=counts.attrs)
+
+
+def dense(data_set, name):
+    """Counts of a variable as a DataArray, whether stored sparse or not."""
+    if is_sparse(data_set, name):
+        return to_dataarray(read(data_set, name))
+    return data_set[name]
+
+
+def library_size(matrix):
+    """Total counts of each row."""
+    return np.asarray(matrix.sum(1, dtype='int64')).ravel()
+
+
+def expressed_genes(matrix, min_total=None):
+    """Columns with more than `min_total` counts in total.
+
+    By default the threshold is the number of genes, like the filter of
+    `run_gsea` and `differential-expression.R`.
+    """
+    if min_total is None:
+        min_total = matrix.shape[1]
+    return np.asarray(matrix.sum(0, dtype='int64')).ravel() > min_total
+
+
+def log2_cpm(matrix, genes=None, block_size=256):
+    """log2(counts per million) of all genes or the selected ones.
+
+    Zero counts have the same value in a row, so only the non-zero counts
+    are computed individually, a block of rows at a time, and only the
+    selected genes are dense.
+    """
+    library_size_1 = library_size(matrix) + 1
+    if genes is not None:
+        matrix = matrix[:, genes]
+    cpm = np.empty(matrix.shape)
+    cpm[...] = np.log2(0.5 / library_size_1 * 1e6)[:, np.newaxis]
+    for start in range(0, matrix.shape[0], block_size):
+        block = matrix[start:start + block_size].tocoo()
+        rows = start + block.row
+        cpm[rows, block.col] = np.log2(
+            (0.5 + block.data) / library_size_1[rows] * 1e6)
+    return cpm
@@ -0,0 +1,400 @@
+"""Cross validation of ridge, lasso and logistic models of many targets.
+
+The folds are drawn once. Regression needs only the Gram matrix of the
+predictors and their cross-products with the targets, so these are
+computed once for all data and each fold subtracts its test cases. Every
+fold fits the whole regularisation path of all targets, starting each
+penalty from the solution of the previous one, and folds run in a process
+pool.
+
+Performance is estimated by nested cross validation. For each test fold,
+the penalty is selected per model and target by the explained variance of
+a cross validation over the other folds, each in turn, and only the test
+fold scores it. The path of explained variance is that of the outer folds,
+its maximum is biased upwards. Its best penalty is that of the model fitted
+to all data, whose coefficients give the feature importance.
+
+The logistic models predict whether a target is above its median, their
+performance is the Brier score and the AUC of the predicted probabilities.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+from scipy.stats import rankdata
+import xarray as xr
+
+from lib import click_utils
+
+models = ('ridge', 'lasso', 'logistic')
+n_penalties = 30
+# Penalties relative to the largest useful one for lasso, or to the
+# variance of the standardised predictors for ridge and logistic
+ridge_penalties = np.logspace(3, -3, n_penalties)
+lasso_penalties = np.logspace(0, -3, n_penalties)
+logistic_penalties = np.logspace(1, -4, n_penalties)
+
+
+def read_matrix(path, var):
+    """(case, feature) array of a variable, or of all case variables.
+
+    Without `var`, the numeric variables along case, except the MRI
+    annotations, are stacked along `cad_feature` like the MRI features.
+    """
+    ds = xr.open_dataset(path).load()
+    if var is not None:
+        da = ds[var]
+        other = [d for d in da.dims if d != 'case']
+        da = da.transpose('case', *other)
+        # Keep annotation of the features, such as factor names
+        for name, v in ds.data_vars.items():
+            if name != var and v.dims == tuple(other):
+                da.coords[name] = v
+        return da
+    names = [name for name, v in ds.data_vars.items()
+             if v.dims == ('case',) and v.dtype.kind in 'iuf' and
+             name not in ('Comment', 'MultiFocal')]
+    return ds[names].to_array('cad_feature').transpose('case', 'cad_feature')
+
+
+def fold_ids(n, n_folds, seed):
+    """Fold of every case, folds as equal in size as possible."""
+    r = np.random.RandomState(seed)
+    return r.permutation(np.arange(n) % n_folds)
+
+
+class FoldData:
+    """Standardised cross-products of the training cases of a fold."""
+
+    def __init__(self, x, y, sums, test):
+        x_sum, y_sum, xx, xy, yy = sums
+        x_te = x[test]
+        y_te = y[test]
+        n = x.shape[0] - test.sum()
+        x_sum = x_sum - x_te.sum(0)
+        y_sum = y_sum - y_te.sum(0)
+        self.x_mean = x_sum / n
+        self.y_mean = y_sum / n
+        c_xx = xx - x_te.T @ x_te - np.outer(x_sum, x_sum) / n
+        c_xy = xy - x_te.T @ y_te - np.outer(x_sum, y_sum) / n
+        c_yy = yy - (y_te**2).sum(0) - y_sum**2 / n
+        self.x_sd = np.sqrt(np.maximum(np.diag(c_xx), 0) / n)
+        self.x_sd[self.x_sd == 0] = 1.0
+        self.y_sd = np.sqrt(np.maximum(c_yy, 0) / n)
+        self.y_sd[self.y_sd == 0] = 1.0
+        self.r_xx = c_xx / (n * np.outer(self.x_sd, self.x_sd))
+        self.r_xy = c_xy / (n * np.outer(self.x_sd, self.y_sd))
+
+    def predict(self, x, coef):
+        """Predictions of coefficients (feature, target, penalty)."""
+        x_std = (x - self.x_mean) / self.x_sd
+        pred = np.einsum('cf,ftp->ctp', x_std, coef)
+        return (self.y_mean[:, np.newaxis] +
+                self.y_sd[:, np.newaxis] * pred)
+
+
+def ridge_path(r_xx, r_xy, penalties):
+    """Ridge coefficients of all targets and penalties, (f, t, p)."""
+    s, v = np.linalg.eigh(r_xx)
+    vr = v.T @ r_xy
+    return np.einsum('fe,etp->ftp', v,
+                     vr[:, :, np.newaxis] /
+                     (s[:, np.newaxis, np.newaxis] + penalties))
+
+
+def lasso_homotopy(r_xx, r_xy, lambdas):
+    """Lasso coefficients of one target at decreasing penalties `lambdas`.
+
+    Follows the exact, piecewise linear path of the solution from the
+    largest penalty, from one change of the nonzero coefficients to the
+    next, so every penalty starts from the previous solution.
+    """
+    n_features = len(r_xy)
+    coef = np.zeros((len(lambdas), n_features))
+    active = np.zeros(n_features, dtype=bool)
+    sign = np.zeros(n_features)
+    j = np.argmax(np.abs(r_xy))
+    lam = np.abs(r_xy[j])
+    active[j] = True
+    sign[j] = np.sign(r_xy[j])
+    i = np.searchsorted(-lambdas, -lam, side='right')
+    while i < len(lambdas):
+        # Along this piece b = base - lambda * d on the active set, and the
+        # correlations with the residual are c0 + lambda * a
+        r_aa = r_xx[np.ix_(active, active)]
+        rhs = np.column_stack([r_xy[active], sign[active]])
+        try:
+            sol = np.linalg.solve(r_aa, rhs)
+        except np.linalg.LinAlgError:
+            # More active predictors than the training cases support
+            sol = np.linalg.lstsq(r_aa, rhs, rcond=None)[0]
+        base, d = sol[:, 0], sol[:, 1]
+        c0 = r_xy - r_xx[:, active] @ base
+        a = r_xx[:, active] @ d
+        with np.errstate(divide='ignore', invalid='ignore'):
+            enter = np.concatenate([c0 / (1 - a), -c0 / (1 + a)])
+            drop = base / d
+        enter[np.tile(active, 2) | ~(enter < lam * (1 - 1e-10))] = 0
+        drop[~(drop < lam * (1 - 1e-10))] = 0
+        next_lam = max(enter.max(), drop.max(initial=0), 0)
+
+        while i < len(lambdas) and lambdas[i] >= next_lam:
+            coef[i, active] = base - lambdas[i] * d
+            i += 1
+        if next_lam == 0:
+            break
+        if enter.max() >= drop.max(initial=0):
+            j = np.argmax(enter) % n_features
+            active[j] = True
+            sign[j] = np.sign(c0[j] + next_lam * a[j])
+        else:
+            j = np.flatnonzero(active)[np.argmax(drop)]
+            active[j] = False
+            sign[j] = 0
+        lam = next_lam
+    return coef
+
+
+def lasso_path(r_xx, r_xy, penalties):
+    """Lasso coefficients of all targets and penalties, (f, t, p).
+
+    Penalties are relative to the smallest penalty with all coefficients
+    zero, per target.
+    """
+    lambda_max = np.abs(r_xy).max(0)
+    return np.stack([lasso_homotopy(r_xx, r_xy[:, t], penalties * lam).T
+                     for t, lam in enumerate(lambda_max)], axis=1)
+
+
+def logistic_path(x, y, penalties, max_iter=50, tol=1e-8):
+    """L2 penalised logistic regression of binary targets by Newton steps.
+
+    Returns coefficients (f, t, p) of the standardised x and intercepts
+    (t, p). The Hessians of all targets are solved as one stack.
+    """
+    n, n_features = x.shape
+    n_targets = y.shape[1]
+    x1 = np.hstack([np.ones((n, 1)), x])
+    # Outer products of the cases, the Hessians are their weighted sums
+    x1_outer = (x1[:, :, np.newaxis] * x1[:, np.newaxis, :]).reshape(n, -1)
+    coef = np.zeros((n_features + 1, n_targets, len(penalties)))
+    beta = np.zeros((n_targets, n_features + 1))
+    mean = y.mean(0).clip(1e-6, 1 - 1e-6)
+    beta[:, 0] = np.log(mean / (1 - mean))
+    for p, penalty in enumerate(penalties):
+        ridge = np.full(n_features + 1, penalty)
+        ridge[0] = 0.0
+        for _ in range(max_iter):
+            prob = 1 / (1 + np.exp(-(x1 @ beta.T)))
+            grad = (x1.T @ (prob - y)).T / n + ridge * beta
+            weights = prob * (1 - prob)
+            hess = ((weights.T @ x1_outer).reshape(n_targets, n_features + 1,
+                                                   n_features + 1) / n +
+                    np.diag(ridge + 1e-10))
+            step = np.linalg.solve(hess, grad[:, :, np.newaxis])[:, :, 0]
+            beta -= step
+            if np.abs(step).max() < tol:
+                break
+        coef[:, :, p] = beta.T
+    return coef[1:], coef[0]
+
+
+def fit_fold(x, y, y_binary, sums, test):
+    """Coefficients of the paths of all models for one fold.
+
+    With no test cases, this is the fit to all data.
+    """
+    fold = FoldData(x, y, sums, test)
+    train = ~test
+    x_std = (x[train] - fold.x_mean) / fold.x_sd
+    coef = {
+        'ridge': ridge_path(fold.r_xx, fold.r_xy, ridge_penalties),
+        'lasso': lasso_path(fold.r_xx, fold.r_xy, lasso_penalties),
+    }
+    logistic_coef, intercept = logistic_path(x_std, y_binary[train],
+                                             logistic_penalties)
+    pred = {m: fold.predict(x[test], coef[m]) for m in coef}
+    logit = (intercept +
+             np.einsum('cf,ftp->ctp',
+                       (x[test] - fold.x_mean) / fold.x_sd, logistic_coef))
+    pred['logistic'] = 1 / (1 + np.exp(-logit))
+    coef['logistic'] = logistic_coef
+    return pred, coef
+
+
+def explained_variance(y, pred):
+    """Explained variance of predictions (case, target, penalty)."""
+    resid = ((y[:, :, np.newaxis] - pred)**2).sum(0)
+    total = ((y - y.mean(0))**2).sum(0)
+    return 1 - resid / total[:, np.newaxis]
+
+
+def auc(y, score):
+    """Area under the ROC curve of binary targets, per target."""
+    result = np.full(y.shape[1], np.nan)
+    for t in range(y.shape[1]):
+        pos = y[:, t].astype(bool)
+        n_pos = pos.sum()
+        n_neg = len(pos) - n_pos
+        if n_pos and n_neg:
+            ranks = rankdata(score[:, t])
+            result[t] = ((ranks[pos].sum() - n_pos * (n_pos + 1) / 2) /
+                         (n_pos * n_neg))
+    return result
+
+
+def best_step(ev_path):
+    """Penalty step with the largest explained variance, per target."""
+    return np.argmax(np.where(np.isfinite(ev_path), ev_path, -np.inf),
+                     axis=1)
+
+
+def cross_validate(x, y, n_folds, seed, jobs):
+    """Nested cross validated performance of the models."""
+    complete = np.isfinite(x).all(1) & np.isfinite(y).all(1)
+    x = x[complete]
+    y = y[complete]
+    # Binary targets of the logistic model, above or below the median
+    y_binary = (y > np.median(y, 0)).astype(float)
+    folds = fold_ids(x.shape[0], n_folds, seed)
+    sums = (x.sum(0), y.sum(0), x.T @ x, x.T @ y, (y**2).sum(0))
+    # Outer folds, inner folds g of the training cases of outer fold f, and
+    # all data
+    inner = [(f, g) for f in range(n_folds) for g in range(n_folds)
+             if g != f]
+    tests = ([folds == f for f in range(n_folds)] +
+             [(folds == f) | (folds == g) for f, g in inner] +
+             [np.zeros(x.shape[0], dtype=bool)])
+    args = [(x, y, y_binary, sums, t) for t in tests]
+    if jobs == 1:
+        results = [fit_fold(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(fit_fold, *zip(*args)))
+    outer_results = results[:n_folds]
+    inner_results = results[n_folds:-1]
+
+    perf = dict()
+    targets = np.arange(y.shape[1])
+    no_value = np.full(y.shape[1], np.nan)
+    for m in models:
+        target = y_binary if m == 'logistic' else y
+        pred = np.empty((x.shape[0], y.shape[1], n_penalties))
+        for f, (fold_pred, _) in enumerate(outer_results):
+            pred[folds == f] = fold_pred[m]
+        ev_path = explained_variance(target, pred)
+
+        nested_pred = np.empty(y.shape)
+        for f in range(n_folds):
+            train = folds != f
+            inner_pred = np.empty(pred.shape)
+            for (outer, g), (fold_pred, _) in zip(inner, inner_results):
+                if outer == f:
+                    test = folds[(folds == f) | (folds == g)] == g
+                    inner_pred[folds == g] = fold_pred[m][test]
+            step = best_step(explained_variance(target[train],
+                                                inner_pred[train]))
+            nested_pred[~train] = pred[~train][:, targets, step]
+
+        best = best_step(ev_path)
+        importance = np.abs(results[-1][1][m][:, targets, best])
+        total = importance.sum(0)
+        error = target - nested_pred
+        logistic = m == 'logistic'
+        perf[m] = {
+            'explained_variance': (
+                no_value if logistic else
+                explained_variance(target, nested_pred[:, :, np.newaxis])[
+                    :, 0]),
+            'median_absolute_error': (
+                no_value if logistic else np.median(np.abs(error), axis=0)),
+            'brier_score': (np.mean(error**2, axis=0) if logistic
+                            else no_value),
+            'auc': auc(target, nested_pred) if logistic else no_value,
+            'selected_step': best,
+            'path_explained_variance': ev_path,
+            'feature_importance': (importance /
+                                   np.where(total > 0, total, 1)).T,
+        }
+    fold = np.full(complete.shape, -1)
+    fold[complete] = folds
+    return perf, fold
+
+
+def to_dataset(perf, x, y, fold):
+    target_dim = y.dims[1]
+    feature_dim = x.dims[1]
+    ds = xr.Dataset(coords={
+        'model': np.array(models, dtype=object),
+        'case': x['case'].values,
+        target_dim: y[target_dim].values,
+        feature_dim: x[feature_dim].values,
+    })
+    for name, dims in [
+            ('explained_variance', [target_dim]),
+            ('median_absolute_error', [target_dim]),
+            ('brier_score', [target_dim]),
+            ('auc', [target_dim]),
+            ('selected_step', [target_dim]),
+            ('path_explained_variance', [target_dim, 'penalty_step']),
+            ('feature_importance', [target_dim, feature_dim])]:
+        ds[name] = (['model'] + dims,
+                    np.stack([perf[m][name] for m in models]))
+    ds['explained_variance'].attrs['long_name'] = (
+        "nested cross validated explained variance of ridge and lasso")
+    ds['brier_score'].attrs['long_name'] = (
+        "nested cross validated Brier score of logistic models")
+    ds['selected_step'].attrs['long_name'] = (
+        "penalty step of the model of all data")
+    ds['path_explained_variance'].attrs['long_name'] = (
+        "cross validated explained variance along the path, the maximum "
+        "is biased upwards")
+    ds['penalty'] = (['model', 'penalty_step'], np.stack([
+        ridge_penalties, lasso_penalties, logistic_penalties]))
+    ds['penalty'].attrs['long_name'] = (
+        "penalty relative to the standardised predictors, for lasso to the "
+        "smallest penalty without any coefficient")
+    ds['fold'] = ('case', fold)
+    ds['fold'].attrs['long_name'] = "test fold, -1 for incomplete cases"
+    for da in (x, y):
+        for name, coord in da.coords.items():
+            if name not in ds.coords and coord.dims == da.dims[1:]:
+                ds.coords[name] = coord
+    return ds
+
+
+@click.command()
+@click.argument('predictors', type=click_utils.in_path)
+@click.argument('targets', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--predictor-var', default=None,
+              help="Variable of the predictors, by default all case "
+                   "variables.")
+@click.option('--target-var', default=None,
+              help="Variable of the targets, by default all case "
+                   "variables.")
+@click.option('--folds', 'n_folds', default=10)
+@click.option('--seed', default=0, help="Seed of the fold assignment.")
+@click.option('-j', '--jobs', default=1, help="Number of processes.")
+def cross_validate_models(predictors, targets, out, predictor_var,
+                          target_var, n_folds, seed, jobs):
+    """Cross validate ridge, lasso and logistic models of all targets."""
+    x = read_matrix(predictors, predictor_var)
+    y = read_matrix(targets, target_var)
+    x, y = xr.align(x, y, exclude=set(x.dims[1:]) | set(y.dims[1:]))
+
+    perf, fold = cross_validate(x.values, y.values, n_folds, seed, jobs)
+    ds = to_dataset(perf, x, y, fold)
+    ds.attrs['folds'] = n_folds
+    ds.attrs['seed'] = seed
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    ds.attrs['history'] = (f"{time_str} cross_validate.py predict "
+                           f"{targets} from {predictors}\n")
+    ds.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    cross_validate_models()
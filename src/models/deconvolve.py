@@ -0,0 +1,173 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import pandas as pd
+from scipy.optimize import nnls
+from sklearn.svm import NuSVR
+import xarray as xr
+
+from lib import click_utils
+
+# nu of the support vector regressions, the best fit is kept like CIBERSORT
+svr_nus = (0.25, 0.5, 0.75)
+
+
+def read_signature(path):
+    """Signature matrix, expression of genes by symbol in each cell type."""
+    df = pd.read_table(path, index_col=0)
+    return xr.DataArray(
+        df.values.astype(float),
+        dims=['gene_symbol', 'cell_type'],
+        coords={'gene_symbol': df.index.values.astype(str),
+                'cell_type': df.columns.values.astype(str)},
+    )
+
+
+def signature_mixtures(gexp, signature):
+    """Linear scale expression of the signature genes, (gene_symbol, case).
+
+    Genes with the same HGNC symbol are averaged.
+    """
+    symbols = gexp['hgnc_symbol'].values.astype(str)
+    keep = np.isin(symbols, signature['gene_symbol'].values)
+    cpm = pd.DataFrame(2 ** gexp['log2_cpm'].values[:, keep].T,
+                       index=symbols[keep])
+    cpm = cpm.groupby(level=0).mean()
+    return xr.DataArray(
+        cpm.values,
+        dims=['gene_symbol', 'case'],
+        coords={'gene_symbol': cpm.index.values,
+                'case': gexp['case'].values},
+    )
+
+
+def _scale(a):
+    return (a - a.mean(0)) / a.std(0, ddof=1)
+
+
+def deconvolve_batch(signature, mixtures, method):
+    """Cell fractions, fit correlation and RMSE of mixture columns.
+
+    Like CIBERSORT, both methods fit, and the fit is measured, between the
+    standardised mixture and the standardised signature combined with the
+    fractions.
+    """
+    x = (signature - signature.mean()) / signature.std(ddof=1)
+    y_all = _scale(mixtures)
+    n_cell_types = signature.shape[1]
+    fractions = np.zeros((mixtures.shape[1], n_cell_types))
+    correlation = np.full(mixtures.shape[1], np.nan)
+    rmse = np.full(mixtures.shape[1], np.nan)
+    for i in range(mixtures.shape[1]):
+        y = y_all[:, i]
+        if method == 'nnls':
+            candidates = [nnls(x, y)[0]]
+        else:
+            candidates = [NuSVR(kernel='linear', nu=nu).fit(x, y).coef_[0]
+                          for nu in svr_nus]
+        for w in candidates:
+            w = np.maximum(w, 0)
+            if w.sum() == 0:
+                continue
+            w = w / w.sum()
+            fit = x @ w
+            fit_rmse = np.sqrt(np.mean((fit - y)**2))
+            if np.isnan(rmse[i]) or fit_rmse < rmse[i]:
+                fractions[i] = w
+                rmse[i] = fit_rmse
+                correlation[i] = np.corrcoef(fit, y)[0, 1]
+    return fractions, correlation, rmse
+
+
+def permuted_mixtures(mixtures, n_genes, n_permutations, seed):
+    """Random mixtures of values drawn from all mixtures, (gene, perm)."""
+    r = np.random.RandomState(seed)
+    values = mixtures.ravel()
+    return values[r.randint(values.size, size=(n_genes, n_permutations))]
+
+
+def deconvolve_all(signature, mixtures, method, batch_size, jobs):
+    """deconvolve_batch over batches of columns in a process pool."""
+    starts = range(0, mixtures.shape[1], batch_size)
+    batches = [mixtures[:, s:s+batch_size] for s in starts]
+    if jobs == 1:
+        results = [deconvolve_batch(signature, b, method) for b in batches]
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(deconvolve_batch,
+                                    [signature] * len(batches), batches,
+                                    [method] * len(batches)))
+    if not results:
+        return (np.empty((0, signature.shape[1])), np.empty(0),
+                np.empty(0))
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
+def permutation_p(correlation, null_correlation):
+    """Fraction of random mixtures fitting at least as well."""
+    null = np.sort(null_correlation[np.isfinite(null_correlation)])
+    n_better = null.size - np.searchsorted(null, correlation, side='left')
+    p = (n_better + 1) / (null.size + 1)
+    return np.where(np.isfinite(correlation), p, np.nan)
+
+
+@click.command()
+@click.argument('gene_expression', type=click_utils.in_path)
+@click.argument('signature_matrix', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--method', type=click.Choice(['svr', 'nnls']), default='svr',
+              help="nu-SVR like CIBERSORT, or non-negative least squares.")
+@click.option('--permutations', default=100,
+              help="Number of random mixtures for the p-values.")
+@click.option('--batch-size', default=16,
+              help="Number of cases per task of the process pool.")
+@click.option('-j', '--jobs', default=1, help="Number of processes.")
+@click.option('--seed', default=0, help="Seed of the random mixtures.")
+def deconvolve(gene_expression, signature_matrix, out, method, permutations,
+               batch_size, jobs, seed):
+    """Estimate cell type fractions of every case from its expression."""
+    gexp = xr.open_dataset(gene_expression)
+    signature = read_signature(signature_matrix)
+    mixtures = signature_mixtures(gexp, signature)
+    signature = signature.sel(gene_symbol=mixtures['gene_symbol'])
+    gexp.close()
+    click.echo(f"{signature.shape[0]} of the signature genes are expressed",
+               err=True)
+
+    fractions, correlation, rmse = deconvolve_all(
+        signature.values, mixtures.values, method, batch_size, jobs)
+    null_mixtures = permuted_mixtures(mixtures.values, signature.shape[0],
+                                      permutations, seed)
+    _, null_correlation, _ = deconvolve_all(
+        signature.values, null_mixtures, method, batch_size, jobs)
+
+    ds = xr.Dataset(
+        {
+            'cell_fraction': (['case', 'cell_type'], fractions),
+            'p': ('case', permutation_p(correlation, null_correlation)),
+            'correlation': ('case', correlation),
+            'rmse': ('case', rmse),
+        },
+        coords={
+            'case': mixtures['case'].values,
+            'cell_type': signature['cell_type'].values.astype(object),
+        },
+    )
+    ds['cell_fraction'].attrs['long_name'] = "relative cell type fraction"
+    ds['p'].attrs['long_name'] = "permutation p-value of the fit"
+    ds.attrs['method'] = method
+    ds.attrs['permutations'] = permutations
+    ds.attrs['n_signature_genes'] = signature.shape[0]
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    ds.attrs['history'] = (f"{time_str} deconvolve.py {method} "
+                           f"deconvolution of {gene_expression} with "
+                           f"{signature_matrix}\n")
+    ds.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    deconvolve()
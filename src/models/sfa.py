@@ -0,0 +1,134 @@
+"""Sparse factor analysis of gene expression and MRI features together.
+
+The data types share the factors of the cases, each has its own loadings
+with an elastic net penalty of strength `l_<type>` and l1 ratio `alpha`.
+A fit alternates a coordinate descent pass over the loadings with least
+squares factors, which are scaled to unit variance. All features are
+standardised, so the penalties are comparable between data types.
+"""
+import numpy as np
+
+data_types = ('gexp', 'mri')
+
+
+def standardize(x):
+    """Columns of x centered and scaled to unit variance."""
+    sd = x.std(0)
+    sd[sd == 0] = 1.0
+    return (x - x.mean(0)) / sd
+
+
+def initial_factors(data, k):
+    """First k principal components of all data, with unit variance."""
+    x = np.concatenate([data[t] for t in data_types], axis=1)
+    u, _, _ = np.linalg.svd(x, full_matrices=False)
+    return u[:, :k] * np.sqrt(x.shape[0])
+
+
+def _soft_threshold(x, threshold):
+    return np.sign(x) * np.maximum(np.abs(x) - threshold, 0.0)
+
+
+def update_loadings(x, z, w, l1, l2):
+    """Loadings after one coordinate descent pass, over all features at
+    once."""
+    n = z.shape[0]
+    w = w.copy()
+    resid = x - z @ w.T
+    for j in range(z.shape[1]):
+        z_j = z[:, j]
+        resid += np.outer(z_j, w[:, j])
+        rho = z_j @ resid / n
+        w[:, j] = _soft_threshold(rho, l1) / (z_j @ z_j / n + l2)
+        resid -= np.outer(z_j, w[:, j])
+    return w
+
+
+def update_factors(data, loadings, z):
+    """Least squares factors given the loadings, scaled to unit variance.
+
+    The loadings are scaled to keep the fit the same. Factors without any
+    loading are kept as they are.
+    """
+    xw = sum(data[t] @ loadings[t] for t in data_types)
+    wtw = sum(loadings[t].T @ loadings[t] for t in data_types)
+    active = np.diag(wtw) > 0
+    z = z.copy()
+    if active.any():
+        z[:, active] = np.linalg.solve(wtw[np.ix_(active, active)],
+                                       xw[:, active].T).T
+    scale = z.std(0)
+    scale[scale == 0] = 1.0
+    z /= scale
+    loadings = {t: loadings[t] * scale for t in data_types}
+    return z, loadings
+
+
+def objective(resid, loadings, penalties, alpha, n):
+    total = 0.0
+    for t in data_types:
+        w = loadings[t]
+        total += ((resid[t]**2).sum() / (2 * n) +
+                  penalties[t] * (alpha * np.abs(w).sum() +
+                                  (1 - alpha) / 2 * (w**2).sum()))
+    return total
+
+
+def model_stats(data, resid, loadings):
+    """BIC of the fit, and deviance, degrees of freedom and sparsity of
+    each data type."""
+    stats = {'bic': 0.0}
+    for t in data_types:
+        n_obs = data[t].size
+        deviance = n_obs * np.log((resid[t]**2).sum() / n_obs)
+        dof = int(np.count_nonzero(loadings[t]))
+        stats[f'deviance_{t}'] = deviance
+        stats[f'dof_{t}'] = dof
+        stats[f'sparsity_{t}'] = 1 - dof / loadings[t].size
+        stats['bic'] += deviance + np.log(n_obs) * dof
+    return stats
+
+
+def empty_model_bic(data):
+    """BIC of the model without factors."""
+    return sum(data[t].size * np.log((data[t]**2).sum() / data[t].size)
+               for t in data_types)
+
+
+def fit(data, k, l_gexp, l_mri, alpha, *, init=None, max_iter=10000,
+        tol=1e-7, stop=None):
+    """Fit the model to standardised data of the same cases.
+
+    `init` is a (factors, loadings) pair to start from, else the principal
+    components. `stop(n_iter, stats)` is called every 50 iterations and
+    ends the fit when it returns True. Returns the factors, loadings,
+    number of iterations, whether `stop` ended the fit and `model_stats`.
+    """
+    n = data[data_types[0]].shape[0]
+    penalties = {'gexp': l_gexp, 'mri': l_mri}
+    if init is None:
+        z = initial_factors(data, k)
+        loadings = {t: np.zeros((data[t].shape[1], k)) for t in data_types}
+    else:
+        z, loadings = init
+        z = z.copy()
+        loadings = dict(loadings)
+    last = np.inf
+    stopped = False
+    for n_iter in range(1, max_iter + 1):
+        for t in data_types:
+            loadings[t] = update_loadings(
+                data[t], z, loadings[t], penalties[t] * alpha,
+                penalties[t] * (1 - alpha))
+        z, loadings = update_factors(data, loadings, z)
+        resid = {t: data[t] - z @ loadings[t].T for t in data_types}
+        current = objective(resid, loadings, penalties, alpha, n)
+        if abs(last - current) <= tol * abs(current):
+            break
+        last = current
+        if stop is not None and n_iter % 50 == 0:
+            if stop(n_iter, model_stats(data, resid, loadings)):
+                stopped = True
+                break
+
+    return z, loadings, n_iter, stopped, model_stats(data, resid, loadings)
@@ -0,0 +1,249 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+from itertools import product
+import json
+from pathlib import Path
+
+import click
+import numpy as np
+import xarray as xr
+import yaml
+
+from lib import click_utils
+from models import sfa
+
+params = ('l_gexp', 'l_mri', 'alpha', 'k')
+stat_names = ('bic', 'deviance_gexp', 'deviance_mri', 'dof_gexp', 'dof_mri',
+              'sparsity_gexp', 'sparsity_mri')
+
+
+def load_data(gene_expression, mri_features):
+    """Standardised expression and MRI features of the cases with both."""
+    gexp = xr.open_dataset(gene_expression)['log2_cpm'].load()
+    mri_ds = xr.open_dataset(mri_features).load()
+    mri = mri_ds[[v for v in mri_ds.data_vars
+                  if v not in ('Comment', 'MultiFocal')]]
+    mri = mri.to_array('cad_feature').transpose('case', 'cad_feature')
+    mri = mri[mri.notnull().all('cad_feature')]
+    gexp, mri = xr.align(gexp.transpose('case', 'gene'), mri)
+    return {'gexp': sfa.standardize(gexp.values),
+            'mri': sfa.standardize(mri.values)}
+
+
+def data_hash(data):
+    h = hashlib.sha256()
+    for t in sfa.data_types:
+        h.update(str(data[t].shape).encode())
+        h.update(np.ascontiguousarray(data[t]).tobytes())
+    return h.hexdigest()
+
+
+def parameter_grid(path):
+    """All combinations of the parameter values in a YAML file."""
+    with open(path) as f:
+        spec = yaml.safe_load(f)
+    return [dict(zip(params, values))
+            for values in product(*[spec[p] for p in params])]
+
+
+class FitCache:
+    """Fits stored by hash of the data, parameters and fit settings.
+
+    A refined grid finds the fits of the points it shares with a coarser
+    one, and starts the others from their neighbours. Only fits that ran
+    to convergence or `max_iter` are stored. Fits stopped as dominated
+    depend on the best fit of their sweep, so they are fitted again.
+    """
+
+    def __init__(self, directory, data_key, settings):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.data_key = data_key
+        self.settings = settings
+
+    def key(self, p):
+        return hashlib.sha256(json.dumps(
+            [self.data_key, self.settings, [p[n] for n in params]],
+        ).encode()).hexdigest()
+
+    def path(self, p):
+        return self.directory / f"{self.key(p)}.npz"
+
+    def stats(self, p):
+        """Statistics of a cached fit, None if it is not cached."""
+        if not self.path(p).exists():
+            return None
+        with np.load(str(self.path(p))) as f:
+            return json.loads(str(f['stats']))
+
+    def solution(self, p):
+        with np.load(str(self.path(p))) as f:
+            return f['factors'], {t: f[f'loadings_{t}']
+                                  for t in sfa.data_types}
+
+    def put(self, p, factors, loadings, stats):
+        # Write to a temporary name, so an interrupted sweep leaves no
+        # truncated fits behind
+        part = self.path(p).with_suffix('.part.npz')
+        np.savez(str(part), factors=factors, stats=json.dumps(stats),
+                 **{f'loadings_{t}': loadings[t] for t in sfa.data_types})
+        part.replace(self.path(p))
+
+
+def distance(a, b):
+    """Distance between parameters, on log scale for the penalties."""
+    return (abs(np.log10(a['l_gexp']) - np.log10(b['l_gexp'])) +
+            abs(np.log10(a['l_mri']) - np.log10(b['l_mri'])) +
+            abs(a['alpha'] - b['alpha']))
+
+
+def nearest(p, finished):
+    """Nearest finished fit with the same k, to start from."""
+    candidates = [f for f, stats in finished
+                  if f['k'] == p['k'] and not stats['dominated']]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda f: distance(p, f))
+
+
+_data = None
+
+
+def _load_worker_data(gene_expression, mri_features):
+    global _data
+    _data = load_data(gene_expression, mri_features)
+
+
+def _fit(p, init, best_bic, settings):
+    """Fit in a worker, stopped once it is clearly worse than the best."""
+    dominance = settings['dominance']
+
+    def dominated(n_iter, stats):
+        return (best_bic is not None and n_iter >= settings['min_iter'] and
+                stats['bic'] > best_bic + dominance * abs(best_bic))
+
+    z, loadings, n_iter, stopped, stats = sfa.fit(
+        _data, p['k'], p['l_gexp'], p['l_mri'], p['alpha'], init=init,
+        max_iter=settings['max_iter'], tol=settings['tol'], stop=dominated)
+    stats = {n: float(stats[n]) for n in stat_names}
+    stats['n_iter'] = n_iter
+    stats['dominated'] = stopped
+    return z, loadings, stats
+
+
+def best_bic(finished):
+    bics = [s['bic'] for _, s in finished if not s['dominated']]
+    return min(bics) if bics else None
+
+
+def sweep(gene_expression, mri_features, grid, cache, jobs, batch_size):
+    """Fit every point of the grid in a process pool.
+
+    Points are fitted in order of k and decreasing penalty, in batches of
+    `batch_size`. Each point starts from the nearest fit of the earlier
+    batches, if any, and is stopped if it is dominated by their best BIC.
+    The results therefore do not depend on the number of jobs or the order
+    in which fits finish. Returns the statistics of the fits in the order
+    of the grid.
+    """
+    order = sorted(range(len(grid)), key=lambda i: (
+        grid[i]['k'], -grid[i]['l_gexp'], -grid[i]['l_mri'],
+        -grid[i]['alpha']))
+    results = [None] * len(grid)
+    finished = []
+    for i in order:
+        stats = cache.stats(grid[i])
+        if stats is not None:
+            results[i] = stats
+            finished.append((grid[i], stats))
+    pending = [i for i in order if results[i] is None]
+    click.echo(f"{len(grid) - len(pending)} of {len(grid)} fits cached",
+               err=True)
+
+    with ProcessPoolExecutor(jobs, initializer=_load_worker_data,
+                             initargs=(gene_expression, mri_features)) as pool:
+        for batch_start in range(0, len(pending), batch_size):
+            batch = pending[batch_start:batch_start + batch_size]
+            incumbent = best_bic(finished)
+            futures = []
+            for i in batch:
+                start = nearest(grid[i], finished)
+                init = None if start is None else cache.solution(start)
+                futures.append(pool.submit(_fit, grid[i], init, incumbent,
+                                           cache.settings))
+            for i, future in zip(batch, futures):
+                z, loadings, stats = future.result()
+                if not stats['dominated']:
+                    cache.put(grid[i], z, loadings, stats)
+                results[i] = stats
+                click.echo(f"{grid[i]} bic={stats['bic']:.6g} "
+                           f"n_iter={stats['n_iter']}"
+                           f"{' dominated' if stats['dominated'] else ''}",
+                           err=True)
+            finished.extend((grid[i], results[i]) for i in batch)
+            click.echo(f"{batch_start + len(batch)}/{len(pending)} fits",
+                       err=True)
+    return results
+
+
+def to_dataset(grid, results, empty_bic):
+    """Model indexed statistics, with the BIC of dominated fits missing."""
+    ds = xr.Dataset(coords={
+        p: ('model', np.array([g[p] for g in grid])) for p in params
+    })
+    dominated = np.array([r['dominated'] for r in results])
+    for name in stat_names:
+        values = np.array([r[name] for r in results])
+        if name == 'bic':
+            values = np.where(dominated, np.nan, values)
+        ds[name] = ('model', values)
+    ds['n_iter'] = ('model', np.array([r['n_iter'] for r in results]))
+    ds['dominated'] = ('model', dominated.astype('int8'))
+    ds.attrs['empty_model_bic'] = empty_bic
+    return ds
+
+
+@click.command()
+@click.argument('gene_expression', type=click_utils.in_path)
+@click.argument('mri_features', type=click_utils.in_path)
+@click.argument('grid', type=click_utils.in_path)
+@click.argument('out', type=click_utils.out_path)
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              required=True, help="Directory of the fits of all sweeps.")
+@click.option('-j', '--jobs', default=1, help="Number of processes.")
+@click.option('--batch-size', default=8,
+              help="Number of fits started from the same earlier fits. "
+                   "More jobs than this are idle.")
+@click.option('--max-iter', default=10000)
+@click.option('--tol', default=1e-7,
+              help="Relative change of the objective at convergence.")
+@click.option('--dominance', default=0.05,
+              help="Stop fits with a BIC this fraction worse than the "
+                   "best fit so far.")
+@click.option('--min-iter', default=200,
+              help="Iterations before a fit may be stopped as dominated.")
+def sfa_parameter_sweep(gene_expression, mri_features, grid, out, cache_dir,
+                        jobs, batch_size, max_iter, tol, dominance, min_iter):
+    """BIC of SFA models over a grid of penalties and number of factors."""
+    data = load_data(gene_expression, mri_features)
+    key = data_hash(data)
+    settings = {'max_iter': max_iter, 'tol': tol, 'dominance': dominance,
+                'min_iter': min_iter}
+    cache = FitCache(cache_dir, key, settings)
+    points = parameter_grid(grid)
+
+    results = sweep(gene_expression, mri_features, points, cache, jobs,
+                    batch_size)
+    ds = to_dataset(points, results, sfa.empty_model_bic(data))
+    ds.attrs['data_sha256'] = key
+    time_str = (datetime.utcnow()
+                .replace(microsecond=0, tzinfo=timezone.utc)
+                .isoformat())
+    ds.attrs['history'] = (f"{time_str} sfa_parameter_sweep.py "
+                           f"{gene_expression} {mri_features} {grid}\n")
+    ds.to_netcdf(out)
+
+
+if __name__ == '__main__':
+    sfa_parameter_sweep()
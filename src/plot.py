@@ -1,17 +1,22 @@
 import contextlib
 from functools import wraps
-
-import matplotlib
-import matplotlib.pyplot
-import matplotlib.cm
-import IPython.display
+import sys
 
 import numpy as np
-import pandas as pd
-import xarray as xr
+
+from lib.lazy import is_instance, lazy_import
+from lib.sketch import HistogramSketch, QuantileSketch
+
+matplotlib = lazy_import('matplotlib')
+pyplot = lazy_import('matplotlib.pyplot')
 
 
 def display(fig):
+    """Show a figure in a notebook or IPython shell, elsewhere do nothing."""
+    ipython = sys.modules.get('IPython')
+    if ipython is None or ipython.get_ipython() is None:
+        return
+    import IPython.display
     IPython.display.display(fig)
 
 
@@ -22,14 +27,14 @@ def _autoplot(f):
         fig = None
         res = None
         if ax is None:
-            fig, ax = matplotlib.pyplot.subplots()
+            fig, ax = pyplot.subplots()
         try:
             res = f(*args, ax=ax, **kwargs)
             if fig is not None:
                 disp(fig)
         finally:
             if fig is not None and not matplotlib.is_interactive():
-                matplotlib.pyplot.close(fig)
+                pyplot.close(fig)
 
         return res
 
@@ -38,22 +43,22 @@ def _autoplot(f):
 
 @contextlib.contextmanager
 def figure(*args, **kwargs):
-    fig = matplotlib.pyplot.figure(*args, **kwargs)
+    fig = pyplot.figure(*args, **kwargs)
     yield(fig)
     try:
         display(fig)
     finally:
-        matplotlib.pyplot.close(fig)
+        pyplot.close(fig)
 
 
 @contextlib.contextmanager
 def subplots(*args, **kwargs):
-    fig, axs = matplotlib.pyplot.subplots(*args, **kwargs)
+    fig, axs = pyplot.subplots(*args, **kwargs)
     yield fig, axs
     try:
         display(fig)
     finally:
-        matplotlib.pyplot.close(fig)
+        pyplot.close(fig)
 
 
 def _infer_set_ticklabels(ticklabels):
@@ -105,7 +110,7 @@ def heatmap(x, y=None, z=None, mask=None, *, xticklabels=None,
         # x is a matrix
         if y is not None or z is not None:
             raise TypeError("y and z should not be specified if x is matrix.")
-        if isinstance(x, xr.DataArray):
+        if is_instance(x, 'xarray', 'DataArray'):
             Z = x.values
             if xlabel is None:
                 xlabel = x.dims[1]
@@ -209,8 +214,12 @@ def hist(x, bins='sturges', *, range=None, weights=None, density=False,
          facecolor='white', edgecolor='black', title=None,
          xlabel=None, ylabel=None,
          ax):
-    n, bins = np.histogram(x, bins=bins, range=range, weights=weights,
-                           density=density)
+    if isinstance(x, HistogramSketch):
+        n = x.density() if density else x.counts
+        bins = x.edges
+    else:
+        n, bins = np.histogram(x, bins=bins, range=range, weights=weights,
+                               density=density)
 
     # get the corners of the rectangles for the histogram
     left = np.array(bins[:-1])
@@ -261,8 +270,31 @@ def interpolate_quantiles(x, n):
     return x[idx]
 
 
+def qq_probabilities(n, points):
+    """Plotting positions of about `points` of n order statistics.
+
+    The order statistics are spaced logarithmically from both ends, so the
+    tails are drawn in as much detail as the bulk.
+    """
+    ends = np.floor(np.geomspace(1, n, max(points // 2, 2)))
+    i = np.unique(np.concatenate([ends, n + 1 - ends]))
+    return (i - 0.5) / n
+
+
+def _sketch_quantiles(x, q):
+    if isinstance(x, QuantileSketch):
+        return x.quantile(q)
+    return np.percentile(np.asarray(x), 100 * q)
+
+
 @_autoplot
-def qqplot(x, y, *, ax, diagonal=False, xlabel=None, ylabel=None, title=None):
+def qqplot(x, y, *, ax, diagonal=False, xlabel=None, ylabel=None, title=None,
+           points=1000):
+    """Quantiles of y against those of x.
+
+    x and y are arrays or `QuantileSketch`es. With a sketch, about
+    `points` quantiles are drawn, however many values it summarises.
+    """
 
     # Arguments
     if xlabel is None:
@@ -271,13 +303,20 @@ def qqplot(x, y, *, ax, diagonal=False, xlabel=None, ylabel=None, title=None):
         ylabel = False
 
     # Calculations
-    x = np.sort(np.array(x))
-    y = np.sort(np.array(y))
+    if isinstance(x, QuantileSketch) or isinstance(y, QuantileSketch):
+        n = min(v.count if isinstance(v, QuantileSketch) else np.size(v)
+                for v in (x, y))
+        q = qq_probabilities(int(n), points)
+        x = _sketch_quantiles(x, q)
+        y = _sketch_quantiles(y, q)
+    else:
+        x = np.sort(np.array(x))
+        y = np.sort(np.array(y))
 
-    if len(x) > len(y):
-        x = interpolate_quantiles(x, len(y))
-    elif len(y) > len(x):
-        y = interpolate_quantiles(y, len(x))
+        if len(x) > len(y):
+            x = interpolate_quantiles(x, len(y))
+        elif len(y) > len(x):
+            y = interpolate_quantiles(y, len(x))
 
     # Plot
     if diagonal:
@@ -302,7 +341,7 @@ def qqplot(x, y, *, ax, diagonal=False, xlabel=None, ylabel=None, title=None):
 def boxplot(x, y, *, ax, xlabel=None, ylabel=None, title=None):
     if hasattr(x, 'shape') and len(x.shape) == 1:
         # x is a vector
-        if isinstance(x, xr.DataArray):
+        if is_instance(x, 'xarray', 'DataArray'):
             if xlabel is None:
                 xlabel = x.name
             x = x.values
@@ -313,7 +352,7 @@ def boxplot(x, y, *, ax, xlabel=None, ylabel=None, title=None):
         raise NotImplementedError()
     if hasattr(y, 'shape') and len(y.shape) == 1:
         # y is a vector
-        if isinstance(y, xr.DataArray):
+        if is_instance(y, 'xarray', 'DataArray'):
             if ylabel is None:
                 ylabel = y.name
             y = y.values
@@ -354,7 +393,7 @@ def lines(x, y=None, *, ax=None, color='black',
           **kwargs):
     assert(ax is not None)
     if y is None:
-        if isinstance(x, pd.Series):
+        if is_instance(x, 'pandas', 'Series'):
             x_ = x
             x = np.array(x_.index)
             y = np.array(x_)
@@ -362,7 +401,7 @@ def lines(x, y=None, *, ax=None, color='black',
                 xlabel = x_.index.name
             if ylabel is None:
                 ylabel = x_.name
-        elif isinstance(x, xr.DataArray):
+        elif is_instance(x, 'xarray', 'DataArray'):
             assert len(x.shape) == 1
             assert len(x.dims) == 1
             x_ = x
@@ -1,5 +1,8 @@
+from lib import dataset_server
+
+
 def load_gsea_ds(fn):
-    ds = xr.open_dataset(fn).load()
+    ds = dataset_server.open_dataset(fn)
     ds['mri_feature'] = [s.decode() for s in ds['mri_feature'].values]
     ds['mri_feature'] = [" ".join(s.split('_')).title()
                          for s in ds['mri_feature'].values]
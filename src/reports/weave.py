@@ -0,0 +1,482 @@
+"""Weave reports and execute notebooks, with the results of chunks cached.
+
+Code chunks of Pweave markdown (.pmd) reports and code cells of notebooks
+run in a Jupyter kernel, like Pweave and nbconvert do. The outputs of
+every chunk, its text, tables and figures, are stored under a key of its
+source and of the sources, outputs and data of the chunks before it. A
+stored result is used while the files the chunk read are unchanged, so
+editing prose runs no code at all. Files read are those the kernel opens
+from Python, which includes imported modules of the project, those opened
+with `lib.dataset_server.open_dataset`, which raises the same audit event,
+and the existing paths in string literals of the chunk. Other files opened
+by C libraries such as netCDF, with a path that is not a literal, for
+instance an f-string, are not tracked.
+
+A chunk that has to run needs the state of the chunks before it, so the
+cached chunks before it are run again first, without keeping their
+outputs. Reports are woven in parallel, each in its own kernel.
+"""
+import ast
+import base64
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+
+import click
+
+from lib import click_utils
+
+chunk_start = re.compile(r'^```\s*\{?python\b(?P<options>[^}]*)\}?\s*$')
+chunk_end = re.compile(r'^```\s*$')
+inline_code = re.compile(r'<%(?P<expression>=?)(?P<code>.*?)%>', re.DOTALL)
+ansi_escape = re.compile(r'\x1b\[[0-9;]*m')
+
+default_options = {
+    'echo': True,
+    'evaluate': True,
+    'fig': True,
+    'include': True,
+    'results': 'verbatim',
+    'caption': '',
+}
+
+# Run in the kernel before the first chunk. Files opened for reading are
+# recorded by an audit hook, if Python has them.
+kernel_setup = '''
+%matplotlib inline
+import sys as _weave_sys
+
+_weave_read = set()
+
+
+def _weave_audit(event, args):
+    if event != 'open' or not isinstance(args[0], str):
+        return
+    mode = args[1]
+    if mode is None:
+        if args[2] & 3 == 0:
+            _weave_read.add(args[0])
+    elif not any(c in mode for c in 'wax+'):
+        _weave_read.add(args[0])
+
+
+def _weave_pop_read():
+    read = sorted(_weave_read)
+    _weave_read.clear()
+    return read
+
+
+if hasattr(_weave_sys, 'addaudithook'):
+    _weave_sys.addaudithook(_weave_audit)
+'''
+
+
+class Chunk:
+    """Code to run, with Pweave chunk options."""
+
+    def __init__(self, source, name=None, options=None, inline=False):
+        self.source = source
+        self.name = name
+        self.options = dict(default_options, **(options or {}))
+        self.inline = inline
+
+
+def parse_chunk_options(text):
+    """Name and options of a chunk header like `name, fig=False`."""
+    name = None
+    options = dict()
+    for i, item in enumerate(re.split(r',(?=(?:[^"\']*["\'][^"\']*["\'])*'
+                                      r'[^"\']*$)', text)):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            if i == 0:
+                name = item
+            continue
+        key, value = item.split('=', 1)
+        try:
+            options[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            options[key.strip()] = value.strip()
+    return name, options
+
+
+def parse_pmd(text):
+    """Parts of a report, prose as strings and code as chunks.
+
+    Inline code in prose, `<% code %>` or `<%= expression %>`, becomes an
+    inline chunk. Code of a chunk with a `source` option is read from
+    that file.
+    """
+    parts = []
+    prose = []
+    lines = iter(text.splitlines(keepends=True))
+    for line in lines:
+        match = chunk_start.match(line)
+        if not match:
+            prose.append(line)
+            continue
+        parts.extend(_parse_prose(''.join(prose)))
+        prose = []
+        source = []
+        for line in lines:
+            if chunk_end.match(line):
+                break
+            source.append(line)
+        name, options = parse_chunk_options(match.group('options'))
+        source = ''.join(source)
+        if 'source' in options:
+            source = Path(options['source']).read_text()
+        parts.append(Chunk(source.strip('\n'), name, options))
+    parts.extend(_parse_prose(''.join(prose)))
+    return parts
+
+
+def _parse_prose(text):
+    parts = []
+    start = 0
+    for match in inline_code.finditer(text):
+        parts.append(text[start:match.start()])
+        code = match.group('code').strip()
+        if match.group('expression'):
+            code = f"print({code}, end='')"
+        parts.append(Chunk(code, inline=True,
+                           options={'echo': False, 'fig': False}))
+        start = match.end()
+    parts.append(text[start:])
+    return [p for p in parts if not isinstance(p, str) or p]
+
+
+def literal_paths(source):
+    """Existing files named by string literals of Python code."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    strings = [node.value for node in ast.walk(tree)
+               if isinstance(node, ast.Constant) and
+               isinstance(node.value, str)]
+    return [s for s in strings if len(s) < 512 and os.path.isfile(s)]
+
+
+class ResultCache:
+    """Outputs of the chunks of one document, by key.
+
+    An entry records the digests of the files the chunk read, it is valid
+    while these are the same. Digests are computed once per size and
+    modification time of a file.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.digest_path = self.directory / 'file-digests.json'
+        try:
+            self.digests = json.loads(self.digest_path.read_text())
+        except (OSError, ValueError):
+            self.digests = dict()
+        self.used = set()
+
+    def file_digest(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        known = self.digests.get(path)
+        if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.digests[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def get(self, key):
+        """Outputs and file digests of a valid entry, else None."""
+        path = self.directory / f"{key}.json"
+        try:
+            entry = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+        for file, digest in entry['files'].items():
+            if self.file_digest(file) != digest:
+                return None
+        self.used.add(key)
+        return entry
+
+    def put(self, key, outputs, files):
+        entry = {'outputs': outputs,
+                 'files': {f: self.file_digest(f) for f in files}}
+        part = self.directory / f"{key}.json.part"
+        part.write_text(json.dumps(entry))
+        part.replace(self.directory / f"{key}.json")
+        self.used.add(key)
+        return entry
+
+    def close(self):
+        """Remove the entries not used by this build, save the digests."""
+        for path in self.directory.glob('*.json'):
+            if path != self.digest_path and path.stem not in self.used:
+                path.unlink()
+        part = self.digest_path.with_suffix('.json.part')
+        part.write_text(json.dumps(self.digests))
+        part.replace(self.digest_path)
+
+
+class Kernel:
+    """Jupyter kernel started when the first chunk has to run.
+
+    Chunks taken from the cache are queued with `skip`, and run before the
+    next chunk that is executed, to restore the state of the kernel.
+    """
+
+    def __init__(self, kernel_name, cwd, timeout):
+        self.kernel_name = kernel_name
+        self.cwd = cwd
+        self.timeout = timeout
+        self.manager = None
+        self.client = None
+        self.skipped = []
+
+    def skip(self, source):
+        self.skipped.append(source)
+
+    def execute(self, source):
+        """Outputs, files read and whether the code ran without error."""
+        if self.client is None:
+            self._start()
+        for skipped in self.skipped:
+            self._execute(skipped)
+        self.skipped = []
+        return self._execute(source)
+
+    def _start(self):
+        from jupyter_client.manager import KernelManager
+        self.manager = KernelManager(kernel_name=self.kernel_name)
+        self.manager.start_kernel(cwd=self.cwd)
+        self.client = self.manager.client()
+        self.client.start_channels()
+        self.client.wait_for_ready(timeout=60)
+        self._execute(kernel_setup)
+
+    def _execute(self, source):
+        from nbformat.v4 import output_from_msg
+        outputs = []
+
+        def collect(msg):
+            msg_type = msg['header']['msg_type']
+            if msg_type in ('stream', 'display_data', 'execute_result',
+                            'error'):
+                output = output_from_msg(msg)
+                # Keep outputs the same between runs
+                if 'execution_count' in output:
+                    output['execution_count'] = None
+                outputs.append(output)
+            elif msg_type == 'clear_output':
+                outputs.clear()
+
+        reply = self.client.execute_interactive(
+            source, store_history=False, timeout=self.timeout,
+            user_expressions={'read': '_weave_pop_read()'},
+            output_hook=collect)
+        content = reply['content']
+        if content['status'] != 'ok':
+            return outputs, [], False
+        read = content['user_expressions'].get('read', {})
+        files = ast.literal_eval(read.get('data', {}).get('text/plain', '[]'))
+        return outputs, files, True
+
+    def close(self):
+        if self.client is not None:
+            self.client.stop_channels()
+            self.manager.shutdown_kernel()
+
+
+def project_files(files, cwd, ignore):
+    """Files inside the working directory, relative to it, except those in
+    the `ignore` directories."""
+    root = str(Path.cwd()) + os.sep
+    ignore = [str(i) + os.sep for i in ignore]
+    result = set()
+    for f in files:
+        path = str((Path(cwd) / f).resolve())
+        if (path.startswith(root) and os.path.isfile(path) and
+                not any(path.startswith(i) for i in ignore)):
+            result.add(path[len(root):])
+    return sorted(result)
+
+
+def run_chunks(chunks, cache, kernel, allow_errors, ignore):
+    """Outputs of every chunk, from the cache where it is valid.
+
+    After an error, the state of the kernel is unknown, so the chunks after
+    it run without the cache.
+    """
+    state = ''
+    failed = False
+    results = []
+    for chunk in chunks:
+        if not chunk.options['evaluate']:
+            results.append([])
+            continue
+        if failed:
+            results.append(kernel.execute(chunk.source)[0])
+            continue
+        key = hashlib.sha256(
+            json.dumps([state, chunk.source]).encode()).hexdigest()
+        entry = cache.get(key)
+        if entry is not None:
+            kernel.skip(chunk.source)
+        else:
+            outputs, files, ok = kernel.execute(chunk.source)
+            if not ok:
+                error = next(o for o in outputs if o['output_type'] == 'error')
+                message = ansi_escape.sub('', '\n'.join(error['traceback']))
+                if not allow_errors:
+                    raise click.ClickException(
+                        f"Error in chunk {chunk.name or len(results) + 1}:\n"
+                        f"{message}")
+                click.echo(message, err=True)
+                results.append(outputs)
+                failed = True
+                continue
+            files = project_files(files + literal_paths(chunk.source),
+                                  kernel.cwd, ignore)
+            entry = cache.put(key, outputs, files)
+        state = hashlib.sha256(json.dumps(
+            [key, sorted(entry['files'].items()), entry['outputs']],
+            sort_keys=True).encode()).hexdigest()
+        results.append(entry['outputs'])
+    return results
+
+
+def _text_block(text):
+    return f"~~~~\n{text.rstrip()}\n~~~~~~~~~~~~~\n\n" if text.strip() else ''
+
+
+def render_markdown(parts, results, figure_dir, figure_prefix):
+    """Pandoc markdown of a report, figures written to `figure_dir`."""
+    figure_dir.mkdir(parents=True, exist_ok=True)
+    chunks = iter(results)
+    markdown = []
+    for i, part in enumerate(parts):
+        if isinstance(part, str):
+            markdown.append(part)
+            continue
+        outputs = next(chunks)
+        if part.inline:
+            markdown.append(''.join(o.get('text', '') for o in outputs
+                                    if o['output_type'] == 'stream').strip())
+            continue
+        if not part.options['include']:
+            continue
+        name = part.name or f"chunk{i + 1}"
+        if part.options['echo']:
+            markdown.append(f"~~~~{{.python}}\n{part.source}\n"
+                            "~~~~~~~~~~~~~\n\n")
+        n_figures = 0
+        for output in outputs:
+            kind = output['output_type']
+            if kind == 'stream':
+                if part.options['results'] != 'hidden':
+                    markdown.append(_text_block(output['text']))
+            elif kind == 'error':
+                markdown.append(_text_block(ansi_escape.sub(
+                    '', '\n'.join(output['traceback']))))
+            else:
+                data = output['data']
+                image = next((t for t in ('image/png', 'image/svg+xml')
+                              if t in data), None)
+                if image is not None:
+                    n_figures += 1
+                    ext = 'png' if image == 'image/png' else 'svg'
+                    fn = f"{figure_prefix}_{name}_{n_figures}.{ext}"
+                    content = data[image]
+                    (figure_dir / fn).write_bytes(
+                        base64.b64decode(content) if ext == 'png'
+                        else content.encode())
+                    if part.options['fig']:
+                        markdown.append(f"![{part.options['caption']}]"
+                                        f"({figure_dir.name}/{fn})\\\n\n")
+                elif part.options['results'] == 'hidden':
+                    continue
+                elif 'text/markdown' in data:
+                    markdown.append(data['text/markdown'] + "\n\n")
+                elif 'text/html' in data:
+                    markdown.append(data['text/html'] + "\n\n")
+                elif 'text/plain' in data:
+                    markdown.append(_text_block(data['text/plain']))
+    return ''.join(markdown)
+
+
+def weave(source, out_dir, cache_dir, kernel_name, timeout, allow_errors):
+    """Weave a report or execute a notebook, returns the output path."""
+    source = Path(source)
+    out_dir = Path(out_dir) if out_dir else source.parent
+    cache = ResultCache(Path(cache_dir) / source.stem)
+    figure_dir = out_dir / 'figures'
+    ignore = [Path(cache_dir).resolve(), figure_dir.resolve()]
+    if source.suffix == '.ipynb':
+        import nbformat
+        notebook = nbformat.read(str(source), as_version=4)
+        cells = [c for c in notebook.cells if c.cell_type == 'code']
+        chunks = [Chunk(c.source, f"cell{i + 1}") for i, c in enumerate(cells)]
+        # Notebooks run in their directory, like with nbconvert
+        kernel = Kernel(kernel_name, str(source.parent), timeout)
+    else:
+        parts = parse_pmd(source.read_text())
+        chunks = [p for p in parts if isinstance(p, Chunk)]
+        kernel = Kernel(kernel_name, str(Path.cwd()), timeout)
+
+    try:
+        results = run_chunks(chunks, cache, kernel, allow_errors, ignore)
+    finally:
+        kernel.close()
+    cache.close()
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if source.suffix == '.ipynb':
+        for cell, outputs in zip(cells, results):
+            cell.outputs = [nbformat.from_dict(o) for o in outputs]
+        out = out_dir / source.name
+        nbformat.write(notebook, str(out))
+    else:
+        out = out_dir / f"{source.stem}.md"
+        out.write_text(render_markdown(parts, results, figure_dir,
+                                       source.stem))
+    return out
+
+
+@click.command()
+@click.argument('sources', nargs=-1, required=True, type=click_utils.in_path)
+@click.option('--out-dir', type=click.Path(file_okay=False), default=None,
+              help="Directory of the outputs, by default that of the "
+                   "sources.")
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              required=True, help="Directory of the cached chunk results.")
+@click.option('--kernel', 'kernel_name', default='python3')
+@click.option('--timeout', default=1800, help="Seconds per chunk.")
+@click.option('--allow-errors', is_flag=True,
+              help="Include errors in the output instead of failing.")
+@click.option('-j', '--jobs', default=1, help="Number of parallel kernels.")
+def weave_reports(sources, out_dir, cache_dir, kernel_name, timeout,
+                  allow_errors, jobs):
+    """Weave .pmd reports to markdown and execute .ipynb notebooks."""
+    args = [(s, out_dir, cache_dir, kernel_name, timeout, allow_errors)
+            for s in sources]
+    if jobs == 1:
+        outs = [weave(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            outs = list(pool.map(weave, *zip(*args)))
+    for out in outs:
+        click.echo(f"Wrote {out}", err=True)
+
+
+if __name__ == '__main__':
+    weave_reports()
@@ -1,8 +1,11 @@
 from itertools import product
 
 import numpy as np
-import scipy.stats
-import xarray as xr
+
+from lib.lazy import lazy_import
+
+stats = lazy_import('scipy.stats')
+xr = lazy_import('xarray')
 
 
 def swivel_dim(x, dim):
@@ -11,16 +14,26 @@ def swivel_dim(x, dim):
 
 
 _cor_funs = {
-    'pearson': scipy.stats.pearsonr,
-    'spearman': scipy.stats.spearmanr,
+    'pearson': 'pearsonr',
+    'spearman': 'spearmanr',
 }
 
 
-def cor(x, y, dim=0, *, nan_policy='omit', method='pearson'):
-    cor_fun = _cor_funs.get(method, None)
-    if cor_fun is None:
+def cor(x, y, dim=0, *, nan_policy='omit', method='pearson', max_p=None,
+        max_fdr=None, top_k=None, block_size=None):
+    """Correlation of every feature of x with every feature of y.
+
+    By default returns the dense grid of all pairs. With `max_p`, `max_fdr`
+    or `top_k` the pairs are tested in blocks of `block_size` features of x
+    and only the pairs passing the thresholds are returned, as a list along
+    dimension `pair`. See `sparse_cor`.
+    """
+    if method not in _cor_funs:
         raise ValueError("cor_fun must be one of {" +
                          ",".join(_cor_funs.keys()) + "}")
+    cor_fun = getattr(stats, _cor_funs[method])
+    if nan_policy not in ('propagate', 'omit'):
+        raise ValueError("nan_policy must be one of {'propagate', 'omit'}")
 
     if isinstance(dim, str):
         x_dim = x.dims.index(dim)
@@ -67,6 +80,12 @@ def cor(x, y, dim=0, *, nan_policy='omit', method='pearson'):
 
     fshape_x = x_a.shape[1:]
     fshape_y = y_a.shape[1:]
+    if max_p is not None or max_fdr is not None or top_k is not None:
+        return sparse_cor(x_a, y_a, fdim_x, fdim_y, coords,
+                          nan_policy=nan_policy, method=method, max_p=max_p,
+                          max_fdr=max_fdr, top_k=top_k,
+                          block_size=block_size)
+
     cor_a = np.full(fshape_x + fshape_y, np.nan)
     p_a = np.full(fshape_x + fshape_y, np.nan)
     fiter_x = product(*[range(n) for n in fshape_x])
@@ -91,3 +110,213 @@ def cor(x, y, dim=0, *, nan_policy='omit', method='pearson'):
     cor_da = xr.DataArray(cor_a, dims=fdim_x+fdim_y)
     return xr.Dataset({'correlation': cor_da, 'nominal_p': p_da},
                       coords=coords)
+
+
+def bh_adjust(p, n_tests=None):
+    """Benjamini-Hochberg adjusted p-values.
+
+    `p` may be the smallest p-values of `n_tests` tests. The adjusted
+    values are then exact where they are at most the largest p-value left
+    out, and an upper bound elsewhere.
+    """
+    p = np.asarray(p, dtype=float)
+    if n_tests is None:
+        n_tests = p.size
+    order = np.argsort(p)
+    ranked = p[order] * n_tests / np.arange(1, p.size + 1)
+    adjusted = np.empty_like(p)
+    adjusted[order] = np.fmin.accumulate(ranked[::-1])[::-1]
+    return np.fmin(adjusted, 1.0)
+
+
+def _pearson_block(x, y, nan_policy):
+    """Pearson correlations and p-values of all columns of x and y.
+
+    Missing values are left out per pair, as the sums are computed over
+    the observations where both columns are finite.
+    """
+    x_ok = np.isfinite(x)
+    y_ok = np.isfinite(y)
+    # Center for numerical stability, the per pair means are corrected for
+    # in the sums below
+    x0 = np.where(x_ok, x - np.nanmean(x, axis=0), 0.0)
+    y0 = np.where(y_ok, y - np.nanmean(y, axis=0), 0.0)
+    x_okf = x_ok.astype(float)
+    y_okf = y_ok.astype(float)
+
+    n = x_okf.T @ y_okf
+    sx = x0.T @ y_okf
+    sy = x_okf.T @ y0
+    sxx = (x0 * x0).T @ y_okf
+    syy = x_okf.T @ (y0 * y0)
+    sxy = x0.T @ y0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = ((n * sxy - sx * sy) /
+             np.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy)))
+        r = np.clip(r, -1.0, 1.0)
+        df = n - 2
+        t = r * np.sqrt(df / ((1.0 - r) * (1.0 + r)))
+    p = 2 * stats.t.sf(np.abs(t), df)
+    invalid = n < 3
+    if nan_policy == 'propagate':
+        invalid |= n < x.shape[0]
+    r[invalid] = np.nan
+    p[invalid | np.isnan(r)] = np.nan
+    return r, p
+
+
+def _rank(a, tie_sizes=False):
+    """Ranks of the columns of a, ties get their average rank.
+
+    With `tie_sizes`, also return the number of values tied with each
+    value, itself included.
+    """
+    # Sorting rows of the transpose is much faster than sorting columns
+    a_t = np.ascontiguousarray(a.T)
+    order = np.argsort(a_t, axis=1)
+    rows = np.arange(a_t.shape[0])[:, np.newaxis]
+    sorted_a = a_t[rows, order]
+    n = a_t.shape[1]
+    positions = np.broadcast_to(np.arange(n), a_t.shape)
+    new_value = np.ones(a_t.shape, dtype=bool)
+    new_value[:, 1:] = sorted_a[:, 1:] != sorted_a[:, :-1]
+    # First and last position of the run of ties of each value
+    first = np.maximum.accumulate(np.where(new_value, positions, 0), axis=1)
+    last_value = np.ones(a_t.shape, dtype=bool)
+    last_value[:, :-1] = new_value[:, 1:]
+    last = np.minimum.accumulate(
+        np.where(last_value, positions, n)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(a_t.shape)
+    ranks[rows, order] = (first + last) / 2 + 1
+    if not tie_sizes:
+        return ranks.T
+    sizes = np.empty(a_t.shape, dtype=int)
+    sizes[rows, order] = last - first + 1
+    return ranks.T, sizes.T
+
+
+def _spearman_block(x, y, nan_policy):
+    """Spearman correlations and p-values of all columns of x and y."""
+    x_ok = np.isfinite(x)
+    y_ok = np.isfinite(y)
+    if x_ok.all() and y_ok.all() or nan_policy == 'propagate':
+        # Pairs with missing values are discarded by _pearson_block
+        x_rank = np.where(x_ok, _rank(np.where(x_ok, x, 0.0)), np.nan)
+        y_rank = np.where(y_ok, _rank(np.where(y_ok, y, 0.0)), np.nan)
+        return _pearson_block(x_rank, y_rank, nan_policy)
+
+    # Ranks depend on which observations are left out, so rank x once for
+    # every pattern of missing values in y
+    complete = x_ok.all(axis=0)
+    r = np.full((x.shape[1], y.shape[1]), np.nan)
+    p = np.full((x.shape[1], y.shape[1]), np.nan)
+    patterns, pattern_i = np.unique(y_ok.T, axis=0, return_inverse=True)
+    for obs, cols in zip(patterns, (np.where(pattern_i.ravel() == i)[0]
+                                    for i in range(len(patterns)))):
+        r_p, p_p = _pearson_block(_rank(x[obs][:, complete]),
+                                  _rank(y[obs][:, cols]), nan_policy)
+        r[np.ix_(complete, cols)] = r_p
+        p[np.ix_(complete, cols)] = p_p
+        for i, j in product(np.where(~complete)[0], cols):
+            ok = obs & x_ok[:, i]
+            if ok.sum() >= 3:
+                r[i, j], p[i, j] = stats.spearmanr(x[ok, i], y[ok, j])
+    return r, p
+
+
+_cor_blocks = {
+    'pearson': _pearson_block,
+    'spearman': _spearman_block,
+}
+
+
+def _top_k(y_i, p, k):
+    """Mask of the k smallest p-values per feature of y."""
+    order = np.lexsort((p, y_i))
+    y_sorted = y_i[order]
+    first = np.searchsorted(y_sorted, y_sorted, side='left')
+    keep = np.zeros(len(p), dtype=bool)
+    keep[order] = np.arange(len(p)) - first < k
+    return keep
+
+
+def sparse_cor(x, y, fdim_x, fdim_y, coords, *, nan_policy='omit',
+               method='pearson', max_p=None, max_fdr=None, top_k=None,
+               block_size=None):
+    """Correlations passing thresholds, computed block by block.
+
+    x and y are arrays with observations along the first axis. Only pairs
+    with a p-value at most the candidate threshold, `max_fdr` or else
+    `max_p`, are kept between blocks, together with the number of tests
+    for the Benjamini-Hochberg FDR. With only `top_k`, at most `top_k`
+    pairs per feature of y are kept between blocks.
+
+    Returns a dataset along dimension `pair`, ordered by p-value, with for
+    every feature dimension the label of the pair. The fdr is exact where
+    it is at most the candidate threshold and is left out with only
+    `top_k`.
+    """
+    for name, value in (('max_p', max_p), ('max_fdr', max_fdr)):
+        if value is not None and not 0 < value <= 1:
+            raise ValueError(f"{name} must be in (0, 1]")
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be at least 1")
+
+    fshape_x = x.shape[1:]
+    fshape_y = y.shape[1:]
+    x = x.reshape(x.shape[0], -1).astype(float)
+    y = y.reshape(y.shape[0], -1).astype(float)
+    n_x = x.shape[1]
+    n_y = y.shape[1]
+    if block_size is None:
+        block_size = max(1, min(2**20 // max(n_y, 1),
+                                2**24 // max(x.shape[0], 1)))
+    if max_fdr is not None:
+        candidate_p = max(max_fdr, max_p or 0)
+    else:
+        candidate_p = max_p
+
+    cor_block = _cor_blocks[method]
+    kept = []
+    n_tests = 0
+    for start in range(0, n_x, block_size):
+        r, p = cor_block(x[:, start:start+block_size], y, nan_policy)
+        n_tests += int(np.isfinite(p).sum())
+        if candidate_p is not None:
+            x_i, y_i = np.nonzero(p <= candidate_p)
+        else:
+            x_i, y_i = np.nonzero(np.isfinite(p))
+        kept.append((x_i + start, y_i, r[x_i, y_i], p[x_i, y_i]))
+        if candidate_p is None:
+            # Merge with the best pairs of earlier blocks
+            merged = [np.concatenate(a) for a in zip(*kept)]
+            keep = _top_k(merged[1], merged[3], top_k)
+            kept = [tuple(a[keep] for a in merged)]
+
+    x_i, y_i, r, p = (np.concatenate(a) for a in zip(*kept))
+    data_vars = {'correlation': r, 'nominal_p': p}
+    if candidate_p is not None:
+        fdr = bh_adjust(p, n_tests)
+        keep = np.ones(len(p), dtype=bool)
+        if max_p is not None:
+            keep &= p <= max_p
+        if max_fdr is not None:
+            keep &= fdr <= max_fdr
+        if top_k is not None:
+            keep[keep] = _top_k(y_i[keep], p[keep], top_k)
+        x_i, y_i, r, p, fdr = (a[keep] for a in (x_i, y_i, r, p, fdr))
+        data_vars = {'correlation': r, 'nominal_p': p, 'fdr': fdr}
+
+    order = np.argsort(p, kind='mergesort')
+    pair_coords = dict()
+    for fdims, fshape, flat_i in ((fdim_x, fshape_x, x_i[order]),
+                                  (fdim_y, fshape_y, y_i[order])):
+        for d, i in zip(fdims, np.unravel_index(flat_i, fshape)):
+            if d in coords:
+                pair_coords[d] = ('pair', np.asarray(coords[d])[i])
+            else:
+                pair_coords[d] = ('pair', i)
+    ds = xr.Dataset({k: ('pair', v[order]) for k, v in data_vars.items()},
+                    coords=pair_coords)
+    ds.attrs['n_tests'] = n_tests
+    return ds
@@ -1,7 +1,6 @@
 import click
-import xarray as xr
 
-from lib import click_utils
+from lib import click_utils, dataset_server
 import plot
 from visualization.labels import feature_order, feature_display_names
 from visualization.style import set_style
@@ -11,7 +10,8 @@ from visualization.style import set_style
 @click.argument('cad_factors', type=click_utils.in_path)
 @click.argument('out', type=click_utils.out_path)
 def plot_mri_cad_factors(cad_factors, out):
-    fa_dataset = xr.open_dataset(cad_factors).load()
+    set_style()
+    fa_dataset = dataset_server.open_dataset(cad_factors)
 
     assert all(f in feature_order for f in fa_dataset['cad_feature'].values)
     fa_dataset = fa_dataset.reindex(cad_feature=feature_order)
@@ -32,5 +32,4 @@ def plot_mri_cad_factors(cad_factors, out):
 
 
 if __name__ == '__main__':
-    set_style()
     plot_mri_cad_factors()
@@ -1,23 +1,25 @@
 import click
 import numpy as np
-import sklearn
-import xarray as xr
 
-from features.fa_mri_features import read_mri, adjust_scale
-from lib import click_utils
+from lib import click_utils, dataset_server
+from lib.lazy import lazy_import
 import plot
 from visualization.style import set_style
 
+decomposition = lazy_import('sklearn.decomposition')
+fa_mri_features = lazy_import('features.fa_mri_features')
+
 
 @click.command()
 @click.argument('mri_features', type=click_utils.in_path)
 @click.argument('out', type=click_utils.out_path)
 def plot_fa_variance_explained(mri_features, out):
-    mri_data_set = xr.open_dataset(mri_features).load()
-    mri = read_mri(mri_data_set)
-    mri = adjust_scale(mri)
+    set_style()
+    mri_data_set = dataset_server.open_dataset(mri_features)
+    mri = fa_mri_features.read_mri(mri_data_set)
+    mri = fa_mri_features.adjust_scale(mri)
 
-    pca = sklearn.decomposition.PCA()
+    pca = decomposition.PCA()
     mri_a = (mri / mri.std('case')).values
     pca.fit(mri_a)
 
@@ -67,6 +69,4 @@ def plot_fa_variance_explained(mri_features, out):
 
 
 if __name__ == '__main__':
-    set_style()
-
     plot_fa_variance_explained()
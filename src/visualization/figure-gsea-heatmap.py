@@ -5,13 +5,15 @@ import click
 import matplotlib
 import matplotlib.cm
 import numpy as np
-import pandas as pd
-import xarray as xr
 
-from lib import click_utils
+from lib import click_utils, dataset_server
+from lib.lazy import lazy_import
 import plot
 from visualization.style import set_style
 
+pd = lazy_import('pandas')
+xr = lazy_import('xarray')
+
 gs_labels = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X"]
 gs_label_props = dict(
     weight='bold',
@@ -245,12 +247,13 @@ def plot_gsea_heatmap(gsea, genesets_annot, factor_idx, fig, abs):
 @click.argument('factor', type=int)
 @click.argument('out', type=click_utils.out_path)
 def plot_gsea_heatmap_(gsea_results, sel_genesets, factor, out):
+    set_style()
     print(gsea_results)
     if gsea_results.endswith("_T.nc"):
         abs = True
     else:
         abs = False
-    gsea = xr.open_dataset(gsea_results).load()
+    gsea = dataset_server.open_dataset(gsea_results)
     gsea['gene_set'] = (xr.apply_ufunc(np.char.decode, gsea['gene_set'])
                         .astype('object'))
     gsea['mri_feature'] = np.arange(1, gsea['mri_feature'].shape[0]+1, dtype='i2')
@@ -266,5 +269,4 @@ def plot_gsea_heatmap_(gsea_results, sel_genesets, factor, out):
 
 
 if __name__ == '__main__':
-    set_style()
     plot_gsea_heatmap_()
@@ -1,17 +1,20 @@
 import click
 import numpy as np
-import xarray as xr
 
 from lib import click_utils
+from lib.lazy import lazy_import
 import plot
 from visualization.labels import feature_order, feature_display_names
 from visualization.style import set_style
 
+xr = lazy_import('xarray')
+
 
 @click.command()
 @click.argument('mri_features', type=click_utils.in_path)
 @click.argument('out', type=click_utils.out_path)
 def plot_mri_cad_factor_correlation(mri_features, out):
+    set_style()
     mri_ds = xr.open_dataset(mri_features)
     del mri_ds['Comment']
     del mri_ds['MultiFocal']
@@ -53,5 +56,4 @@ def plot_mri_cad_factor_correlation(mri_features, out):
 
 
 if __name__ == '__main__':
-    set_style()
     plot_mri_cad_factor_correlation()
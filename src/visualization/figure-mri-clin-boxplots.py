@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import click
+import numpy as np
+
+from analysis.mri_clinical_association import (
+    default_missing_codes, read_clinical, read_mri, clinical_codes,
+)
+from lib import click_utils
+from lib.lazy import lazy_import
+import plot
+from visualization.style import set_style
+from visualization.labels import (
+    clin_display_names, factor_display_names, feature_display_names,
+)
+
+xr = lazy_import('xarray')
+
+
+def hits(assoc, max_fdr):
+    """MRI feature and clinical variable of significant group differences.
+
+    Correlations with numeric variables are not shown as boxplots.
+    """
+    grouped = assoc['test'] != 'spearman'
+    sig = (assoc['fdr'] <= max_fdr) & grouped
+    feature_i, clinical_i = np.where(sig.values)
+    return [(assoc['mri_feature'].values[i], assoc['clinical'].values[j])
+            for i, j in zip(feature_i, clinical_i)]
+
+
+def group_labels(labels):
+    """Labels of the groups, numbers without a fraction as integers."""
+    if labels.dtype.kind == 'f' and np.all(labels == np.round(labels)):
+        return labels.astype(int).astype(str)
+    return labels.astype(str)
+
+
+@click.command()
+@click.argument('association', type=click_utils.in_path)
+@click.argument('mri_features', type=click_utils.in_path)
+@click.argument('cad_factors', type=click_utils.in_path)
+@click.argument('factor_annotation', type=click_utils.in_path)
+@click.argument('clinical_annotation', type=click_utils.in_path)
+@click.argument('out_dir', type=click.Path(file_okay=False))
+@click.option('--fdr', 'max_fdr', default=0.05,
+              help="Maximum FDR of the associations to plot.")
+@click.option('--missing-code', 'missing_codes', multiple=True, type=int,
+              default=default_missing_codes,
+              help="Code of unknown clinical values.")
+def plot_clin_boxplots(association, mri_features, cad_factors,
+                       factor_annotation, clinical_annotation, out_dir,
+                       max_fdr, missing_codes):
+    """Boxplots of all significant MRI-clinical associations."""
+    set_style()
+    assoc = xr.open_dataset(association).load()
+    mri = read_mri(mri_features, cad_factors, factor_annotation)
+    clinical = read_clinical(clinical_annotation, mri['case'])
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    for mri_feature, clinical_var in hits(assoc, max_fdr):
+        result = assoc.sel(mri_feature=mri_feature, clinical=clinical_var)
+        codes, labels = clinical_codes(clinical[clinical_var].values,
+                                       missing_codes)
+        values = mri.sel(mri_feature=mri_feature).values
+        known = (codes >= 0) & np.isfinite(values)
+        name = str(result['name'].values)
+        if result['source'] == 'factor':
+            fn = f"clin-boxplotf-{clinical_var}-{name}"
+            ylabel = factor_display_names.get(name, name)
+        else:
+            fn = f"clin-boxplot-{clinical_var}-{name}"
+            ylabel = feature_display_names.get(name, name)
+
+        with plot.subplots(figsize=(3.5, 3.5)) as (fig, ax):
+            plot.boxplot(
+                group_labels(labels)[codes[known]], values[known],
+                title="",
+                xlabel=clin_display_names.get(clinical_var, clinical_var),
+                ylabel=ylabel,
+                ax=ax,
+            )
+            fig.savefig(str(out_dir / f"{fn}.svg"), format='svg')
+
+        with (out_dir / f"{fn}_stats.txt").open('w') as f:
+            f.write(f"test: {result['test'].values}\n")
+            f.write(f"statistic: {float(result['statistic']):.6e}\n")
+            f.write(f"p: {float(result['nominal_p']):.6e}\n")
+            f.write(f"fdr: {float(result['fdr']):.6e}\n")
+            f.write(f"n: {int(result['n'])}\n")
+
+
+if __name__ == '__main__':
+    plot_clin_boxplots()
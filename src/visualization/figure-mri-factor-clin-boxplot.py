@@ -1,14 +1,16 @@
 import click
 import numpy as np
-import scipy.stats
 import yaml
-import xarray as xr
 
 from lib import click_utils
+from lib.lazy import lazy_import
 import plot
 from visualization.style import set_style
 from visualization.labels import factor_display_names, clin_display_names
 
+stats = lazy_import('scipy.stats')
+xr = lazy_import('xarray')
+
 
 def only(lst):
     assert len(lst) == 1
@@ -34,6 +36,7 @@ def split_by(x, y):
 @click.argument('stats_out', type=click_utils.out_path)
 def plot_factor_in_subtype(cad_factors, factor_id, factor_annotation,
                            clinical_annotation, clinical_var, out, stats_out):
+    set_style()
     factor_da = xr.open_dataset(cad_factors)['factors']
     with open(factor_annotation) as f:
         factor_index = only([i for i, v in yaml.load(f).items()
@@ -55,12 +58,11 @@ def plot_factor_in_subtype(cad_factors, factor_id, factor_annotation,
         fig.savefig(out, format='svg')
 
     factor_by_clin = split_by(factor.values, clin.values)
-    h, p = scipy.stats.kruskal(*factor_by_clin.values())
+    h, p = stats.kruskal(*factor_by_clin.values())
     with open(stats_out, 'w') as f:
         f.write(f"h: {h:.6e}\n")
         f.write(f"p: {p:.6e}\n")
 
 
 if __name__ == '__main__':
-    set_style()
     plot_factor_in_subtype()
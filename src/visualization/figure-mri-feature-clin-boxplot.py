@@ -1,14 +1,16 @@
 import click
 import numpy as np
-import scipy.stats
 import yaml
-import xarray as xr
 
 from lib import click_utils
+from lib.lazy import lazy_import
 import plot
 from visualization.style import set_style
 from visualization.labels import feature_display_names, clin_display_names
 
+stats = lazy_import('scipy.stats')
+xr = lazy_import('xarray')
+
 
 def only(lst):
     assert len(lst) == 1
@@ -33,6 +35,7 @@ def split_by(x, y):
 @click.argument('stats_out', type=click_utils.out_path)
 def plot_factor_in_subtype(mri_features, feature_id, clinical_annotation,
                            clinical_var, out, stats_out):
+    set_style()
     mri_ds = xr.open_dataset(mri_features)
     feature = mri_ds[feature_id]
 
@@ -50,12 +53,11 @@ def plot_factor_in_subtype(mri_features, feature_id, clinical_annotation,
         fig.savefig(out, format='svg')
 
     feature_by_clin = split_by(feature.values, clin.values)
-    h, p = scipy.stats.kruskal(*feature_by_clin.values())
+    h, p = stats.kruskal(*feature_by_clin.values())
     with open(stats_out, 'w') as f:
         f.write(f"h: {h:.6e}\n")
         f.write(f"p: {p:.6e}\n")
 
 
 if __name__ == '__main__':
-    set_style()
     plot_factor_in_subtype()
@@ -1,7 +1,11 @@
-import matplotlib
+from lib.lazy import lazy_import
 
+matplotlib = lazy_import('matplotlib')
 
-def set_style(p=matplotlib.rcParams):
+
+def set_style(p=None):
+    if p is None:
+        p = matplotlib.rcParams
     p['font.family'] = 'sans-serif'
     p['font.sans-serif'] = ['Arial']
     p['font.weight'] = 'normal'